@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-19 18:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('citysuggester', '0002_auto_20190107_0438'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='travelsystem',
+            name='version',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+    ]
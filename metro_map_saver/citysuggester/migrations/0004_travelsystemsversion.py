@@ -0,0 +1,28 @@
+# Generated by Django 5.1.2 on 2026-10-19 19:23
+
+from django.db import migrations, models
+
+
+def start_from_latest_system(apps, schema_editor):
+    TravelSystem = apps.get_model('citysuggester', 'TravelSystem')
+    TravelSystemsVersion = apps.get_model('citysuggester', 'TravelSystemsVersion')
+    latest = TravelSystem.objects.aggregate(latest=models.Max('version'))['latest'] or 0
+    TravelSystemsVersion.objects.create(pk=1, version=latest)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('citysuggester', '0003_travelsystem_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TravelSystemsVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(start_from_latest_system, migrations.RunPython.noop),
+    ]
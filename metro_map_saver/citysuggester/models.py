@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.db import models
+from django.db import models, transaction
 from map_saver.validator import html_dom_id_safe, convert_nonascii_to_ascii
 
 class TravelSystem(models.Model):
@@ -25,12 +25,19 @@ class TravelSystem(models.Model):
 
     name = models.CharField(max_length=255, unique=True)
     stations = models.TextField() # all stations stored together, one per line
+    # Goes up every time any system is saved, so maps only need re-checking
+    #   against the systems that changed since they were last checked (see SavedMap.suggested_city_version)
+    version = models.PositiveIntegerField(default=0, db_index=True)
 
     def _station_count(self):
         """ Return a count of how many stations there are in this system
         """
         return len(self.stations.split('\n'))
 
+    @staticmethod
+    def latest_version():
+        return TravelSystemsVersion.objects.filter(pk=1).values_list('version', flat=True).first() or 0
+
     def save(self, *args, **kwargs):
 
         """ Formats stations in the same manner as they are saved through the validator 
@@ -44,9 +51,46 @@ class TravelSystem(models.Model):
                 ).lower()
             ).strip()
         self.stations = '\n'.join(sorted(set(stations))).strip()
+        self.version = TravelSystemsVersion.next()
         super(TravelSystem, self).save(*args, **kwargs)
 
+        # Every process rebuilds its index of stations to systems on its next suggestion
+        from .utils import bump_systems_version
+        bump_systems_version()
+
+    def delete(self, *args, **kwargs):
+        deleted = super(TravelSystem, self).delete(*args, **kwargs)
+        # Maps that were matched with this system need re-checking
+        TravelSystemsVersion.next()
+
+        from .utils import bump_systems_version
+        bump_systems_version()
+        return deleted
+
     def __str__(self):
         return '{0} ({1} stations)'.format(
             self.name, self._station_count()
-        )
\ No newline at end of file
+        )
+
+class TravelSystemsVersion(models.Model):
+
+    """ The latest TravelSystem.version, in a single row.
+        Unlike the highest version of the systems that still exist,
+            this never goes back down when the newest system is deleted,
+            so a version is never handed out twice.
+    """
+
+    version = models.PositiveIntegerField(default=0)
+
+    @staticmethod
+    def next():
+
+        """ Advances the version and returns it
+        """
+
+        with transaction.atomic():
+            # The update locks the row until the transaction commits
+            if not TravelSystemsVersion.objects.filter(pk=1).update(version=models.F('version') + 1):
+                latest = TravelSystem.objects.aggregate(latest=models.Max('version'))['latest'] or 0
+                TravelSystemsVersion.objects.create(pk=1, version=latest + 1)
+            return TravelSystemsVersion.objects.get(pk=1).version
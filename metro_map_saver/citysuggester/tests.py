@@ -1,6 +1,120 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
+from io import StringIO
 
-# Create your tests here.
+from map_saver.models import SavedMap
+
+from .models import TravelSystem
+from .utils import get_systems_index, load_systems, suggest_city, SystemsIndex
+
+
+class SuggestCityTest(TestCase):
+
+    """ Test suggesting a city from a map's stations through the index of stations to systems
+    """
+
+    def setUp(self):
+        cache.clear()
+        TravelSystem.objects.create(name='Metro', stations='\n'.join(f'dc{index}' for index in range(10)))
+        TravelSystem.objects.create(name='MARC', stations='\n'.join(f'dc{index}' for index in range(6)) + '\nbaltimore')
+        TravelSystem.objects.create(name='BART', stations='\n'.join(f'sf{index}' for index in range(10)))
+
+    def test_suggest_city(self):
+        map_stations = {f'dc{index}' for index in range(8)} | {'sf1'}
+        self.assertEqual([('Metro (10)', 8), ('MARC (7)', 6)], suggest_city(map_stations))
+        self.assertEqual([('Metro (10)', 8)], suggest_city(map_stations, station_overlap=6))
+        self.assertEqual([], suggest_city({'sf1', 'sf2'}))
+        # Same results from a dict of systems, as before
+        self.assertEqual(suggest_city(map_stations), suggest_city(map_stations, systems=load_systems()))
+
+    def test_ties_in_load_order(self):
+        index = SystemsIndex({'First': {'a', 'b'}, 'Second': {'a', 'b'}})
+        self.assertEqual([('First (2)', 2), ('Second (2)', 2)], index.suggest({'a', 'b'}, station_overlap=1))
+
+    def test_rebuilt_when_systems_change(self):
+        index = get_systems_index()
+        with self.assertNumQueries(0):
+            self.assertIs(index, get_systems_index())
+
+        map_stations = {f'sf{index}' for index in range(6)} | {f'muni{index}' for index in range(7)}
+        self.assertEqual([('BART (10)', 6)], suggest_city(map_stations))
+
+        muni = TravelSystem.objects.create(name='MUNI', stations='\n'.join(f'muni{index}' for index in range(7)))
+        self.assertIsNot(index, get_systems_index())
+        self.assertEqual([('MUNI (7)', 7), ('BART (10)', 6)], suggest_city(map_stations))
+
+        muni.delete()
+        self.assertEqual([('BART (10)', 6)], suggest_city(map_stations))
+
+
+class IncrementalSuggestCityTest(TestCase):
+
+    """ Test re-checking maps against only the TravelSystems that changed since they were last checked
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.metro = TravelSystem.objects.create(name='Metro', stations='\n'.join(f'dc{index}' for index in range(10)))
+        self.dc_map = SavedMap.objects.create(urlhash='dcmap', station_count=8, stations=','.join(f'dc{index}' for index in range(8)))
+        self.sf_map = SavedMap.objects.create(urlhash='sfmap', station_count=8, stations=','.join(f'sf{index}' for index in range(8)))
+        call_command('suggest_city', stdout=StringIO(), skip_checks=True)
+
+    def test_incremental(self):
+        self.dc_map.refresh_from_db()
+        self.sf_map.refresh_from_db()
+        self.assertEqual(('Metro', 8, 1), (self.dc_map.suggested_city, self.dc_map.suggested_city_overlap, self.dc_map.suggested_city_version))
+        self.assertEqual(('', -2, 1), (self.sf_map.suggested_city, self.sf_map.suggested_city_overlap, self.sf_map.suggested_city_version))
+
+        # Nothing has changed, so there's nothing to re-check
+        output = StringIO()
+        call_command('suggest_city', '--incremental', stdout=output, skip_checks=True)
+        self.assertIn('Checking 0 maps', output.getvalue())
+
+        TravelSystem.objects.create(name='BART', stations='\n'.join(f'sf{index}' for index in range(10)))
+        output = StringIO()
+        with self.assertNumQueries(6):
+            # The latest version, counting the maps, reloading the systems (BART is new),
+            #   loading the maps, the systems changed since version 1, then one bulk update for both maps
+            call_command('suggest_city', '--incremental', stdout=output, skip_checks=True)
+        self.assertIn('Checking 2 maps', output.getvalue())
+
+        self.dc_map.refresh_from_db()
+        self.sf_map.refresh_from_db()
+        self.assertEqual(('Metro', 8, 2), (self.dc_map.suggested_city, self.dc_map.suggested_city_overlap, self.dc_map.suggested_city_version))
+        self.assertEqual(('BART', 8, 2), (self.sf_map.suggested_city, self.sf_map.suggested_city_overlap, self.sf_map.suggested_city_version))
+
+    def test_newest_system_deleted(self):
+        beta = TravelSystem.objects.create(name='Beta', stations='\n'.join(f'beta{index}' for index in range(10)))
+        beta_map = SavedMap.objects.create(urlhash='betamap', station_count=8, stations=','.join(f'beta{index}' for index in range(8)))
+        call_command('suggest_city', stdout=StringIO(), skip_checks=True)
+        beta_map.refresh_from_db()
+        self.assertEqual(('Beta', 2), (beta_map.suggested_city, beta_map.suggested_city_version))
+
+        # Deleting the system with the highest version still moves the version on
+        beta.delete()
+        self.assertEqual(3, TravelSystem.latest_version())
+        output = StringIO()
+        call_command('suggest_city', '--incremental', stdout=output, skip_checks=True)
+        self.assertIn('Checking 3 maps', output.getvalue())
+        beta_map.refresh_from_db()
+        self.assertEqual(('', -2, 3), (beta_map.suggested_city, beta_map.suggested_city_overlap, beta_map.suggested_city_version))
+
+        # and the next system doesn't reuse a version
+        gamma = TravelSystem.objects.create(name='Gamma', stations='\n'.join(f'beta{index}' for index in range(10)))
+        self.assertEqual(4, gamma.version)
+        call_command('suggest_city', '--incremental', stdout=StringIO(), skip_checks=True)
+        beta_map.refresh_from_db()
+        self.assertEqual(('Gamma', 4), (beta_map.suggested_city, beta_map.suggested_city_version))
+
+    def test_matched_system_changed(self):
+        # Metro loses most of the stations this map has in common with it
+        self.metro.stations = '\n'.join(f'dc{index}' for index in range(4))
+        self.metro.save()
+        call_command('suggest_city', '--incremental', stdout=StringIO(), skip_checks=True)
+
+        self.dc_map.refresh_from_db()
+        self.assertEqual(('', -2, 2), (self.dc_map.suggested_city, self.dc_map.suggested_city_overlap, self.dc_map.suggested_city_version))
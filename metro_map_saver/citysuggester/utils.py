@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from django.core.cache import cache
+
+import collections
 import csv
+import threading
+import time
 
 from .models import TravelSystem
 
@@ -9,14 +14,20 @@ from .models import TravelSystem
 # Only 1 station in common is probably not very useful
 MINIMUM_STATION_OVERLAP = 5
 
-def load_systems():
+# Bumped whenever a TravelSystem is saved or deleted, so every process knows to rebuild its SystemsIndex
+SYSTEMS_VERSION_KEY = 'citysuggester:systems_version'
+
+def load_systems(changed_since=None):
 
-    """ Loads all known systems into a dictionary for processing
+    """ Loads all known systems into a dictionary for processing;
+            or only the ones saved since this TravelSystem.version
     """
 
     systems = {}
 
     travel_systems = TravelSystem.objects.all()
+    if changed_since is not None:
+        travel_systems = travel_systems.filter(version__gt=changed_since)
 
     for system in travel_systems:
         systems[system.name] = set(system.stations.split('\n'))
@@ -24,23 +35,96 @@ def load_systems():
     return systems
 
 
+class SystemsIndex:
+
+    """ Which systems each station is in,
+            so scoring a map only looks up the map's own stations
+            instead of intersecting them with every system
+    """
+
+    def __init__(self, systems, version=None):
+        self.version = version
+        self.station_counts = {}
+        # For breaking ties the same way as always: in the order the systems were loaded
+        self.order = {}
+        self.systems_by_station = collections.defaultdict(list)
+        for position, (name, system_stations) in enumerate(systems.items()):
+            self.station_counts[name] = len(system_stations)
+            self.order[name] = position
+            for station in system_stations:
+                self.systems_by_station[station].append(name)
+
+    def suggest(self, map_stations, station_overlap=MINIMUM_STATION_OVERLAP):
+        hits = collections.Counter()
+        for station in set(map_stations):
+            hits.update(self.systems_by_station.get(station, ()))
+
+        matches = sorted(
+            (name for name, common_stations in hits.items() if common_stations > station_overlap),
+            key=lambda name: (-hits[name], self.order[name]),
+        )
+        return [
+            ('{0} ({1})'.format(name, self.station_counts[name]), hits[name])
+            for name in matches
+        ]
+
+
+_systems_index = None
+_systems_index_lock = threading.Lock()
+
+def get_systems_version():
+
+    """ Like map_saver.caching.get_map_card_versions, a missing version starts from the clock
+    """
+
+    version = cache.get(SYSTEMS_VERSION_KEY)
+    if version is None:
+        cache.add(SYSTEMS_VERSION_KEY, time.time_ns(), None)
+        version = cache.get(SYSTEMS_VERSION_KEY)
+    return version
+
+
+def bump_systems_version():
+    try:
+        cache.incr(SYSTEMS_VERSION_KEY)
+    except ValueError:
+        cache.set(SYSTEMS_VERSION_KEY, time.time_ns(), None)
+
+
+def get_systems_index():
+
+    """ Returns this process's SystemsIndex,
+            loading it the first time and again whenever the TravelSystems have changed
+    """
+
+    global _systems_index
+
+    version = get_systems_version()
+    if _systems_index is not None and _systems_index.version == version:
+        return _systems_index
+
+    with _systems_index_lock:
+        if _systems_index is None or _systems_index.version != version:
+            _systems_index = SystemsIndex(load_systems(), version)
+        return _systems_index
+
+
 def suggest_city(map_stations, station_overlap=MINIMUM_STATION_OVERLAP, systems=None):
 
     """ Given a set of stations from a map,
         suggest a city it might be located in
         based on known stations in known metro systems
-    """
 
-    possible_cities = {}
+        systems may be a SystemsIndex, or {name: set of stations} (as from load_systems);
+            by default, the process-wide index is used
+    """
 
     if not systems:
-        systems = load_systems()
+        systems = get_systems_index()
+    elif not isinstance(systems, SystemsIndex):
+        systems = SystemsIndex(systems)
 
-    for name, system_stations in systems.items():
-        common_stations = system_stations.intersection(map_stations)
-        if len(common_stations) > station_overlap:
-            possible_cities['{0} ({1})'.format(name, len(system_stations))] = len(common_stations) # Or maybe: the set itself, rather than the length
-    return sorted(possible_cities.items(), key=lambda kv: kv[1], reverse=True)
+    return systems.suggest(map_stations, station_overlap)
 
 
 def create_systems_from_csv(csv_file):
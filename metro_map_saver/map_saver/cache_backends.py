@@ -0,0 +1,454 @@
+""" Cache backends for the default cache, built up from mixins
+        so each layer can be tested (and turned off) on its own
+"""
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.memcached import PyMemcacheCache
+from django.http import HttpResponse
+
+from collections import OrderedDict
+
+import pickle
+import threading
+import time
+import uuid
+import zlib
+
+# Stored as-is in the local tier; HttpResponses are kept frozen and anything else is kept pickled
+#   so no two requests ever share (and mutate) the same HttpResponse
+IMMUTABLE_TYPES = (str, bytes, int, float, bool, type(None))
+
+
+class FrozenResponse:
+
+    """ The parts of a cached page (an HttpResponse from cache_page or the cache middleware)
+            needed to build a fresh copy of it, which is much cheaper than unpickling one
+    """
+
+    __slots__ = ('content', 'status', 'reason', 'headers')
+
+    def __init__(self, response):
+        self.content = response.content
+        self.status = response.status_code
+        self.reason = response.reason_phrase
+        self.headers = tuple(response.items())
+
+    @staticmethod
+    def can_freeze(value):
+        # A rendered TemplateResponse (or redirect, JsonResponse...) is fully described by these parts;
+        #   responses setting cookies carry more state than this keeps
+        return isinstance(value, HttpResponse) and getattr(value, 'is_rendered', True) and not value.cookies
+
+    def thaw(self):
+        return HttpResponse(self.content, status=self.status, reason=self.reason, headers=dict(self.headers))
+
+
+class LocalStore:
+
+    """ A size-bounded LRU of {key: (expires_at, value, thaw)}, shared by every thread in this process;
+            thaw turns the stored value back into what was set (None if it was stored as-is)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.generation = None
+        self.generation_checked_at = 0
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+
+
+# One store per cache alias per process;
+#   Django gives each thread its own cache backend instance.
+_local_stores = {}
+_local_stores_lock = threading.Lock()
+
+
+class LocalTierMixin:
+
+    """ Keeps the hottest keys in this process's memory, in front of the shared cache,
+            so they don't cost a socket round-trip every time.
+
+        Only keys starting with one of LOCAL_TIER['KEY_PREFIXES'] are kept locally
+            (by default, pages cached by cache_page and the cache middleware).
+
+        Other workers can't see this process's memory, so to stay coherent:
+            * local entries expire after LOCAL_TIER['TIMEOUT'] seconds (or sooner, if set with a shorter timeout)
+            * deleting, touching or incrementing a local-tier key (or clearing the cache)
+                bumps a generation key in the shared cache,
+                and every process empties its local tier when it sees the generation change
+                (checked at most every LOCAL_TIER['GENERATION_CHECK_INTERVAL'] seconds)
+
+        A value set in one worker can therefore be stale in another for at most TIMEOUT seconds.
+    """
+
+    GENERATION_KEY = 'localtier:generation'
+
+    def __init__(self, server, params):
+        super().__init__(server, params)
+        local_tier = params.get('LOCAL_TIER', {})
+        self.local_max_entries = local_tier.get('MAX_ENTRIES', 500)
+        self.local_timeout = local_tier.get('TIMEOUT', 10)
+        self.local_generation_interval = local_tier.get('GENERATION_CHECK_INTERVAL', 1)
+        self.local_key_prefixes = tuple(local_tier.get('KEY_PREFIXES', ('views.decorators.cache.',)))
+
+        store_name = local_tier.get('NAME') or str(server)
+        with _local_stores_lock:
+            self.local_store = _local_stores.setdefault(store_name, LocalStore())
+
+    def is_local(self, key):
+        return isinstance(key, str) and key.startswith(self.local_key_prefixes)
+
+    def local_stats(self):
+        with self.local_store.lock:
+            return dict(self.local_store.stats, entries=len(self.local_store.entries))
+
+    def _check_generation(self):
+
+        """ Empty the local tier if another process has invalidated something since we last looked
+        """
+
+        store = self.local_store
+        now = time.monotonic()
+        if now - store.generation_checked_at < self.local_generation_interval:
+            return
+        generation = super().get(self.GENERATION_KEY)
+        with store.lock:
+            store.generation_checked_at = now
+            if generation != store.generation:
+                if store.entries:
+                    store.stats['invalidations'] += 1
+                store.entries.clear()
+                store.generation = generation
+
+    def _bump_generation(self):
+        try:
+            generation = super().incr(self.GENERATION_KEY)
+        except ValueError:
+            # Missing (expired, evicted or cleared); start from somewhere
+            #   no other process could already be at
+            generation = time.time_ns()
+            super().set(self.GENERATION_KEY, generation, None)
+        store = self.local_store
+        with store.lock:
+            store.entries.clear()
+            store.stats['invalidations'] += 1
+            store.generation = generation
+            store.generation_checked_at = time.monotonic()
+
+    def _local_get(self, local_key):
+        store = self.local_store
+        with store.lock:
+            entry = store.entries.get(local_key)
+            if entry is None or entry[0] < time.monotonic():
+                store.entries.pop(local_key, None)
+                store.stats['misses'] += 1
+                return False, None
+            store.entries.move_to_end(local_key)
+            store.stats['hits'] += 1
+            _, value, thaw = entry
+        if thaw is not None:
+            value = thaw(value)
+        return True, value
+
+    def _local_set(self, local_key, value, timeout=DEFAULT_TIMEOUT):
+        local_timeout = self.local_timeout
+        if timeout is not DEFAULT_TIMEOUT and timeout is not None:
+            local_timeout = min(local_timeout, timeout)
+        if local_timeout <= 0:
+            return
+
+        if isinstance(value, IMMUTABLE_TYPES):
+            thaw = None
+        elif FrozenResponse.can_freeze(value):
+            value, thaw = FrozenResponse(value), FrozenResponse.thaw
+        else:
+            value, thaw = pickle.dumps(value, pickle.HIGHEST_PROTOCOL), pickle.loads
+
+        store = self.local_store
+        with store.lock:
+            store.entries[local_key] = (time.monotonic() + local_timeout, value, thaw)
+            store.entries.move_to_end(local_key)
+            while len(store.entries) > self.local_max_entries:
+                store.entries.popitem(last=False)
+                store.stats['evictions'] += 1
+
+    def get(self, key, default=None, version=None):
+        if not self.is_local(key):
+            return super().get(key, default, version)
+
+        self._check_generation()
+        local_key = self.make_key(key, version)
+        found, value = self._local_get(local_key)
+        if found:
+            return value
+
+        # Can't tell a stored None from a miss with a default of None,
+        #   so use a sentinel to only keep real hits
+        missing = object()
+        value = super().get(key, missing, version)
+        if value is missing:
+            return default
+        self._local_set(local_key, value)
+        return value
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        local_keys = [key for key in keys if self.is_local(key)]
+        if local_keys:
+            self._check_generation()
+
+        found = {}
+        remaining = []
+        for key in keys:
+            if key in local_keys:
+                hit, value = self._local_get(self.make_key(key, version))
+                if hit:
+                    found[key] = value
+                    continue
+            remaining.append(key)
+
+        if remaining:
+            fetched = super().get_many(remaining, version)
+            for key, value in fetched.items():
+                if key in local_keys:
+                    self._local_set(self.make_key(key, version), value)
+            found.update(fetched)
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        result = super().set(key, value, timeout, version)
+        if self.is_local(key):
+            self._local_set(self.make_key(key, version), value, timeout)
+        return result
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = super().set_many(data, timeout, version)
+        for key, value in data.items():
+            if self.is_local(key) and key not in failed:
+                self._local_set(self.make_key(key, version), value, timeout)
+        return failed
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = super().add(key, value, timeout, version)
+        if added and self.is_local(key):
+            self._local_set(self.make_key(key, version), value, timeout)
+        return added
+
+    def delete(self, key, version=None):
+        if self.is_local(key):
+            self._bump_generation()
+        return super().delete(key, version)
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        if any(self.is_local(key) for key in keys):
+            self._bump_generation()
+        return super().delete_many(keys, version)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        if self.is_local(key):
+            self._bump_generation()
+        return super().touch(key, timeout, version)
+
+    def incr(self, key, delta=1, version=None):
+        value = super().incr(key, delta, version)
+        if self.is_local(key):
+            self._bump_generation()
+        return value
+
+    def decr(self, key, delta=1, version=None):
+        value = super().decr(key, delta, version)
+        if self.is_local(key):
+            self._bump_generation()
+        return value
+
+    def clear(self):
+        result = super().clear()
+        # The generation key went with everything else
+        self._bump_generation()
+        return result
+
+
+class CompressedValue:
+
+    """ A pickled, zlib-compressed value
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+
+class PickledValue:
+
+    """ A value that was already pickled (to measure it), kept that way:
+            pickling this again only copies the bytes, rather than walking the whole object again
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+
+class ChunkManifest:
+
+    """ Stored in place of a value too big for one memcached item;
+            the compressed value itself is split across chunk_count keys
+            named after the original key and this manifest's token
+    """
+
+    def __init__(self, token, chunk_count):
+        self.token = token
+        self.chunk_count = chunk_count
+
+    def chunk_keys(self, key):
+        return [f'{key}:chunk:{self.token}:{index}' for index in range(self.chunk_count)]
+
+
+class ChunkedValuesMixin:
+
+    """ Lets the cache hold values bigger than memcached's item size limit (-I 2m; see supervisor.conf).
+
+        Values that pickle to more than CHUNKED_VALUES['COMPRESS_THRESHOLD'] bytes are stored zlib-compressed;
+            if that's still more than CHUNKED_VALUES['CHUNK_SIZE'], it's split into chunks
+            and the key itself holds a manifest listing them.
+
+        Without this, memcached refuses anything over the limit
+            and the next request for it is a miss, every time -- e.g. big 360x360 maps under cache_page.
+
+        Chunks are written before their manifest, and each write gets a fresh token,
+            so a reader never sees a half-written value.
+            If any chunk has been evicted, the whole value is a miss.
+        Deleting a key only deletes its manifest; orphaned chunks expire with the same timeout.
+
+        Small values (including integers, so incr/decr keep working) are passed through untouched.
+    """
+
+    CHUNKED_COUNTER_KEY = 'chunkedvalues:chunked'
+
+    def __init__(self, server, params):
+        super().__init__(server, params)
+        chunked_values = params.get('CHUNKED_VALUES', {})
+        self.compress_threshold = chunked_values.get('COMPRESS_THRESHOLD', 64 * 1024)
+        self.chunk_size = chunked_values.get('CHUNK_SIZE', 1024 * 1024)
+        self.chunk_stats = {
+            'compressed': 0,
+            'chunked': 0,
+            'chunks_written': 0,
+            'chunk_misses': 0,
+        }
+
+    def chunked_count(self):
+
+        """ How many values have needed chunking, across every process
+                (since memcached last restarted)
+        """
+
+        return super().get(self.CHUNKED_COUNTER_KEY, 0)
+
+    def _encode(self, key, value):
+
+        """ Returns (value to store at key, {chunk key: chunk})
+        """
+
+        if isinstance(value, (int, float, bool, type(None))):
+            return value, {}
+
+        if isinstance(value, (str, bytes)):
+            # Measured without pickling; the cache stores these as-is
+            if len(value) <= self.compress_threshold:
+                return value, {}
+            pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        else:
+            # Pickled once, and that pickle is what's stored (compressed or not)
+            pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            if len(pickled) <= self.compress_threshold:
+                return PickledValue(pickled), {}
+
+        compressed = zlib.compress(pickled)
+        self.chunk_stats['compressed'] += 1
+        if len(compressed) <= self.chunk_size:
+            return CompressedValue(compressed), {}
+
+        manifest = ChunkManifest(uuid.uuid4().hex[:12], -(-len(compressed) // self.chunk_size))
+        chunks = {
+            chunk_key: compressed[index * self.chunk_size:(index + 1) * self.chunk_size]
+            for index, chunk_key in enumerate(manifest.chunk_keys(key))
+        }
+        self.chunk_stats['chunked'] += 1
+        self.chunk_stats['chunks_written'] += len(chunks)
+        try:
+            super().incr(self.CHUNKED_COUNTER_KEY)
+        except ValueError:
+            super().add(self.CHUNKED_COUNTER_KEY, 1, None)
+        return manifest, chunks
+
+    def _decode(self, key, value, default, version):
+        if isinstance(value, ChunkManifest):
+            chunk_keys = value.chunk_keys(key)
+            chunks = super().get_many(chunk_keys, version)
+            if len(chunks) != len(chunk_keys):
+                self.chunk_stats['chunk_misses'] += 1
+                return default
+            value = CompressedValue(b''.join(chunks[chunk_key] for chunk_key in chunk_keys))
+        if isinstance(value, CompressedValue):
+            return pickle.loads(zlib.decompress(value.data))
+        if isinstance(value, PickledValue):
+            return pickle.loads(value.data)
+        return value
+
+    def get(self, key, default=None, version=None):
+        missing = object()
+        value = super().get(key, missing, version)
+        if value is missing:
+            return default
+        return self._decode(key, value, default, version)
+
+    def get_many(self, keys, version=None):
+        missing = object()
+        found = {}
+        for key, value in super().get_many(keys, version).items():
+            value = self._decode(key, value, missing, version)
+            if value is not missing:
+                found[key] = value
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        value, chunks = self._encode(key, value)
+        if chunks and super().set_many(chunks, timeout, version):
+            # Couldn't store every chunk; don't leave an older value behind either
+            super().delete(key, version)
+            return
+        return super().set(key, value, timeout, version)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        value, chunks = self._encode(key, value)
+        if chunks and super().set_many(chunks, timeout, version):
+            return False
+        return super().add(key, value, timeout, version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        encoded = {}
+        all_chunks = {}
+        chunk_owners = {}
+        for key, value in data.items():
+            encoded[key], chunks = self._encode(key, value)
+            all_chunks.update(chunks)
+            chunk_owners.update(dict.fromkeys(chunks, key))
+
+        failed = []
+        if all_chunks:
+            failed = sorted({chunk_owners[chunk_key] for chunk_key in super().set_many(all_chunks, timeout, version)})
+        if failed:
+            # Same as set(): a value whose chunks couldn't all be stored is a miss, not an older value
+            super().delete_many(failed, version)
+            for key in failed:
+                del encoded[key]
+        return failed + super().set_many(encoded, timeout, version)
+
+
+class TieredPyMemcacheCache(LocalTierMixin, ChunkedValuesMixin, PyMemcacheCache):
+    pass
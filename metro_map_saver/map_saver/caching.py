@@ -0,0 +1,325 @@
+""" Cache keys and helpers shared across map_saver views,
+        kept together so the lookups and their invalidation live side by side
+"""
+
+from django.core.cache import cache
+from django.db.models import Max, Min
+
+import hashlib
+import random
+import re
+import time
+
+# Double-clicks and "save again" send byte-for-byte identical POSTs;
+#   remembering which urlhash a raw payload produced lets us answer those
+#   without running the full validation pipeline again.
+# Maps are never overwritten once saved, so this can live a long time.
+RAW_PAYLOAD_TIMEOUT = 60 * 60 * 24 * 7
+
+
+def raw_payload_key(raw_mapdata):
+    return 'rawsave:{0}'.format(hashlib.sha256(raw_mapdata.encode('utf-8')).hexdigest())
+
+
+def get_urlhash_for_raw_payload(raw_mapdata):
+
+    """ Returns the urlhash a previous save of this exact payload produced,
+            or None if this payload hasn't been seen (or has expired)
+    """
+
+    if not raw_mapdata:
+        return None
+    return cache.get(raw_payload_key(raw_mapdata))
+
+
+def remember_raw_payload(raw_mapdata, urlhash):
+
+    """ Record that this exact payload validated and saved as urlhash.
+
+        Only the urlhash is stored, never the naming token:
+            the token is handed out once, to whoever created the map,
+            and a repeated save is answered the same way as saving a map that already exists.
+    """
+
+    if raw_mapdata and urlhash:
+        cache.set(raw_payload_key(raw_mapdata), urlhash, RAW_PAYLOAD_TIMEOUT)
+
+
+async def aget_urlhash_for_raw_payload(raw_mapdata):
+    if not raw_mapdata:
+        return None
+    return await cache.aget(raw_payload_key(raw_mapdata))
+
+
+async def aremember_raw_payload(raw_mapdata, urlhash):
+    if raw_mapdata and urlhash:
+        await cache.aset(raw_payload_key(raw_mapdata), urlhash, RAW_PAYLOAD_TIMEOUT)
+
+
+# Nearly every page about a single map starts by turning its urlhash into a row;
+#   remember the answer (including "there's no such map", briefly)
+#   so repeat visits -- and bots requesting made-up urlhashes -- don't reach the database.
+URLHASH_TIMEOUT = 60 * 60 * 24
+URLHASH_MISSING_TIMEOUT = 60 * 5
+URLHASH_MISSING = 'missing'
+
+# Anything else can't be a urlhash (see hex64),
+#   and might not be a valid memcached key either
+CACHEABLE_URLHASH = re.compile(r'[\w-]{1,64}', re.ASCII)
+
+
+def urlhash_key(urlhash):
+    return f'urlhash:{urlhash}'
+
+
+def resolve_urlhash(urlhash):
+
+    """ Returns {'pk', 'created_at', 'payload_etag'} for the map with this urlhash,
+            or None if there isn't one.
+
+        If (somehow) more than one map has the same urlhash, the earliest one wins,
+            same as everywhere else.
+
+        SavedMap.save() forgets the cached answer, so a map that's just been created
+            won't be hidden behind a cached "missing".
+    """
+
+    if not urlhash:
+        return None
+
+    cacheable = CACHEABLE_URLHASH.fullmatch(urlhash)
+    if cacheable:
+        resolved = cache.get(urlhash_key(urlhash))
+        if resolved == URLHASH_MISSING:
+            return None
+        elif resolved:
+            return resolved
+
+    from .models import SavedMap
+
+    resolved = SavedMap.objects.filter(urlhash=urlhash).order_by('id').values(
+        'pk',
+        'created_at',
+        'payload_etag',
+    ).first()
+
+    if cacheable:
+        if resolved:
+            cache.set(urlhash_key(urlhash), resolved, URLHASH_TIMEOUT)
+        else:
+            cache.set(urlhash_key(urlhash), URLHASH_MISSING, URLHASH_MISSING_TIMEOUT)
+
+    return resolved
+
+
+async def aresolve_urlhash(urlhash):
+
+    """ Same as resolve_urlhash, for async views
+    """
+
+    if not urlhash:
+        return None
+
+    cacheable = CACHEABLE_URLHASH.fullmatch(urlhash)
+    if cacheable:
+        resolved = await cache.aget(urlhash_key(urlhash))
+        if resolved == URLHASH_MISSING:
+            return None
+        elif resolved:
+            return resolved
+
+    from .models import SavedMap
+
+    resolved = await SavedMap.objects.filter(urlhash=urlhash).order_by('id').values(
+        'pk',
+        'created_at',
+        'payload_etag',
+    ).afirst()
+
+    if cacheable:
+        if resolved:
+            await cache.aset(urlhash_key(urlhash), resolved, URLHASH_TIMEOUT)
+        else:
+            await cache.aset(urlhash_key(urlhash), URLHASH_MISSING, URLHASH_MISSING_TIMEOUT)
+
+    return resolved
+
+
+def forget_urlhash(*urlhashes):
+    cache.delete_many([
+        urlhash_key(urlhash)
+        for urlhash in urlhashes
+        if urlhash and CACHEABLE_URLHASH.fullmatch(urlhash)
+    ])
+
+
+# Each map card (map_saver/map_card.html) is cached as a template fragment
+#   that varies on the map's card version, so anything that changes what a card shows
+#   only has to bump the version, and every cached copy of that card goes stale at once.
+MAP_CARD_VERSION_TIMEOUT = None
+
+
+def map_card_version_key(pk):
+    return f'mapcard:version:{pk}'
+
+
+def get_map_card_versions(pks):
+
+    """ Returns {pk: card version} for these maps, in one round trip for the ones already known.
+
+        A version that's missing (never set, or evicted) starts from the clock rather than from 0,
+            so it can't land back on a version whose stale card is still cached.
+    """
+
+    keys = {map_card_version_key(pk): pk for pk in pks}
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        for key in missing:
+            cache.add(key, time.time_ns(), MAP_CARD_VERSION_TIMEOUT)
+        # Another process may have added (or bumped) one first; theirs wins
+        versions.update(cache.get_many(missing))
+    return {keys[key]: version for key, version in versions.items()}
+
+
+def bump_map_card_version(*pks):
+    for pk in pks:
+        try:
+            cache.incr(map_card_version_key(pk))
+        except ValueError:
+            cache.set(map_card_version_key(pk), time.time_ns(), MAP_CARD_VERSION_TIMEOUT)
+
+
+# Picking random favorites with ORDER BY RAND() sorts every favorite on every cache miss;
+#   instead, keep the (small) list of eligible pks for each place favorites are shown,
+#   sample from it here, and fetch only the chosen maps.
+# Admin actions forget the pools; otherwise (e.g. tags edited in the Django admin) they're rebuilt hourly.
+FAVORITES_POOL_TIMEOUT = 60 * 60
+FAVORITES_POOLS = (
+    'home',
+    'gallery',
+    'thumbnails',
+)
+
+
+def favorites_pool_key(pool):
+    return f'favorites:pool:{pool}'
+
+
+def favorites_pool_queryset(pool):
+
+    """ The favorite maps eligible to be shown in this pool
+    """
+
+    from .models import SavedMap
+
+    favorites = SavedMap.objects.filter(tags__slug='favorite')
+
+    if pool == 'home':
+        return favorites \
+            .filter(gallery_visible=True) \
+            .exclude(thumbnail__exact='') \
+            .exclude(name__exact='') \
+            .exclude(tags__slug='reviewed')
+    elif pool == 'gallery':
+        return favorites.filter(publicly_visible=True)
+    elif pool == 'thumbnails':
+        return favorites \
+            .filter(publicly_visible=True) \
+            .exclude(name__exact='') \
+            .exclude(tags__slug='reviewed')
+    raise ValueError(f'No such favorites pool: {pool}')
+
+
+def get_favorites_pool(pool):
+    pks = cache.get(favorites_pool_key(pool))
+    if pks is None:
+        pks = list(favorites_pool_queryset(pool).order_by('pk').values_list('pk', flat=True).distinct())
+        cache.set(favorites_pool_key(pool), pks, FAVORITES_POOL_TIMEOUT)
+    return pks
+
+
+def sample_favorites(pool, count):
+
+    """ Returns up to count randomly-chosen favorite maps from this pool, in random order
+    """
+
+    from .models import SavedMap
+
+    pks = get_favorites_pool(pool)
+    chosen = random.sample(pks, min(count, len(pks)))
+    # The thumbnail is shown, so unlike SavedMap.DEFER_FIELDS, don't defer it
+    favorites = SavedMap.objects.defer('mapdata', 'data', 'payload_gzip', 'stations').in_bulk(chosen)
+    # A map deleted since the pool was built is skipped
+    return [favorites[pk] for pk in chosen if pk in favorites]
+
+
+def forget_favorites_pools():
+    cache.delete_many([favorites_pool_key(pool) for pool in FAVORITES_POOLS])
+
+
+# /random/ picks a random pk between the lowest and highest and takes the first map at or after it
+#   (wrapping around), so it costs one indexed lookup however many maps there are.
+# Each gap left by deleted maps adds its whole width to the odds of the map just after it,
+#   which is tolerable across every map, where gaps are few and narrow relative to the range.
+# New maps can't be picked until the cached bounds expire.
+RANDOM_MAP_BOUNDS_TIMEOUT = 60 * 5
+
+# Publicly visible maps are a small, sparse subset of every pk, so probing between their bounds
+#   would pick a map after a long run of private maps far more often than one after a short run;
+#   like the favorites, keep the list of their pks instead and choose from it evenly.
+# Publishing (or deleting) a map forgets the pool; otherwise it's rebuilt hourly.
+RANDOM_PUBLIC_POOL_TIMEOUT = 60 * 60
+RANDOM_PUBLIC_POOL_KEY = 'randommap:pool:public'
+
+
+def random_map_queryset(publicly_visible=False):
+    from .models import SavedMap
+
+    maps = SavedMap.objects.all()
+    if publicly_visible:
+        maps = maps.filter(publicly_visible=True)
+    return maps
+
+
+def random_map_bounds_key():
+    return 'randommap:bounds:all'
+
+
+def get_random_public_pool():
+    pks = cache.get(RANDOM_PUBLIC_POOL_KEY)
+    if pks is None:
+        pks = list(random_map_queryset(publicly_visible=True).order_by('pk').values_list('pk', flat=True))
+        cache.set(RANDOM_PUBLIC_POOL_KEY, pks, RANDOM_PUBLIC_POOL_TIMEOUT)
+    return pks
+
+
+def forget_random_public_pool():
+    cache.delete(RANDOM_PUBLIC_POOL_KEY)
+
+
+def random_map_pk(publicly_visible=False):
+
+    """ Returns the pk of a randomly-chosen map (optionally, only publicly visible maps),
+            or None if there aren't any
+    """
+
+    if publicly_visible:
+        pks = get_random_public_pool()
+        return random.choice(pks) if pks else None
+
+    maps = random_map_queryset()
+
+    bounds = cache.get(random_map_bounds_key())
+    if bounds is None:
+        bounds = maps.aggregate(low=Min('pk'), high=Max('pk'))
+        if bounds['low'] is None:
+            return None
+        cache.set(random_map_bounds_key(), bounds, RANDOM_MAP_BOUNDS_TIMEOUT)
+
+    probe = random.randint(bounds['low'], bounds['high'])
+    pk = maps.filter(pk__gte=probe).order_by('pk').values_list('pk', flat=True).first()
+    if pk is None:
+        # Everything from the probe up has been deleted since the bounds were cached
+        pk = maps.filter(pk__lt=probe).order_by('pk').values_list('pk', flat=True).first()
+    return pk
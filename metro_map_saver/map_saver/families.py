@@ -0,0 +1,88 @@
+""" Grouping the many near-identical versions people save of one map into a MapFamily.
+
+    Each map, in the order they were created, joins the family of the most similar earlier map
+        (by station names; see map_saver.similarity) that was created shortly before it,
+        or starts a family of its own. The newest map in a family is its latest version.
+
+    ./manage.py cluster_families (run on a regular schedule) clusters the maps that aren't in a family yet;
+        the admin gallery can then show only the latest version of each family
+        out of the maps it's showing (?collapse=1).
+"""
+
+from django.db import transaction
+from django.db.models import F
+
+from .similarity import candidate_pks, station_set, station_similarity, SIMILARITY_THRESHOLD
+
+import datetime
+
+# How long after the previous version a map can be saved and still be another version of it
+FAMILY_WINDOW = datetime.timedelta(days=7)
+
+
+def find_family(saved_map):
+
+    """ Returns (family pk, similarity) of the most similar earlier map in a family,
+            or (None, 0) if there isn't one similar enough
+    """
+
+    from .models import SavedMap
+
+    these_stations = station_set(saved_map.stations or '')
+    if not these_stations:
+        return None, 0
+
+    earlier_maps = SavedMap.objects.filter(
+        pk__lt=saved_map.pk,
+        created_at__gte=saved_map.created_at - FAMILY_WINDOW,
+        family_membership__isnull=False,
+    )
+    earlier_maps = earlier_maps.filter(
+        pk__in=candidate_pks(saved_map, among=earlier_maps),
+    ).values_list('stations', 'family_membership__family')
+
+    best_family, best_similarity = None, 0
+    for stations, family in earlier_maps:
+        similarity = station_similarity(these_stations, station_set(stations))
+        if similarity >= SIMILARITY_THRESHOLD and similarity > best_similarity:
+            best_family, best_similarity = family, similarity
+    return best_family, best_similarity
+
+
+def cluster_map(saved_map):
+
+    """ Adds this map to the family it belongs in (starting a new one if need be);
+            returns True if it joined an existing family
+    """
+
+    from .models import MapFamily, MapFamilyMember
+
+    family, similarity = find_family(saved_map)
+    joined = family is not None
+    with transaction.atomic():
+        if joined:
+            # Maps are clustered oldest first, so this is the latest version
+            MapFamily.objects.filter(pk=family).update(size=F('size') + 1, latest=saved_map)
+        else:
+            family = MapFamily.objects.create(latest=saved_map).pk
+            similarity = 1
+        MapFamilyMember.objects.create(savedmap=saved_map, family_id=family, similarity=similarity)
+    return joined
+
+
+def refresh_families(*families):
+
+    """ Recounts these families' size and latest version,
+            for when members were deleted
+    """
+
+    from .models import MapFamily
+
+    for family in MapFamily.objects.filter(pk__in=families):
+        members = list(family.members.order_by('-savedmap_id').values_list('savedmap_id', flat=True))
+        if not members:
+            family.delete()
+            continue
+        family.size = len(members)
+        family.latest_id = members[0]
+        family.save()
@@ -0,0 +1,135 @@
+""" Guarding the admin gallery's free-form filters (?station_count__lte=10&activitylog__user=1)
+        and ordering (?order_by=-likes) against queries that would tie up the database.
+
+    Only lookups onto indexed columns are allowed (ALLOWED_FILTERS, ALLOWED_ORDERINGS);
+        before running, MySQL's EXPLAIN estimates the query's cost, and queries over MAX_QUERY_COST are rejected;
+        and the gallery's queries run with a per-query time limit (query_timeout).
+"""
+
+from django.conf import settings
+from django.core.exceptions import FieldError, ValidationError
+from django.db import connection
+
+from contextlib import contextmanager
+
+import json
+
+# Lookups that can use an index on the column (so no __contains, __iregex, __date, ...)
+RANGE_LOOKUPS = {'exact', 'in', 'gt', 'gte', 'lt', 'lte', 'range'}
+TEXT_LOOKUPS = {'exact', 'in', 'startswith', 'isnull'}
+FILE_LOOKUPS = {'exact', 'isnull'}
+FOREIGN_KEY_LOOKUPS = {'exact', 'in', 'isnull'}
+
+ALLOWED_FILTERS = {
+    'id': RANGE_LOOKUPS,
+    'pk': RANGE_LOOKUPS,
+    'urlhash': TEXT_LOOKUPS,
+    'gallery_visible': {'exact'},
+    'publicly_visible': {'exact'},
+    'created_at': RANGE_LOOKUPS | {'year'},
+    'station_count': RANGE_LOOKUPS,
+    'name': TEXT_LOOKUPS,
+    'suggested_city': TEXT_LOOKUPS,
+    'suggested_city_overlap': RANGE_LOOKUPS,
+    'likes': RANGE_LOOKUPS,
+    'dislikes': RANGE_LOOKUPS,
+    'svg': FILE_LOOKUPS,
+    'png': FILE_LOOKUPS,
+    'thumbnail_svg': FILE_LOOKUPS,
+    'thumbnail_png': FILE_LOOKUPS,
+    'city': FOREIGN_KEY_LOOKUPS,
+    'city__name': TEXT_LOOKUPS,
+    'tags__slug': {'exact', 'in'},
+    'activitylog__user': FOREIGN_KEY_LOOKUPS,
+    'family_membership__family': FOREIGN_KEY_LOOKUPS,
+}
+
+ALLOWED_ORDERINGS = {
+    f'{direction}{field}'
+    for field in ('id', 'created_at', 'station_count', 'name', 'suggested_city', 'suggested_city_overlap', 'likes', 'dislikes', 'svg')
+    for direction in ('', '-')
+}
+
+# In MySQL's EXPLAIN cost units; a full scan of the maps table with a join is well past this
+MAX_QUERY_COST = getattr(settings, 'GALLERY_MAX_QUERY_COST', 200000)
+QUERY_TIMEOUT_MS = getattr(settings, 'GALLERY_QUERY_TIMEOUT_MS', 5000)
+
+
+class RejectedQuery(Exception):
+    pass
+
+
+def check_filters(filters):
+
+    """ Raises RejectedQuery unless every filter is an allowed lookup
+    """
+
+    for key in filters:
+        path, _, lookup = key.rpartition('__')
+        if not path or key in ALLOWED_FILTERS:
+            path, lookup = key, 'exact'
+        if lookup not in ALLOWED_FILTERS.get(path, ()):
+            raise RejectedQuery(f'Filtering by {key} is not allowed.')
+
+
+def check_ordering(order_by):
+    if order_by not in ALLOWED_ORDERINGS:
+        raise RejectedQuery(f'Ordering by {order_by} is not allowed.')
+
+
+def apply_filters(queryset, filters):
+
+    """ Returns the queryset filtered by these (already checked) filters,
+            raising RejectedQuery for values that don't fit their column
+    """
+
+    try:
+        return queryset.filter(**filters)
+    except (FieldError, ValidationError, ValueError, TypeError) as exc:
+        raise RejectedQuery(f'Invalid filter: {exc}')
+
+
+def estimated_cost(queryset):
+
+    """ Returns MySQL's estimate of what running this query would cost,
+            or None where the database can't say
+    """
+
+    if connection.vendor != 'mysql':
+        return None
+    try:
+        plan = json.loads(queryset.explain(format='json'))
+        return float(plan['query_block']['cost_info']['query_cost'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def check_cost(queryset):
+    cost = estimated_cost(queryset)
+    if cost is not None and cost > MAX_QUERY_COST:
+        raise RejectedQuery(f'This query is too expensive to run (estimated cost {cost:,.0f}); try narrower filters.')
+
+
+@contextmanager
+def query_timeout(milliseconds=QUERY_TIMEOUT_MS):
+
+    """ Stops any SELECT that runs longer than this, on MySQL (max_execution_time)
+            or Postgres (statement_timeout); the query then raises OperationalError
+    """
+
+    statements = {
+        'mysql': ('SET SESSION max_execution_time = %s', 'SET SESSION max_execution_time = 0'),
+        'postgresql': ('SET statement_timeout = %s', 'SET statement_timeout = 0'),
+    }.get(connection.vendor)
+
+    if not statements:
+        yield
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(statements[0], [int(milliseconds)])
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute(statements[1])
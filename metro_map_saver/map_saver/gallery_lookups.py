@@ -0,0 +1,147 @@
+""" The lookups the admin gallery's map cards make (see templatetags.admin_gallery_tags),
+        done once for the whole page instead of once per card.
+
+    Per card, the gallery used to count existing publicly visible maps with the same name for every tag,
+        count those whose name contains the suggested city (name__contains, which can't use an index),
+        look up the suggested city's TravelSystem, and count the map's ActivityLog entries;
+        a page of 100 maps ran hundreds of queries.
+
+    GalleryLookups instead reads the (name, tag) of the publicly visible tagged maps
+        named (or with a name containing) one of the names on the page in one query
+        and matches names in Python, looks up every suggested city's TravelSystem in one query,
+        and counts every card's ActivityLog entries in one grouped query.
+    The view puts it in the context as gallery_lookups; without it, the tags fall back to querying per card.
+"""
+
+from django.db.models import Count, Q
+from django.utils.functional import cached_property
+
+from collections import Counter
+
+# Tags that find_existing_maps searches
+SUGGESTED_CITY_TAGS = ('real', 'speculative')
+
+
+def clean_name(name):
+
+    """ User-named maps have suggested tags in parentheses,
+            and TravelSystems contain the country name (after a comma);
+            neither is considered part of the name
+    """
+
+    name = name.split("(")[0].strip()
+    return name.split(",")[0].strip()
+
+
+class GalleryLookups:
+
+    def __init__(self, saved_maps, tags):
+
+        from moderate.models import ActivityLog
+
+        self.saved_maps = list(saved_maps)
+        self.tags = list(tags)
+        self._contains_counts = {}
+
+        activity = {}
+        if self.saved_maps:
+            activity = dict(
+                ActivityLog.objects.filter(savedmap__in=[saved_map.pk for saved_map in self.saved_maps])
+                .values_list('savedmap')
+                .annotate(count=Count('id'))
+            )
+        for saved_map in self.saved_maps:
+            saved_map.activity_count = activity.get(saved_map.pk, 0)
+            # For the existing_maps filter, which only gets the map
+            saved_map.gallery_lookups = self
+
+    @cached_property
+    def map_names(self):
+        return {clean_name(saved_map.name) for saved_map in self.saved_maps if saved_map.name} - {''}
+
+    @cached_property
+    def suggested_cities(self):
+        return {clean_name(saved_map.suggested_city) for saved_map in self.saved_maps if saved_map.suggested_city} - {''}
+
+    @cached_property
+    def public_names(self):
+
+        """ Returns [(name, tag slug), ...] of the publicly visible maps
+                with one of the tags the gallery can show counts for
+                that are named one of this page's maps' names, or have one of its suggested cities in their name
+        """
+
+        from .models import SavedMap
+
+        if not self.map_names and not self.suggested_cities:
+            return []
+
+        matches = Q(name__in=self.map_names)
+        for suggested_city in self.suggested_cities:
+            matches |= Q(name__contains=suggested_city)
+
+        # existing_maps is called with the tag's name, which matches its slug
+        slugs = {tag.name for tag in self.tags} | {tag.slug for tag in self.tags} | set(SUGGESTED_CITY_TAGS)
+        return list(
+            SavedMap.objects.filter(matches, publicly_visible=True, tags__slug__in=slugs).values_list('name', 'tags__slug')
+        )
+
+    @cached_property
+    def name_counts(self):
+        # Like name= on MySQL's case-insensitive collation
+        return Counter((name.lower(), slug) for name, slug in self.public_names)
+
+    def existing_maps(self, name, tag):
+
+        """ How many publicly visible maps with this tag have exactly this name
+        """
+
+        return self.name_counts.get((clean_name(name).lower(), tag), 0)
+
+    def find_existing_maps(self, name, tag):
+
+        """ How many publicly visible maps with this tag have this name in theirs;
+                case-sensitive, like name__contains (LIKE BINARY) on MySQL
+        """
+
+        from .models import SavedMap
+
+        name = clean_name(name)
+        if not name:
+            return None
+        if name not in self.suggested_cities:
+            # Not one of this page's suggested cities, so public_names may not have its matches
+            return SavedMap.objects.filter(publicly_visible=True, name__contains=name, tags__slug=tag).count()
+        if (name, tag) not in self._contains_counts:
+            self._contains_counts[(name, tag)] = sum(
+                1 for public_name, slug in self.public_names
+                if slug == tag and name in public_name
+            )
+        return self._contains_counts[(name, tag)]
+
+    @cached_property
+    def travel_systems(self):
+
+        """ Returns {name: TravelSystem} of the systems these maps' suggested cities could be
+        """
+
+        from citysuggester.models import TravelSystem
+
+        suggested_cities = {saved_map.suggested_city for saved_map in self.saved_maps if saved_map.suggested_city}
+        if not suggested_cities:
+            return {}
+        starts_with = Q()
+        for suggested_city in suggested_cities:
+            starts_with |= Q(name__startswith=suggested_city)
+        return {system.name: system for system in TravelSystem.objects.filter(starts_with).only('name', 'stations')}
+
+    def stations_in_travelsystem(self, name):
+
+        """ How many stations there are in the TravelSystem this name starts
+        """
+
+        system = self.travel_systems.get(name)
+        if not system:
+            system = next((system for system_name, system in sorted(self.travel_systems.items()) if system_name.startswith(name)), None)
+        if system:
+            return system._station_count()
@@ -0,0 +1,323 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from map_saver.validator import (
+    validate_metro_map,
+    validate_metro_map_v2,
+    validate_metro_map_v3,
+    MAX_MAP_SIZE,
+)
+
+import json
+import logging
+import math
+import time
+import tracemalloc
+
+COLORS = ['bd1038', 'df8600', 'f0ce15', '00b251', '0896d7', '662c90', 'a2a2a2']
+
+# If doubling the input more than this many times over multiplies the time it takes,
+#   (2 ** 1.3 = ~2.5x the time for 2x the input) that's worth a look
+SUPERLINEAR_EXPONENT = 1.3
+
+# json.loads gives up somewhere short of Python's recursion limit,
+#   so the deep nesting payloads keep their depth fixed well under it and grow wider instead
+NESTING_DEPTH = 50
+
+
+def grid_points(n):
+
+    """ Yields n distinct (x, y) points as strings, filling the map row by row
+    """
+
+    for index in range(min(n, MAX_MAP_SIZE * MAX_MAP_SIZE)):
+        yield str(index % MAX_MAP_SIZE), str(index // MAX_MAP_SIZE)
+
+
+def deeply_nested(n):
+
+    """ n branches, each nested NESTING_DEPTH deep
+    """
+
+    nested = 1
+    for _ in range(NESTING_DEPTH):
+        nested = {'0': nested}
+    return {str(index): nested for index in range(n)}
+
+
+# Each payload builder takes n, roughly "how much" of the input to generate,
+#   and returns a metro_map in that data_version's format.
+
+def v1_valid(n):
+    metro_map = {'global': {'lines': {color: {'displayName': f'{color} Line'} for color in COLORS}}}
+    for index, (x, y) in enumerate(grid_points(n)):
+        point = {'line': COLORS[index % len(COLORS)]}
+        if index % 10 == 0:
+            point['station'] = {'name': f'Station_{index}', 'lines': [point['line']]}
+        metro_map.setdefault(x, {})[y] = point
+    return metro_map
+
+def v1_nondigit_keys(n):
+    metro_map = v1_valid(10)
+    for index in range(n):
+        metro_map[f'x{index}'] = {f'y{index}': {'line': COLORS[0]}}
+    return metro_map
+
+def v1_huge_station_names(n):
+    metro_map = v1_valid(n)
+    for x in metro_map:
+        if x == 'global':
+            continue
+        for y in metro_map[x]:
+            metro_map[x][y]['station'] = {'name': 'A' * 10000, 'lines': []}
+    return metro_map
+
+def v1_deep_nesting(n):
+    metro_map = v1_valid(10)
+    metro_map['0']['0']['station'] = {'name': 'Deep', 'lines': [], 'orientation': deeply_nested(n)}
+    return metro_map
+
+def v2_valid(n):
+    metro_map = {
+        'global': {'data_version': 2, 'lines': {color: {'displayName': f'{color} Line'} for color in COLORS}},
+        'points_by_color': {},
+        'stations': {},
+    }
+    for index, (x, y) in enumerate(grid_points(n)):
+        color = COLORS[index % len(COLORS)]
+        metro_map['points_by_color'].setdefault(color, {'xys': {}})['xys'].setdefault(x, {})[y] = 1
+        if index % 10 == 0:
+            metro_map['stations'].setdefault(x, {})[y] = {'name': f'Station_{index}'}
+    return metro_map
+
+def v2_nondigit_keys(n):
+    metro_map = v2_valid(10)
+    xys = metro_map['points_by_color'][COLORS[0]]['xys']
+    for index in range(n):
+        xys[f'x{index}'] = {f'y{index}': 1}
+    return metro_map
+
+def v2_huge_station_names(n):
+    metro_map = v2_valid(n)
+    for color in metro_map['points_by_color']:
+        for x, ys in metro_map['points_by_color'][color]['xys'].items():
+            for y in ys:
+                metro_map['stations'].setdefault(x, {})[y] = {'name': 'A' * 10000}
+    return metro_map
+
+def v2_duplicate_points(n):
+
+    """ Every point is drawn in every color; only the first color should win
+    """
+
+    metro_map = v2_valid(0)
+    for color in COLORS:
+        xys = metro_map['points_by_color'].setdefault(color, {'xys': {}})['xys']
+        for x, y in grid_points(n):
+            xys.setdefault(x, {})[y] = 1
+    return metro_map
+
+def v2_deep_nesting(n):
+    metro_map = v2_valid(10)
+    metro_map['points_by_color'][COLORS[0]]['xys']['0']['0'] = deeply_nested(n)
+    return metro_map
+
+def v3_valid(n):
+    metro_map = {
+        'global': {'data_version': 3, 'lines': {color: {'displayName': f'{color} Line'} for color in COLORS}},
+        'points_by_color': {},
+        'stations': {},
+    }
+    for index, (x, y) in enumerate(grid_points(n)):
+        color = COLORS[index % len(COLORS)]
+        width_style = '1-solid' if index % 2 else '0.5-dashed'
+        metro_map['points_by_color'].setdefault(color, {}).setdefault(width_style, {}).setdefault(x, {})[y] = 1
+        if index % 10 == 0:
+            metro_map['stations'].setdefault(x, {})[y] = {'name': f'Station_{index}'}
+    return metro_map
+
+def v3_nondigit_keys(n):
+    metro_map = v3_valid(10)
+    points = metro_map['points_by_color'][COLORS[0]]['0.5-dashed']
+    for index in range(n):
+        points[f'x{index}'] = {f'y{index}': 1}
+    return metro_map
+
+def v3_huge_station_names(n):
+    metro_map = v3_valid(n)
+    for color in metro_map['points_by_color']:
+        for width_style in metro_map['points_by_color'][color]:
+            for x, ys in metro_map['points_by_color'][color][width_style].items():
+                for y in ys:
+                    metro_map['stations'].setdefault(x, {})[y] = {'name': 'A' * 10000}
+    return metro_map
+
+def v3_duplicate_points(n):
+    metro_map = v3_valid(0)
+    for color in COLORS:
+        points = metro_map['points_by_color'].setdefault(color, {}).setdefault('1-solid', {})
+        for x, y in grid_points(n):
+            points.setdefault(x, {})[y] = 1
+    return metro_map
+
+def v3_deep_nesting(n):
+    metro_map = v3_valid(10)
+    metro_map['points_by_color'][COLORS[0]]['0.5-dashed']['0']['0'] = deeply_nested(n)
+    return metro_map
+
+
+VALIDATORS = {
+    'v1': validate_metro_map,
+    'v2': validate_metro_map_v2,
+    'v3': validate_metro_map_v3,
+}
+
+PAYLOADS = {
+    'v1': {
+        'valid': v1_valid,
+        'nondigit_keys': v1_nondigit_keys,
+        'huge_station_names': v1_huge_station_names,
+        'deep_nesting': v1_deep_nesting,
+    },
+    'v2': {
+        'valid': v2_valid,
+        'nondigit_keys': v2_nondigit_keys,
+        'huge_station_names': v2_huge_station_names,
+        'duplicate_points': v2_duplicate_points,
+        'deep_nesting': v2_deep_nesting,
+    },
+    'v3': {
+        'valid': v3_valid,
+        'nondigit_keys': v3_nondigit_keys,
+        'huge_station_names': v3_huge_station_names,
+        'duplicate_points': v3_duplicate_points,
+        'deep_nesting': v3_deep_nesting,
+    },
+}
+
+
+def measure(validator, metro_map, runs):
+
+    """ Returns (seconds per validation, peak bytes allocated, outcome)
+
+        The validators modify the map they're given, so each run gets its own copy,
+            made before the clock starts -- through JSON, the same way a saved map arrives.
+    """
+
+    serialized = json.dumps(metro_map)
+    copies = [json.loads(serialized) for _ in range(runs + 1)]
+
+    outcome = 'ok'
+    t0 = time.perf_counter()
+    for metro_map_copy in copies[:runs]:
+        try:
+            validator(metro_map_copy)
+        except Exception as exc:
+            outcome = f'rejected ({type(exc).__name__})'
+    elapsed = (time.perf_counter() - t0) / runs
+
+    tracemalloc.start()
+    try:
+        validator(copies[-1])
+    except Exception:
+        pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak, outcome
+
+
+def growth_exponent(sizes, timings):
+
+    """ How quickly the cost grows relative to the input:
+            1 is linear, 2 is quadratic.
+        Uses the two largest sizes, where fixed overhead matters least.
+    """
+
+    (n1, t1), (n2, t2) = list(zip(sizes, timings))[-2:]
+    if t1 <= 0 or n2 <= n1:
+        return 0
+    return math.log(t2 / t1) / math.log(n2 / n1)
+
+
+class Command(BaseCommand):
+    help = """
+        Measure how expensive each validator is on large valid maps
+            and on adversarial ones (non-digit keys, huge station names,
+            duplicate points across colors, deep nesting).
+
+        Reports validations/sec and peak memory for each,
+            and flags any input whose cost grows faster than linearly with its size.
+
+        Example: ./manage.py benchmark_validators --sizes 1000 4000 16000 --data-version v3
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            dest='sizes',
+            default=[500, 2000, 8000],
+            help='Generate payloads of these sizes (points, keys, or deeply nested branches). Needs at least two to estimate growth.',
+        )
+        parser.add_argument(
+            '-r',
+            '--runs',
+            type=int,
+            dest='runs',
+            default=5,
+            help='Validate each payload this many times and report the average.',
+        )
+        parser.add_argument(
+            '--data-version',
+            type=str,
+            dest='versions',
+            action='append',
+            choices=list(VALIDATORS),
+            help='Only benchmark this validator; can be repeated. Defaults to all.',
+        )
+        parser.add_argument(
+            '--exponent',
+            type=float,
+            dest='exponent',
+            default=SUPERLINEAR_EXPONENT,
+            help='Flag payloads whose cost grows faster than size ** exponent.',
+        )
+
+    def handle(self, *args, **kwargs):
+        sizes = sorted(set(kwargs['sizes']))
+        runs = kwargs['runs']
+        versions = kwargs['versions'] or list(VALIDATORS)
+
+        if len(sizes) < 2:
+            raise CommandError('Need at least two --sizes to estimate how cost grows')
+        if runs < 1:
+            raise CommandError('--runs must be at least 1')
+
+        # The validators log every skipped point and station; that's useful in production
+        #   but would drown out the report here
+        logging.getLogger('map_saver.validator').setLevel(logging.CRITICAL)
+
+        flagged = []
+        self.stdout.write(f'{"validator":<10} {"payload":<20} {"size":>7} {"ops/sec":>10} {"ms/op":>10} {"peak KiB":>10}  outcome')
+        for version in versions:
+            validator = VALIDATORS[version]
+            for name, build in PAYLOADS[version].items():
+                timings = []
+                for size in sizes:
+                    elapsed, peak, outcome = measure(validator, build(size), runs)
+                    timings.append(elapsed)
+                    ops = (1 / elapsed) if elapsed else float('inf')
+                    self.stdout.write(f'{version:<10} {name:<20} {size:>7} {ops:>10.1f} {elapsed * 1000:>10.2f} {peak / 1024:>10.1f}  {outcome}')
+
+                exponent = growth_exponent(sizes, timings)
+                if exponent > kwargs['exponent']:
+                    flagged.append((version, name, exponent))
+
+        if flagged:
+            self.stdout.write('')
+            self.stdout.write('[WARN] Cost grows faster than linearly for:')
+            for version, name, exponent in flagged:
+                self.stdout.write(f'\t{version} {name}: cost ~ size ** {exponent:.2f}')
+        else:
+            self.stdout.write('\nNo superlinear payloads found.')
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from map_saver.thumbnail_bundles import BUNDLE_TAGS, build_bundle, dirty_bundles
+
+import time
+
+
+class Command(BaseCommand):
+    help = """
+        Run on a regular schedule to rebuild the public gallery's thumbnail bundles
+            (one SVG sprite per tag; see map_saver.thumbnail_bundles)
+            that admin actions have marked dirty, or that haven't been built yet.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-t',
+            '--tag',
+            action='append',
+            dest='tags',
+            default=[],
+            help=f'Rebuild this tag\'s bundle, dirty or not. Can be used more than once. One of: {", ".join(BUNDLE_TAGS)}',
+        )
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            dest='all',
+            default=False,
+            help='Rebuild every bundle, dirty or not.',
+        )
+
+    def handle(self, *args, **kwargs):
+        for tag in kwargs['tags']:
+            if tag not in BUNDLE_TAGS:
+                raise CommandError(f'{tag} is not bundled; choose from {", ".join(BUNDLE_TAGS)}')
+
+        if kwargs['all']:
+            tags = BUNDLE_TAGS
+        elif kwargs['tags']:
+            tags = kwargs['tags']
+        else:
+            tags = dirty_bundles()
+
+        if not tags:
+            self.stdout.write('No bundles need rebuilding.')
+            return
+
+        for tag in tags:
+            t0 = time.time()
+            count = build_bundle(tag)
+            t1 = time.time()
+            self.stdout.write(f'Bundled {count} thumbnails tagged {tag} in {(t1 - t0):.2f}s')
@@ -0,0 +1,73 @@
+from django.core.management.base import BaseCommand, CommandError
+from map_saver.families import cluster_map
+from map_saver.models import MapFamily, SavedMap
+
+import time
+
+
+class Command(BaseCommand):
+    help = """
+        Run on a regular schedule to group maps that aren't in a MapFamily yet
+            with the earlier versions of themselves (see map_saver.families).
+
+        Relies on the MinHash index to find similar maps; run ./manage.py index_maps --index minhash first
+            for maps saved before it existed.
+
+        Maps are read in keyset-paginated chunks (pk > last seen), oldest first.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-s',
+            '--start',
+            type=int,
+            dest='start',
+            default=0,
+            help='Cluster maps with a PK greater than this value.',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            dest='chunk_size',
+            default=1000,
+            help='Read this many maps from the database at a time.',
+        )
+        parser.add_argument(
+            '--rebuild',
+            action='store_true',
+            dest='rebuild',
+            default=False,
+            help='Delete every family and cluster all of the maps again.',
+        )
+
+    def handle(self, *args, **kwargs):
+        chunk_size = kwargs['chunk_size']
+        if chunk_size < 1:
+            raise CommandError('--chunk-size must be at least 1')
+
+        if kwargs['rebuild']:
+            MapFamily.objects.all().delete()
+            self.stdout.write('Deleted every family.')
+
+        maps_to_cluster = SavedMap.objects.filter(family_membership__isnull=True) \
+            .only('pk', 'created_at', 'stations', 'stations_minhash') \
+            .order_by('pk')
+
+        t0 = time.time()
+        last_pk = kwargs['start']
+        clustered = joined = 0
+
+        while True:
+            chunk = list(maps_to_cluster.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+
+            for saved_map in chunk:
+                if cluster_map(saved_map):
+                    joined += 1
+                clustered += 1
+            last_pk = chunk[-1].pk
+            self.stdout.write(f'Clustered through #{last_pk}')
+
+        t1 = time.time()
+        self.stdout.write(f'Clustered {clustered} maps ({joined} joined an existing family) in {(t1 - t0):.2f}s; last PK #{last_pk}')
@@ -0,0 +1,245 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from map_saver.caching import bump_map_card_version, forget_urlhash
+from map_saver.models import SavedMap
+
+import json
+import os
+import time
+
+DEFAULT_CHECKPOINT = 'convert_to_v3.checkpoint'
+
+
+def points_and_stations(mapdata):
+
+    """ Returns the set of (color, x, y) points and the {(x, y): name} stations
+            of a map in any data_version, so a conversion can be checked
+            for what it would add or drop regardless of the format
+    """
+
+    data_version = mapdata.get('global', {}).get('data_version', 1)
+    points = set()
+    stations = {}
+
+    if data_version == 1:
+        for x in mapdata:
+            if x == 'global' or not isinstance(mapdata[x], dict):
+                continue
+            for y in mapdata[x]:
+                if not isinstance(mapdata[x][y], dict) or not mapdata[x][y].get('line'):
+                    continue
+                points.add((mapdata[x][y]['line'], x, y))
+                if mapdata[x][y].get('station'):
+                    stations[(x, y)] = mapdata[x][y]['station'].get('name', '')
+        return points, stations
+
+    for color in mapdata.get('points_by_color', {}):
+        if data_version == 2:
+            by_width_style = {'xys': mapdata['points_by_color'][color].get('xys', {})}
+        else:
+            by_width_style = mapdata['points_by_color'][color]
+        for xys in by_width_style.values():
+            for x in xys:
+                for y in xys[x]:
+                    points.add((color, x, y))
+
+    for x in mapdata.get('stations', {}):
+        for y in mapdata['stations'][x]:
+            stations[(x, y)] = mapdata['stations'][x][y].get('name', '')
+
+    return points, stations
+
+
+class Command(BaseCommand):
+    help = """
+        Convert v1 and v2 maps directly to data_version 3.
+
+        Maps are read in keyset-paginated chunks (pk > last seen),
+            each streamed with .iterator(), and written back with bulk_update,
+            so memory use stays flat no matter how many maps there are.
+
+        The last pk written is saved to a checkpoint file after every batch;
+            use --resume to pick up where an interrupted run left off.
+
+        Use --dry-run to see what each conversion would add or drop without saving anything.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-s',
+            '--start',
+            type=int,
+            dest='start',
+            default=0,
+            help='Convert maps with a PK greater than this value.',
+        )
+        parser.add_argument(
+            '-l',
+            '--limit',
+            type=int,
+            dest='limit',
+            default=0,
+            help='Stop after converting this many maps. Defaults to all of them.',
+        )
+        parser.add_argument(
+            '-u',
+            '--urlhash',
+            type=str,
+            dest='urlhash',
+            default=False,
+            help='Convert only this map.',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            dest='chunk_size',
+            default=500,
+            help='Read this many maps from the database at a time.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            dest='batch_size',
+            default=100,
+            help='Write this many converted maps per bulk_update.',
+        )
+        parser.add_argument(
+            '--checkpoint',
+            type=str,
+            dest='checkpoint',
+            default=DEFAULT_CHECKPOINT,
+            help='File to record the last converted PK in.',
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            dest='resume',
+            default=False,
+            help='Start after the PK recorded in the checkpoint file.',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='Show what each conversion would change; do not save anything.',
+        )
+
+    def read_checkpoint(self, path):
+        try:
+            with open(path) as checkpoint:
+                return int(checkpoint.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+        except ValueError:
+            raise CommandError(f'Checkpoint file {path} does not contain a PK')
+
+    def write_checkpoint(self, path, pk):
+        with open(f'{path}.tmp', 'w') as checkpoint:
+            checkpoint.write(str(pk))
+        os.replace(f'{path}.tmp', path)
+
+    def show_diff(self, saved_map, mapdata, mapdata_v3):
+        points_before, stations_before = points_and_stations(mapdata)
+        points_after, stations_after = points_and_stations(mapdata_v3)
+
+        dropped_points = points_before - points_after
+        added_points = points_after - points_before
+        dropped_stations = stations_before.keys() - stations_after.keys()
+        renamed_stations = {
+            xy for xy in stations_before.keys() & stations_after.keys()
+            if stations_before[xy] != stations_after[xy]
+        }
+
+        data_version = mapdata.get('global', {}).get('data_version', 1)
+        status = 'OK' if not (dropped_points or added_points or dropped_stations) else 'CHANGED'
+        self.stdout.write(
+            f'[{status}] #{saved_map.pk} {saved_map.urlhash} v{data_version} -> v3: '
+            f'{len(points_before)} -> {len(points_after)} points, '
+            f'{len(stations_before)} -> {len(stations_after)} stations'
+        )
+        for color, x, y in sorted(dropped_points)[:10]:
+            self.stdout.write(f'\t- point {color} at {x},{y}')
+        for color, x, y in sorted(added_points)[:10]:
+            self.stdout.write(f'\t+ point {color} at {x},{y}')
+        for x, y in sorted(dropped_stations)[:10]:
+            self.stdout.write(f'\t- station {stations_before[(x, y)]} at {x},{y}')
+        for x, y in sorted(renamed_stations)[:10]:
+            self.stdout.write(f'\t~ station at {x},{y}: {stations_before[(x, y)]} -> {stations_after[(x, y)]}')
+
+    def handle(self, *args, **kwargs):
+        urlhash = kwargs['urlhash']
+        limit = kwargs['limit']
+        chunk_size = kwargs['chunk_size']
+        batch_size = kwargs['batch_size']
+        checkpoint = kwargs['checkpoint']
+        dry_run = kwargs['dry_run']
+
+        if chunk_size < 1 or batch_size < 1:
+            raise CommandError('--chunk-size and --batch-size must both be at least 1')
+
+        last_pk = kwargs['start']
+        if kwargs['resume']:
+            last_pk = max(last_pk, self.read_checkpoint(checkpoint))
+            self.stdout.write(f'Resuming after #{last_pk}')
+
+        # v1 maps that were never converted have no data at all
+        maps_to_convert = SavedMap.objects.filter(
+            Q(data={}) | Q(data__global__data_version__lt=3)
+        ).only('pk', 'urlhash', 'mapdata', 'data').order_by('pk')
+        if urlhash:
+            maps_to_convert = maps_to_convert.filter(urlhash=urlhash)
+
+        t0 = time.time()
+        converted = skipped = 0
+        batch = []
+
+        while True:
+            # MySQL can't truly stream a cursor (the driver buffers the whole result),
+            #   so page by PK and only stream within each chunk
+            chunk = maps_to_convert.filter(pk__gt=last_pk)[:chunk_size]
+            seen_in_chunk = 0
+            for saved_map in chunk.iterator(chunk_size=chunk_size):
+                seen_in_chunk += 1
+                last_pk = saved_map.pk
+
+                try:
+                    mapdata = saved_map.data or json.loads(saved_map.mapdata)
+                    mapdata_v3 = SavedMap.upgrade_mapdata_to_v3(mapdata)
+                except Exception as exc:
+                    self.stdout.write(f'[WARN] Exception {exc!r} for #{saved_map.pk} {saved_map.urlhash}')
+                    skipped += 1
+                    continue
+
+                if dry_run:
+                    self.show_diff(saved_map, mapdata, mapdata_v3)
+                else:
+                    saved_map.data = mapdata_v3
+                    saved_map.build_payload()
+                    batch.append(saved_map)
+
+                converted += 1
+                if len(batch) >= batch_size:
+                    self.save_batch(batch, checkpoint)
+                    batch = []
+
+                if limit and converted >= limit:
+                    break
+
+            if not seen_in_chunk or (limit and converted >= limit):
+                break
+
+        if batch:
+            self.save_batch(batch, checkpoint)
+
+        t1 = time.time()
+        verb = 'Checked' if dry_run else 'Converted'
+        self.stdout.write(f'{verb} {converted} maps to v3 ({skipped} skipped) in {(t1 - t0):.2f}s; last PK #{last_pk}')
+
+    def save_batch(self, batch, checkpoint):
+        SavedMap.objects.bulk_update(batch, ['data', 'payload_gzip', 'payload_etag'])
+        forget_urlhash(*[saved_map.urlhash for saved_map in batch])
+        # Staff see the data version on each map's card
+        bump_map_card_version(*[saved_map.pk for saved_map in batch])
+        self.write_checkpoint(checkpoint, batch[-1].pk)
+        self.stdout.write(f'Saved v3 data through #{batch[-1].pk}')
@@ -1,5 +1,9 @@
 from django.core.management.base import BaseCommand
 from map_saver.models import SavedMap
+from summary.counters import track_counters
+
+# Each batch is its own transaction, so the counter rows are only locked for one batch at a time
+BATCH_SIZE = 500
 
 class Command(BaseCommand):
     help = """
@@ -9,11 +13,24 @@ class Command(BaseCommand):
     """
 
     def handle(self, *args, **kwargs):
-        needs_stations = SavedMap.objects.filter(station_count=-1)
-        
-        for mmap in needs_stations:
-            mmap.stations = mmap._get_stations()
-            mmap.station_count = mmap._station_count()
-            mmap.save()
+        needs_stations = SavedMap.objects.filter(station_count=-1).order_by('pk')
+
+        last_pk = 0
+        counted = 0
+        while True:
+            batch = needs_stations.filter(pk__gt=last_pk)[:BATCH_SIZE]
+            pks = list(batch.values_list('pk', flat=True))
+            if not pks:
+                break
+
+            # Counting a map's stations moves it into a station count group on the admin dashboard
+            with track_counters(SavedMap.objects.filter(pk__in=pks)):
+                for mmap in SavedMap.objects.filter(pk__in=pks):
+                    mmap.stations = mmap._get_stations()
+                    mmap.station_count = mmap._station_count()
+                    mmap.save()
+
+            counted += len(pks)
+            last_pk = pks[-1]
 
-        self.stdout.write(f'Counted stations for {needs_stations.count()} maps.')
+        self.stdout.write(f'Counted stations for {counted} maps.')
@@ -0,0 +1,133 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from map_saver.models import MapStation, SavedMap
+from map_saver.similarity import index_grid_hash, index_map
+from map_saver.station_index import index_stations
+
+import time
+
+
+def index_minhash(saved_map, reindex):
+
+    """ Returns True if the map's MinHash signature and bands were (re-)written
+    """
+
+    signature = saved_map.update_stations_minhash()
+    if signature is False and not reindex:
+        return False
+    with transaction.atomic():
+        SavedMap.objects.filter(pk=saved_map.pk).update(stations_minhash=saved_map.stations_minhash)
+        index_map(saved_map, signature or None)
+    return True
+
+
+def index_grid(saved_map, reindex):
+
+    """ Returns True if the map's grid hash was (re-)written
+    """
+
+    value = saved_map.update_grid_hash()
+    if value is False and not reindex:
+        return False
+    with transaction.atomic():
+        SavedMap.objects.filter(pk=saved_map.pk).update(grid_hash=saved_map.grid_hash)
+        index_grid_hash(saved_map, saved_map.grid_hash)
+    return True
+
+
+def index_station_names(saved_map, reindex):
+
+    """ Returns True if the map's MapStation rows were (re-)written
+    """
+
+    if not reindex and (not saved_map.stations or MapStation.objects.filter(savedmap=saved_map).exists()):
+        return False
+    with transaction.atomic():
+        index_stations(saved_map)
+    return True
+
+
+# Which index, and which fields each needs to read
+INDEXES = {
+    'minhash': (index_minhash, ('pk', 'stations', 'stations_minhash')),
+    # mapdata is only read for v1 maps that were never converted
+    'grid': (index_grid, ('pk', 'data', 'grid_hash')),
+    'stations': (index_station_names, ('pk', 'stations')),
+}
+
+
+class Command(BaseCommand):
+    help = """
+        Build (or catch up) the indexes used to find similar maps.
+
+        SavedMap.save() keeps them up to date when a map's stations or data change;
+            this is for maps saved before an index existed, or changed without save() (e.g. with .update()),
+            or to rebuild one after changing how it's computed (--reindex).
+
+        --index minhash: the MinHash signature of each map's stations, and its LSH bands (see map_saver.similarity)
+        --index grid: the average hash of where each map's lines are, and its chunks
+        --index stations: each map's station names (see map_saver.station_index)
+
+        Maps are read in keyset-paginated chunks (pk > last seen), so memory use stays flat.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-i',
+            '--index',
+            type=str,
+            dest='index',
+            choices=sorted(INDEXES),
+            default='minhash',
+            help='Which index to build.',
+        )
+        parser.add_argument(
+            '-s',
+            '--start',
+            type=int,
+            dest='start',
+            default=0,
+            help='Index maps with a PK greater than this value.',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            dest='chunk_size',
+            default=1000,
+            help='Read this many maps from the database at a time.',
+        )
+        parser.add_argument(
+            '--reindex',
+            action='store_true',
+            dest='reindex',
+            default=False,
+            help='Rewrite the index for every map, even ones that look up to date.',
+        )
+
+    def handle(self, *args, **kwargs):
+        chunk_size = kwargs['chunk_size']
+        reindex = kwargs['reindex']
+        if chunk_size < 1:
+            raise CommandError('--chunk-size must be at least 1')
+
+        index, fields = INDEXES[kwargs['index']]
+        maps_to_index = SavedMap.objects.only(*fields).order_by('pk')
+
+        t0 = time.time()
+        last_pk = kwargs['start']
+        indexed = seen = 0
+
+        while True:
+            chunk = list(maps_to_index.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+
+            for saved_map in chunk:
+                if index(saved_map, reindex):
+                    indexed += 1
+            seen += len(chunk)
+            last_pk = chunk[-1].pk
+            self.stdout.write(f'Indexed through #{last_pk} ({indexed} of {seen} maps changed)')
+
+        t1 = time.time()
+        self.stdout.write(f'Built the {kwargs["index"]} index for {indexed} of {seen} maps in {(t1 - t0):.2f}s; last PK #{last_pk}')
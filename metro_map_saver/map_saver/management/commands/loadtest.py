@@ -0,0 +1,218 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from concurrent.futures import ThreadPoolExecutor
+
+import json
+import math
+import requests
+import threading
+import time
+import uuid
+
+# The smallest map that will pass validation and be saved, with one station
+DEFAULT_PAYLOAD = {
+    "global": {"data_version": 3, "lines": {"bd1038": {"displayName": "Red Line"}}},
+    "points_by_color": {"bd1038": {"1-solid": {"1": {"1": 1, "2": 1}, "2": {"1": 1}}}},
+    "stations": {"1": {"1": {"name": "Loadtest"}}},
+}
+
+ENDPOINTS = {
+    'wsgi': {
+        'save': '/save/',
+        'load': '/load/{urlhash}',
+    },
+    'asgi': {
+        'save': '/async/save/',
+        'load': '/async/load/{urlhash}',
+    },
+}
+
+
+def percentile(latencies, pct):
+    if not latencies:
+        return 0
+    index = max(0, math.ceil(pct / 100 * len(latencies)) - 1)
+    return latencies[index]
+
+
+class Command(BaseCommand):
+    help = """
+        Compare requests/sec and tail latency of the WSGI save/load endpoints
+            against their async (ASGI) variants.
+
+        Run one server for each, for example:
+            gunicorn metro_map_saver.wsgi -b 127.0.0.1:8000
+            uvicorn metro_map_saver.asgi:application --port 8001
+
+        then:
+            ./manage.py loadtest -u 8RkQTRav --wsgi http://127.0.0.1:8000 --asgi http://127.0.0.1:8001
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--wsgi',
+            type=str,
+            dest='wsgi',
+            default='http://127.0.0.1:8000',
+            help='Base URL of the server running metro_map_saver.wsgi',
+        )
+        parser.add_argument(
+            '--asgi',
+            type=str,
+            dest='asgi',
+            default='http://127.0.0.1:8001',
+            help='Base URL of the server running metro_map_saver.asgi',
+        )
+        parser.add_argument(
+            '-u',
+            '--urlhash',
+            type=str,
+            dest='urlhash',
+            default='',
+            help='Load this map for the load endpoint. If not provided, loads the map saved by the first save.',
+        )
+        parser.add_argument(
+            '-n',
+            '--requests',
+            type=int,
+            dest='requests',
+            default=200,
+            help='Send this many requests to each endpoint.',
+        )
+        parser.add_argument(
+            '-c',
+            '--concurrency',
+            type=int,
+            dest='concurrency',
+            default=20,
+            help='Send this many requests at once.',
+        )
+        parser.add_argument(
+            '--payload',
+            type=str,
+            dest='payload',
+            default='',
+            help='Path to a JSON file of a map to save. Defaults to a tiny one-station map.',
+        )
+        parser.add_argument(
+            '--repeat',
+            action='store_true',
+            dest='repeat',
+            default=False,
+            help='Save the identical payload every time (exercises the repeated-save fast path) instead of a unique map per request.',
+        )
+
+    def get_payloads(self, payload_path, count, repeat):
+
+        """ Each save gets its own station name, so every request
+                goes through validation and a database write
+                unless --repeat is set
+        """
+
+        if payload_path:
+            with open(payload_path) as payload_file:
+                payload = json.load(payload_file)
+        else:
+            payload = DEFAULT_PAYLOAD
+
+        payloads = []
+        for _ in range(count):
+            if repeat:
+                payloads.append(json.dumps(payload))
+                continue
+            unique = json.loads(json.dumps(payload))
+            unique.setdefault('stations', {}).setdefault('1', {})['1'] = {'name': f'Loadtest_{uuid.uuid4().hex[:12]}'}
+            payloads.append(json.dumps(unique))
+        return payloads
+
+    def get_session(self, base_url):
+
+        """ The save endpoints are CSRF-protected like any other POST,
+                so pick up a csrftoken the same way the editor does
+        """
+
+        session = requests.Session()
+        session.get(f'{base_url}/')
+        session.headers.update({
+            'X-CSRFToken': session.cookies.get('csrftoken', ''),
+            'Referer': f'{base_url}/',
+        })
+        return session
+
+    def run(self, base_url, concurrency, requests_to_send):
+
+        """ Returns (sorted latencies in ms, errors, elapsed seconds, responses)
+
+            requests.Session isn't thread-safe, so each worker thread gets its own
+        """
+
+        sessions = threading.local()
+
+        def send(request):
+            if not hasattr(sessions, 'session'):
+                sessions.session = self.get_session(base_url)
+            session = sessions.session
+            method, url, data = request
+            t0 = time.perf_counter()
+            try:
+                if method == 'post':
+                    response = session.post(url, data=data, timeout=30)
+                else:
+                    response = session.get(url, timeout=30)
+            except requests.RequestException:
+                return (time.perf_counter() - t0) * 1000, None
+            return (time.perf_counter() - t0) * 1000, response
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(send, requests_to_send))
+        elapsed = time.perf_counter() - t0
+
+        latencies = sorted(latency for latency, _ in results)
+        responses = [response for _, response in results]
+        errors = sum(
+            1 for response in responses
+            if response is None or response.status_code != 200 or '[ERROR]' in response.text
+        )
+        return latencies, errors, elapsed, responses
+
+    def report(self, server, endpoint, latencies, errors, elapsed):
+        count = len(latencies)
+        self.stdout.write(
+            f'{server:<5} {endpoint:<5} {count:>6} {errors:>6} {count / elapsed:>9.1f} '
+            f'{percentile(latencies, 50):>8.1f} {percentile(latencies, 95):>8.1f} '
+            f'{percentile(latencies, 99):>8.1f} {latencies[-1] if latencies else 0:>8.1f}'
+        )
+
+    def handle(self, *args, **kwargs):
+        count = kwargs['requests']
+        concurrency = kwargs['concurrency']
+        urlhash = kwargs['urlhash']
+
+        if count < 1 or concurrency < 1:
+            raise CommandError('--requests and --concurrency must both be at least 1')
+
+        self.stdout.write(f'{count} requests per endpoint, {concurrency} at a time')
+        self.stdout.write(f'{"":<5} {"":<5} {"reqs":>6} {"errors":>6} {"req/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+
+        for server, endpoints in ENDPOINTS.items():
+            base_url = kwargs[server].rstrip('/')
+
+            payloads = self.get_payloads(kwargs['payload'], count, kwargs['repeat'])
+            latencies, errors, elapsed, responses = self.run(base_url, concurrency, [
+                ('post', f'{base_url}{endpoints["save"]}', {'metroMap': payload})
+                for payload in payloads
+            ])
+            self.report(server, 'save', latencies, errors, elapsed)
+
+            if not urlhash:
+                saved = [r for r in responses if r is not None and r.status_code == 200 and '[ERROR]' not in r.text]
+                if not saved:
+                    raise CommandError(f'No maps were saved on {base_url}; pass --urlhash to test loading')
+                urlhash = saved[0].text.strip().split(',')[0]
+
+            latencies, errors, elapsed, _ = self.run(base_url, concurrency, [
+                ('get', f'{base_url}{endpoints["load"].format(urlhash=urlhash)}', None)
+                for _ in range(count)
+            ])
+            self.report(server, 'load', latencies, errors, elapsed)
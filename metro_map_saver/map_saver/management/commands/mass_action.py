@@ -1,5 +1,7 @@
 from django.core.management.base import BaseCommand
 
+BATCH_SIZE = 500
+
 class Command(BaseCommand):
     help = """
 
@@ -26,6 +28,7 @@ class Command(BaseCommand):
 
     def handle(self, *args, **kwargs):
         from map_saver.models import SavedMap
+        from summary.counters import track_counters
 
         stations = kwargs['stations']
         action = kwargs['action']
@@ -61,15 +64,20 @@ class Command(BaseCommand):
             self.stdout.write("[EARLY-END] Exiting without editing the maps.")
             return
 
-        for saved_map in maps_to_update.order_by('id'):
-            if saved_map.publicly_visible:
-                continue
-            if action == 'hide':
-                saved_map.gallery_visible = False
-            elif action == 'show':
-                saved_map.gallery_visible = True
-            # For logging purposes, the raw ID would let me revert any mistakes the easiest
-            self.stdout.write(str(saved_map.id))
-            saved_map.save()
+        # Each batch is its own transaction, so the counter rows are only locked for one batch at a time
+        pks = list(maps_to_update.order_by('id').values_list('id', flat=True))
+        for start in range(0, len(pks), BATCH_SIZE):
+            batch = SavedMap.objects.filter(pk__in=pks[start:start + BATCH_SIZE])
+            with track_counters(batch):
+                for saved_map in batch.order_by('id'):
+                    if saved_map.publicly_visible:
+                        continue
+                    if action == 'hide':
+                        saved_map.gallery_visible = False
+                    elif action == 'show':
+                        saved_map.gallery_visible = True
+                    # For logging purposes, the raw ID would let me revert any mistakes the easiest
+                    self.stdout.write(str(saved_map.id))
+                    saved_map.save()
         
         self.stdout.write(f"Finished applying {action} to {count} maps.")
@@ -1,17 +1,30 @@
 from django.core.management.base import BaseCommand
 
+from citysuggester.models import TravelSystem
 from citysuggester.utils import (
+    get_systems_index,
     load_systems,
     suggest_city,
+    SystemsIndex,
     MINIMUM_STATION_OVERLAP,
 )
+from map_saver.caching import bump_map_card_version, forget_urlhash
 from map_saver.models import SavedMap
 
 import time
 
+BATCH_SIZE = 500
+
+def city_name(suggestion):
+    # Suggestions are 'name (number of stations)'
+    return suggestion.split("(")[0].strip()
+
 class Command(BaseCommand):
     help = """
         Suggest cities for unnamed maps without suggestions
+
+        With --incremental, re-check maps that were already checked (including the -2s that didn't match anything)
+            against only the TravelSystems added or changed since they were last checked.
     """
 
     def add_arguments(self, parser):
@@ -47,13 +60,23 @@ class Command(BaseCommand):
             default=False,
             help='Suggest cities for only one map in particular.',
         )
-        # TODO: Add a re-check feature to check suggested_city_overlap=-2 (see below)
+        parser.add_argument(
+            '-i',
+            '--incremental',
+            action='store_true',
+            dest='incremental',
+            default=False,
+            help='Re-check already-checked maps against only the TravelSystems that changed since they were last checked.',
+        )
 
     def handle(self, *args, **kwargs):
         urlhash = kwargs['urlhash']
         start = kwargs['start']
         end = kwargs['end']
         limit = kwargs['limit']
+        incremental = kwargs['incremental']
+
+        latest_version = TravelSystem.latest_version()
 
         if urlhash:
             limit = 1
@@ -62,33 +85,84 @@ class Command(BaseCommand):
             start = start or 1
             end = end or (start + limit + 1)
             needs_suggestions = SavedMap.objects.filter(pk__in=range(start, end))
+        elif incremental:
+            # Maps that haven't been checked at all (-1) are for the regular run
+            needs_suggestions = SavedMap.objects.exclude(suggested_city_overlap=-1).filter(suggested_city_version__lt=latest_version)
         else:
             needs_suggestions = SavedMap.objects.filter(suggested_city_overlap=-1)
 
         # Don't bother checking maps that don't have stations (-1, implied by lte MINIMUM),
         #   or those that don't have at least this many stations
         needs_suggestions = needs_suggestions.exclude(station_count__lte=MINIMUM_STATION_OVERLAP)
-        needs_suggestions = needs_suggestions.order_by('id')[:limit]
+        needs_suggestions = needs_suggestions.only(
+            'pk',
+            'urlhash',
+            'created_at',
+            'stations',
+            'suggested_city',
+            'suggested_city_overlap',
+            'suggested_city_version',
+        ).order_by('id')[:limit]
 
         self.stdout.write(f'Checking {needs_suggestions.count()} maps for suggested cities ...')
         t0 = time.time()
 
         # Pre-load the travelsystems to save setup time
-        travel_systems = load_systems()
+        travel_systems = get_systems_index()
+        if incremental:
+            # Only a few distinct versions in practice: one index of changed systems for each
+            changed_systems = {}
+            changed_names = {}
+            current_names = {city_name(name) for name in travel_systems.station_counts}
 
+        batch = []
         for mmap in needs_suggestions:
-            suggested_city = suggest_city(set(mmap.stations.lower().split(',')), systems=travel_systems)
+            map_stations = set(mmap.stations.lower().split(','))
+            systems = travel_systems
+
+            if incremental:
+                version = mmap.suggested_city_version
+                if version not in changed_systems:
+                    changed_systems[version] = SystemsIndex(load_systems(changed_since=version))
+                    changed_names[version] = {city_name(name) for name in changed_systems[version].station_counts}
+
+                # If the system it was matched with has changed (or is gone), any system could be the best match now;
+                #   otherwise, only a changed system could beat it
+                if not mmap.suggested_city or (mmap.suggested_city not in changed_names[version] and mmap.suggested_city in current_names):
+                    systems = changed_systems[version]
+
+            suggested_city = suggest_city(map_stations, systems=systems)
+            if systems is not travel_systems and mmap.suggested_city and (not suggested_city or suggested_city[0][1] <= mmap.suggested_city_overlap):
+                # Still the best match
+                suggested_city = [(mmap.suggested_city, mmap.suggested_city_overlap)]
+
             if suggested_city:
-                mmap.suggested_city = suggested_city[0][0].split("(")[0].strip()
+                mmap.suggested_city = city_name(suggested_city[0][0])
                 mmap.suggested_city_overlap = suggested_city[0][1]
                 self.stdout.write(f'#{mmap.id}: {mmap.urlhash} ({mmap.created_at.date()}) might be {mmap.suggested_city} ({mmap.suggested_city_overlap} stations in common)')
             else:
+                mmap.suggested_city = ''
                 # If I leave it as -1, it'll re-check every time even if I haven't added new TravelSystems.
                 # If I set to 0, I might not realize I should check it again when I've added more TravelSystems.
                 # -2 seems like a good choice to indicate it's not -1, but it's not a plausible result from already checking either.
+                #   (--incremental re-checks these against the TravelSystems added since)
                 mmap.suggested_city_overlap = -2
                 self.stdout.write(f'#{mmap.id}: {mmap.urlhash} ({mmap.created_at.date()}) did not match any cities currently in the system.')
-            mmap.save()
+            mmap.suggested_city_version = latest_version
+
+            batch.append(mmap)
+            if len(batch) >= BATCH_SIZE:
+                self.save_batch(batch)
+                batch = []
+
+        if batch:
+            self.save_batch(batch)
 
         t1 = time.time()
         self.stdout.write(f'Finished in {(t1 - t0):.2f}s')
+
+    def save_batch(self, batch):
+        SavedMap.objects.bulk_update(batch, ['suggested_city', 'suggested_city_overlap', 'suggested_city_version'])
+        forget_urlhash(*[mmap.urlhash for mmap in batch])
+        # Map cards show the suggested city
+        bump_map_card_version(*[mmap.pk for mmap in batch])
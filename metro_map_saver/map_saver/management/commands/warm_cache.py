@@ -0,0 +1,218 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import DisallowedHost
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+from django.urls import reverse
+from django.utils.cache import get_cache_key
+
+from map_saver.models import PUBLICLY_VISIBLE_TAGS
+from summary.models import MapsByDay, MapsByCity
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
+
+import datetime
+import requests
+import threading
+import time
+
+# The site-wide cache varies on Accept-Encoding (gzip_page), using the header exactly as sent,
+#   so each of these gets its own copy of every page
+DEFAULT_ACCEPT_ENCODINGS = [
+    'gzip, deflate, br, zstd',  # Chrome, Edge
+    'gzip, deflate, br',  # Firefox, Safari
+]
+
+
+def pages_to_warm(months=2, alltime=False, cities=10):
+
+    """ Returns the paths of the pages (and the thumbnail fragments the gallery fetches)
+            that are slowest to render cold:
+            the gallery, the calendar for the most recent months, and the city list
+    """
+
+    paths = [reverse('public_gallery')]
+    paths.extend(
+        reverse('thumbnail_tag', kwargs={'tag': tag})
+        for tag in ['favorite', *PUBLICLY_VISIBLE_TAGS]
+    )
+
+    if alltime:
+        month_starts = list(MapsByDay.objects.dates('day', 'month'))
+    else:
+        month_starts = []
+        month_start = datetime.date.today().replace(day=1)
+        for _ in range(months):
+            month_starts.append(month_start)
+            month_start = (month_start - datetime.timedelta(days=1)).replace(day=1)
+
+    paths.append(reverse('calendar'))
+    for year in sorted({month_start.year for month_start in month_starts}, reverse=True):
+        paths.append(reverse('calendar-year', kwargs={'year': year}))
+    for month_start in sorted(month_starts, reverse=True):
+        paths.append(reverse('calendar-month', kwargs={'year': month_start.year, 'month': month_start.month}))
+
+    paths.append(reverse('city-list'))
+    if cities:
+        for maps_by_city in MapsByCity.objects.select_related('city').order_by('-maps')[:cities]:
+            paths.append(reverse('city', kwargs={'city': maps_by_city.city.name}))
+
+    return paths
+
+
+def forget_cached_page(base_url, path, accept_encoding):
+
+    """ Deletes the site-wide cache's copy of this page, so the next request renders it fresh.
+        Returns how many cache entries were deleted.
+    """
+
+    cache = caches[settings.CACHE_MIDDLEWARE_ALIAS]
+    host = urlsplit(base_url).netloc
+    deleted = 0
+    # Depending on the proxy headers, the app may see the request as http or https;
+    #   the scheme is part of the cache key, so forget both
+    for secure in (False, True):
+        request = RequestFactory().get(path, secure=secure, HTTP_HOST=host, HTTP_ACCEPT_ENCODING=accept_encoding)
+        try:
+            cache_key = get_cache_key(request, settings.CACHE_MIDDLEWARE_KEY_PREFIX, 'GET', cache=cache)
+        except DisallowedHost:
+            return deleted
+        if cache_key and cache.delete(cache_key):
+            deleted += 1
+    return deleted
+
+
+class Command(BaseCommand):
+    help = """
+        Pre-render the gallery, thumbnail, calendar and city pages into the cache,
+            so the first visitors after an admin tagging session
+            or the nightly summarize / summarize_city runs don't pay for cold renders.
+
+        Requests the pages from the running site with bounded concurrency
+            and reports how long each one took.
+
+        Use --refresh to first forget the copies already in the cache
+            (otherwise a stale cached page is "warm" already and won't be re-rendered).
+
+        Example: ./manage.py warm_cache --refresh --base-url https://metromapmaker.com
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--base-url',
+            type=str,
+            dest='base_url',
+            default='https://metromapmaker.com',
+            help='Request the pages from this site.',
+        )
+        parser.add_argument(
+            '-c',
+            '--concurrency',
+            type=int,
+            dest='concurrency',
+            default=4,
+            help='Render at most this many pages at once.',
+        )
+        parser.add_argument(
+            '-m',
+            '--months',
+            type=int,
+            dest='months',
+            default=2,
+            help='Warm the calendar for this many of the most recent months.',
+        )
+        parser.add_argument(
+            '-a',
+            '--alltime',
+            action='store_true',
+            dest='alltime',
+            default=False,
+            help='Warm the calendar for every month with maps instead of only the most recent.',
+        )
+        parser.add_argument(
+            '--cities',
+            type=int,
+            dest='cities',
+            default=10,
+            help='Also warm the pages for this many of the cities with the most maps.',
+        )
+        parser.add_argument(
+            '--accept-encoding',
+            type=str,
+            dest='accept_encodings',
+            action='append',
+            help='Warm the copy of each page for this Accept-Encoding header; can be repeated. Defaults to what common browsers send.',
+        )
+        parser.add_argument(
+            '--refresh',
+            action='store_true',
+            dest='refresh',
+            default=False,
+            help='Forget the cached copy of each page before requesting it.',
+        )
+        parser.add_argument(
+            '--timeout',
+            type=int,
+            dest='timeout',
+            default=60,
+            help='Give up on a page after this many seconds.',
+        )
+
+    def handle(self, *args, **kwargs):
+        base_url = kwargs['base_url'].rstrip('/')
+        concurrency = kwargs['concurrency']
+        timeout = kwargs['timeout']
+        accept_encodings = kwargs['accept_encodings'] or DEFAULT_ACCEPT_ENCODINGS
+
+        if concurrency < 1:
+            raise CommandError('--concurrency must be at least 1')
+
+        paths = pages_to_warm(kwargs['months'], kwargs['alltime'], kwargs['cities'])
+        to_warm = [(path, accept_encoding) for path in paths for accept_encoding in accept_encodings]
+
+        if kwargs['refresh']:
+            forgotten = sum(
+                forget_cached_page(base_url, path, accept_encoding)
+                for path, accept_encoding in to_warm
+            )
+            self.stdout.write(f'Forgot {forgotten} cached pages')
+
+        self.stdout.write(f'Warming {len(paths)} pages x {len(accept_encodings)} encodings at {base_url} with concurrency {concurrency}')
+
+        # requests.Session isn't thread-safe, so each worker thread gets its own
+        sessions = threading.local()
+
+        def warm(path, accept_encoding):
+            if not hasattr(sessions, 'session'):
+                sessions.session = requests.Session()
+            t0 = time.perf_counter()
+            try:
+                response = sessions.session.get(
+                    f'{base_url}{path}',
+                    headers={'Accept-Encoding': accept_encoding},
+                    timeout=timeout,
+                )
+                status = response.status_code
+            except requests.RequestException as exc:
+                status = type(exc).__name__
+            return path, accept_encoding, status, time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        timings = []
+        failed = []
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(warm, path, accept_encoding) for path, accept_encoding in to_warm]
+            for future in as_completed(futures):
+                path, accept_encoding, status, elapsed = future.result()
+                timings.append((elapsed, path, accept_encoding))
+                self.stdout.write(f'{status}\t{elapsed:>7.2f}s\t{path}\t({accept_encoding})')
+                if status != 200:
+                    failed.append(path)
+
+        self.stdout.write(f'\nWarmed {len(to_warm) - len(failed)} of {len(to_warm)} pages in {(time.perf_counter() - t0):.2f}s')
+        self.stdout.write('Slowest:')
+        for elapsed, path, accept_encoding in sorted(timings, reverse=True)[:5]:
+            self.stdout.write(f'\t{elapsed:>7.2f}s\t{path}\t({accept_encoding})')
+        if failed:
+            self.stdout.write(f'[WARN] Failed to warm: {", ".join(sorted(set(failed)))}')
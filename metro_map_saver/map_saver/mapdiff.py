@@ -0,0 +1,171 @@
+""" What changed between two maps, by structure rather than by text:
+        the points added and removed for each line color and width-style,
+        lines whose name / width / style changed,
+        and the stations added, removed, renamed, moved or restyled.
+
+    Both maps are compared as v3 data (older maps are upgraded first, see SavedMap.upgrade_mapdata_to_v3),
+        with set operations, so it takes time linear in the size of the maps.
+"""
+
+from django.template import Context, Template
+
+from .validator import ALLOWED_MAP_SIZES
+
+import json
+
+OVERLAY_TEMPLATE = Template('''
+<svg version="1.1" xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {{ canvas_size }} {{ canvas_size }}" class="diff-overlay">
+{% spaceless %}
+    <style>rect { stroke-width: 0.1; } .added { fill: #28a745; fill-opacity: 0.5; stroke: #28a745; } .removed { fill: #dc3545; fill-opacity: 0.5; stroke: #dc3545; } .station { fill: none; stroke: #ffc107; stroke-width: 0.3; }</style>
+    {% for x, y in removed %}<rect class="removed" x="{{ x }}" y="{{ y }}" width="1" height="1"/>{% endfor %}
+    {% for x, y in added %}<rect class="added" x="{{ x }}" y="{{ y }}" width="1" height="1"/>{% endfor %}
+    {% for x, y in stations %}<rect class="station" x="{{ x }}" y="{{ y }}" width="1.5" height="1.5"/>{% endfor %}
+{% endspaceless %}
+</svg>
+''')
+
+
+def map_data_v3(saved_map):
+
+    """ Returns this map's data as v3, whatever version it was saved as
+    """
+
+    from .models import SavedMap
+
+    mapdata = saved_map.data or json.loads(saved_map.mapdata)
+    return SavedMap.upgrade_mapdata_to_v3(mapdata)
+
+
+def points_by_line(data):
+
+    """ Returns {(color, width_style): {(x, y), ...}}
+    """
+
+    points = {}
+    for color, width_styles in data.get('points_by_color', {}).items():
+        for width_style, xys in width_styles.items():
+            points[(color, width_style)] = {
+                (int(x), int(y))
+                for x in xys
+                for y in xys[x]
+            }
+    return points
+
+
+def stations_by_xy(data):
+    return {
+        (int(x), int(y)): station
+        for x in data.get('stations', {})
+        for y, station in data['stations'][x].items()
+    }
+
+
+def diff_maps(before, after):
+
+    """ Returns the structural differences between two maps' v3 data
+    """
+
+    points_before = points_by_line(before)
+    points_after = points_by_line(after)
+    points = []
+    for color, width_style in sorted(points_before.keys() | points_after.keys()):
+        these = points_before.get((color, width_style), set())
+        those = points_after.get((color, width_style), set())
+        added = those - these
+        removed = these - those
+        if added or removed:
+            points.append({
+                'color': color,
+                'width_style': width_style,
+                'added': sorted(added),
+                'removed': sorted(removed),
+            })
+
+    lines_before = before.get('global', {}).get('lines', {})
+    lines_after = after.get('global', {}).get('lines', {})
+    lines = [
+        {
+            'color': color,
+            'before': lines_before.get(color),
+            'after': lines_after.get(color),
+        }
+        for color in sorted(lines_before.keys() | lines_after.keys())
+        if lines_before.get(color) != lines_after.get(color)
+    ]
+
+    stations_before = stations_by_xy(before)
+    stations_after = stations_by_xy(after)
+    removed = {xy: stations_before[xy] for xy in stations_before.keys() - stations_after.keys()}
+    added = {xy: stations_after[xy] for xy in stations_after.keys() - stations_before.keys()}
+
+    # A station removed from one place and added with the same name elsewhere was moved
+    removed_by_name = {}
+    for xy, station in removed.items():
+        removed_by_name.setdefault(station.get('name', ''), []).append(xy)
+    moved = []
+    for xy, station in sorted(added.items()):
+        same_name = removed_by_name.get(station.get('name', ''))
+        if same_name:
+            from_xy = same_name.pop()
+            moved.append({'name': station.get('name', ''), 'from': from_xy, 'to': xy})
+            del removed[from_xy]
+    for move in moved:
+        del added[move['to']]
+
+    renamed = []
+    restyled = []
+    for xy in sorted(stations_before.keys() & stations_after.keys()):
+        this, that = stations_before[xy], stations_after[xy]
+        if this.get('name', '') != that.get('name', ''):
+            renamed.append({'xy': xy, 'before': this.get('name', ''), 'after': that.get('name', '')})
+        elif this != that:
+            restyled.append({'xy': xy, 'name': this.get('name', ''), 'before': this, 'after': that})
+
+    return {
+        'points': points,
+        'lines': lines,
+        'stations': {
+            'added': [{'xy': xy, 'name': station.get('name', '')} for xy, station in sorted(added.items())],
+            'removed': [{'xy': xy, 'name': station.get('name', '')} for xy, station in sorted(removed.items())],
+            'moved': moved,
+            'renamed': renamed,
+            'restyled': restyled,
+        },
+        'style': {
+            'before': before.get('global', {}).get('style', {}),
+            'after': after.get('global', {}).get('style', {}),
+        } if before.get('global', {}).get('style', {}) != after.get('global', {}).get('style', {}) else None,
+    }
+
+
+def has_changes(diff):
+    return bool(diff['points'] or diff['lines'] or diff['style'] or any(diff['stations'].values()))
+
+
+def diff_overlay_svg(diff, map_size=None):
+
+    """ Returns an SVG (on the same grid as the map's own SVG) marking
+            the cells where points were added (green) or removed (red)
+            and where stations changed (outlined)
+    """
+
+    added = {xy for line in diff['points'] for xy in line['added']}
+    removed = {xy for line in diff['points'] for xy in line['removed']}
+    stations = {station['xy'] for change in ('added', 'removed', 'renamed', 'restyled') for station in diff['stations'][change]}
+    stations |= {move['from'] for move in diff['stations']['moved']} | {move['to'] for move in diff['stations']['moved']}
+
+    if not map_size:
+        # The smallest map size every change fits in
+        highest = max((max(xy) for xy in added | removed | stations), default=0)
+        map_size = next((size for size in ALLOWED_MAP_SIZES if size > highest), ALLOWED_MAP_SIZES[-1])
+
+    def corners(cells, size):
+        # Points are drawn centered on their coordinates
+        return [(x - size / 2, y - size / 2) for x, y in sorted(cells)]
+
+    return OVERLAY_TEMPLATE.render(Context({
+        'canvas_size': map_size,
+        'added': corners(added, 1),
+        'removed': corners(removed - added, 1),
+        'stations': corners(stations, 1.5),
+    })).strip()
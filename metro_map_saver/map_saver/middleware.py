@@ -0,0 +1,14 @@
+from django.middleware.http import ConditionalGetMiddleware
+
+
+class CachedETagMiddleware(ConditionalGetMiddleware):
+
+    """ Answers If-None-Match with a 304 for responses that already carry an ETag
+            (stored map payloads), including the ones FetchFromCacheMiddleware
+            replays from the site cache before condition() on the view ever runs.
+
+        Unlike ConditionalGetMiddleware, it never hashes a page to make up an ETag for it.
+    """
+
+    def needs_etag(self, response):
+        return False
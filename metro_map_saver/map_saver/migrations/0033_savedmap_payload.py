@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-19 18:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_saver', '0032_city_map_saver_c_name_f3a223_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='savedmap',
+            name='payload_etag',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='savedmap',
+            name='payload_gzip',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
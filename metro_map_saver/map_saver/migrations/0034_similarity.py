@@ -0,0 +1,31 @@
+# Generated by Django 5.1.2 on 2026-10-19 18:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_saver', '0033_savedmap_payload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='savedmap',
+            name='stations_minhash',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='MapSimilarityBand',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('band', models.SmallIntegerField()),
+                ('bucket', models.BigIntegerField()),
+                ('savedmap', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='map_saver.savedmap')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['band', 'bucket'], name='map_saver_m_band_cf89a4_idx')],
+            },
+        ),
+    ]
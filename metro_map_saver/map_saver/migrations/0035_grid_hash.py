@@ -0,0 +1,33 @@
+# Generated by Django 5.1.2 on 2026-10-19 18:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_saver', '0034_similarity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='savedmap',
+            name='grid_hash',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='MapGridHash',
+            fields=[
+                ('savedmap', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='map_saver.savedmap')),
+                ('grid_hash', models.BigIntegerField()),
+                ('chunk0', models.PositiveIntegerField()),
+                ('chunk1', models.PositiveIntegerField()),
+                ('chunk2', models.PositiveIntegerField()),
+                ('chunk3', models.PositiveIntegerField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['chunk0'], name='map_saver_m_chunk0_25ee8a_idx'), models.Index(fields=['chunk1'], name='map_saver_m_chunk1_8e9602_idx'), models.Index(fields=['chunk2'], name='map_saver_m_chunk2_f247d2_idx'), models.Index(fields=['chunk3'], name='map_saver_m_chunk3_d67122_idx')],
+            },
+        ),
+    ]
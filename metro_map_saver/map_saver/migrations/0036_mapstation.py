@@ -0,0 +1,25 @@
+# Generated by Django 5.1.2 on 2026-10-19 18:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_saver', '0035_grid_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MapStation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('savedmap', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='map_saver.savedmap')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['name'], name='map_saver_m_name_c656e2_idx')],
+            },
+        ),
+    ]
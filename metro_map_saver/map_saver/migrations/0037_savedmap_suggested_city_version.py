@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-19 18:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_saver', '0036_mapstation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='savedmap',
+            name='suggested_city_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.2 on 2026-10-19 18:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('map_saver', '0037_savedmap_suggested_city_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MapFamily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.PositiveIntegerField(default=1)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('latest', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='map_saver.savedmap')),
+            ],
+            options={
+                'verbose_name_plural': 'map families',
+            },
+        ),
+        migrations.CreateModel(
+            name='MapFamilyMember',
+            fields=[
+                ('savedmap', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='family_membership', serialize=False, to='map_saver.savedmap')),
+                ('similarity', models.FloatField(default=1)),
+                ('family', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='members', to='map_saver.mapfamily')),
+            ],
+        ),
+    ]
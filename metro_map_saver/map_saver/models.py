@@ -1,12 +1,26 @@
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.core.files.images import ImageFile
-from django.db import models
+from django.db import models, transaction
+from django.template.loader import render_to_string
 
 from citysuggester.utils import suggest_city
+from summary.counters import count_new_map, track_counters
+from .caching import bump_map_card_version, forget_random_public_pool, forget_urlhash
+from .families import refresh_families
+from .similarity import (
+    index_grid_hash,
+    index_map,
+    mapdata_grid_hash,
+    minhash,
+    station_set,
+)
+from .station_index import index_stations
 from taggit.managers import TaggableManager
 
 import datetime
+import gzip
+import hashlib
 import json
 import subprocess
 import time
@@ -85,9 +99,24 @@ class SavedMap(models.Model):
     #   (though I don't re-name TravelSystems often)
     suggested_city = models.CharField(max_length=255, blank=True, default='', help_text='Suggested name for this map based on station name overlap with real, existing Metro systems.')
     suggested_city_overlap = models.IntegerField(default=-1)
+    # The latest TravelSystem.version this map's suggested_city was checked against
+    suggested_city_version = models.PositiveIntegerField(default=0)
 
     map_size = models.IntegerField(default=-1)
 
+    # Maps never change once saved, so the load endpoint's response body
+    #   is rendered and gzipped once (see build_payload) and served as-is from then on.
+    # payload_etag is the sha256 of the uncompressed body.
+    payload_gzip = models.BinaryField(null=True, blank=True, editable=False)
+    payload_etag = models.CharField(max_length=64, blank=True, default='')
+
+    # MinHash of the station names, for finding maps with nearly the same stations;
+    #   see map_saver.similarity and MapSimilarityBand
+    stations_minhash = models.BinaryField(null=True, blank=True, editable=False)
+    # Average hash of where the lines are, for finding maps that look alike
+    #   even with different (or no) station names; see MapGridHash
+    grid_hash = models.BigIntegerField(null=True, blank=True, editable=False)
+
     city = models.ForeignKey(
         'City',
         null=True,
@@ -165,6 +194,69 @@ class SavedMap(models.Model):
 
         return stations
 
+    @staticmethod
+    def get_map_details(mapdata, urlhash, naming_token, data_version):
+
+        """ Returns the fields needed to create a SavedMap
+                from a validated mapdata (see CreateMapForm)
+        """
+
+        from citysuggester.utils import MINIMUM_STATION_OVERLAP
+
+        stations = SavedMap.get_stations(mapdata, data_version)
+        map_details = {
+            'urlhash': urlhash,
+            'naming_token': naming_token,
+            'station_count': len(stations),
+            'stations': ','.join(stations),
+            'map_size': mapdata.get('global', {}).get('map_size', -1) or -1,
+        }
+        if data_version >= 2:
+            map_details['data'] = mapdata
+        else:
+            map_details['mapdata'] = json.dumps(mapdata)
+
+        if len(stations) < MINIMUM_STATION_OVERLAP:
+            # Don't need to check these ever
+            map_details['suggested_city_overlap'] = -2
+
+        return map_details
+
+    def get_payload(self):
+
+        """ Returns the mapdata served by the load endpoints
+        """
+
+        if self.data:
+            return json.dumps(self.data)
+        elif self.mapdata:
+            return self.mapdata
+        return {}
+
+    def build_payload(self):
+
+        """ Render the load endpoint's response body for this map
+                and store it gzipped, along with its ETag
+        """
+
+        body = render_to_string('MapDataView.html', {'saved_map': self.get_payload()}).encode('utf-8')
+        # mtime=0 so the same map always compresses to the same bytes
+        self.payload_gzip = gzip.compress(body, mtime=0)
+        self.payload_etag = hashlib.sha256(body).hexdigest()
+
+    def save_payload(self):
+
+        """ Build the payload for a map saved before payloads were stored
+                (or whose data was since converted), without touching any other field
+        """
+
+        self.build_payload()
+        SavedMap.objects.filter(pk=self.pk).update(
+            payload_gzip=self.payload_gzip,
+            payload_etag=self.payload_etag,
+        )
+        forget_urlhash(self.urlhash)
+
     def convert_mapdata_v1_to_v2(self):
 
         """ Convert mapdata (classic) from v1 to v2
@@ -202,8 +294,74 @@ class SavedMap(models.Model):
             mapdata_v2['stations'][index].pop('lines', None)
 
         self.data = self.data_optimized_for_js_performance(mapdata_v2)
+        self.build_payload()
         self.save()
 
+    @staticmethod
+    def upgrade_mapdata_to_v3(mapdata):
+
+        """ Convert v1 (classic mapdata) or v2 (data) straight to v3,
+                the same way the editor's upgradeMapDataVersion() does:
+                every line is drawn in the map's global line width and style.
+
+            Returns the v3 data as validate_metro_map_v3 would save it;
+                v3 data is returned as-is.
+        """
+
+        from .validator import (
+            ALLOWED_LINE_STYLES,
+            ALLOWED_LINE_WIDTHS,
+            validate_metro_map_v3,
+        )
+
+        data_version = mapdata.get('global', {}).get('data_version', 1)
+        if data_version >= 3:
+            return mapdata
+
+        style = dict(mapdata['global'].get('style') or {})
+        line_width = style.get('mapLineWidth', ALLOWED_LINE_WIDTHS[0])
+        # Normalize 1.0 to 1 so the width-style matches ALLOWED_LINE_WIDTH_STYLES
+        if line_width in ALLOWED_LINE_WIDTHS:
+            line_width = ALLOWED_LINE_WIDTHS[ALLOWED_LINE_WIDTHS.index(line_width)]
+        else:
+            line_width = ALLOWED_LINE_WIDTHS[0]
+        line_style = style.get('mapLineStyle', ALLOWED_LINE_STYLES[0])
+        if line_style not in ALLOWED_LINE_STYLES:
+            line_style = ALLOWED_LINE_STYLES[0]
+        style['mapLineWidth'] = line_width
+        style['mapLineStyle'] = line_style
+        width_style = f'{line_width}-{line_style}'
+
+        points_by_color = {}
+        stations = {}
+        if data_version == 1:
+            for x in mapdata:
+                if x == 'global' or not isinstance(mapdata[x], dict):
+                    continue
+                for y in mapdata[x]:
+                    if not isinstance(mapdata[x][y], dict):
+                        continue
+                    color = mapdata[x][y].get('line')
+                    if not color:
+                        continue
+                    points_by_color.setdefault(color, {}).setdefault(width_style, {}).setdefault(x, {})[y] = 1
+                    station = mapdata[x][y].get('station')
+                    if station:
+                        stations.setdefault(x, {})[y] = station
+        else:
+            for color in mapdata.get('points_by_color', {}):
+                points_by_color[color] = {width_style: mapdata['points_by_color'][color].get('xys', {})}
+            stations = mapdata.get('stations', {})
+
+        return validate_metro_map_v3({
+            'global': {
+                'lines': mapdata['global'].get('lines', {}),
+                'style': style,
+            },
+            'points_by_color': points_by_color,
+            'stations': stations,
+        })
+
     def data_optimized_for_js_performance(self, mapdata_v2):
 
         """ sort_points_by_color is a good midway point between being optimized for
@@ -324,6 +482,11 @@ class SavedMap(models.Model):
         self.png = png_filename.removeprefix(settings.MEDIA_ROOT)
         self.save()
 
+        if self.publicly_visible:
+            # This thumbnail's symbol in its tags' bundles is out of date
+            from .thumbnail_bundles import mark_bundles_dirty
+            mark_bundles_dirty(*self.tags.slugs())
+
         t2 = time.time()
 
         # These report the same time, but the station generation is negligible
@@ -333,19 +496,141 @@ class SavedMap(models.Model):
         output += f'\n\tWrote PNG thumbnail and file from SVG in {(t2 - t1):.2f}s.'
         return output
 
+    def update_stations_minhash(self):
+
+        """ Recomputes stations_minhash from the stations;
+                returns the new signature if it changed (so the map needs re-indexing),
+                or False if it didn't (or the stations weren't loaded)
+        """
+
+        if 'stations' in self.get_deferred_fields() or 'stations_minhash' in self.get_deferred_fields():
+            return False
+        signature = minhash(station_set(self.stations))
+        previous = bytes(self.stations_minhash) if self.stations_minhash else None
+        if signature == previous:
+            return False
+        self.stations_minhash = signature
+        return signature
+
+    def update_grid_hash(self):
+
+        """ Recomputes grid_hash from the map data;
+                returns the new hash if it changed (so the map needs re-indexing),
+                or False if it didn't (or the data wasn't loaded)
+        """
+
+        if 'data' in self.get_deferred_fields() or 'grid_hash' in self.get_deferred_fields():
+            return False
+        value = mapdata_grid_hash(self.data, None if self.data else self.mapdata)
+        if value == self.grid_hash:
+            return False
+        self.grid_hash = value
+        return value
+
+    def update_indexes(self, signature, grid):
+        if signature is not False:
+            # stations_minhash only changes when the set of stations does
+            index_map(self, signature)
+            index_stations(self)
+        if grid is not False:
+            index_grid_hash(self, grid)
+
     def __str__(self):
         return self.urlhash
 
+    # stations_minhash and grid_hash (and the indexes built from them) are computed from these
+    INDEXED_FIELDS = ('stations', 'data', 'mapdata')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.remember_indexed_fields()
+        return instance
+
+    def remember_indexed_fields(self):
+        # Kept by reference, so this costs nothing;
+        #   everything that changes these fields assigns a new value rather than editing it in place
+        self._loaded_indexed_fields = {
+            field: self.__dict__[field]
+            for field in self.INDEXED_FIELDS
+            if field in self.__dict__
+        }
+
+    def indexed_fields_changed(self, update_fields=None):
+
+        """ Whether this save might change stations_minhash or grid_hash:
+                most saves (admin actions, naming, generate_images) don't touch the stations or data,
+                so there's no need to recompute either one.
+            Anything missed (e.g. a queryset .update()) is caught by ./manage.py index_maps
+        """
+
+        if self._state.adding:
+            return True
+        if update_fields is not None:
+            return bool(set(update_fields) & set(self.INDEXED_FIELDS))
+        loaded = getattr(self, '_loaded_indexed_fields', None)
+        if loaded is None:
+            # Not loaded from the database, so there's nothing to compare with
+            return True
+        return any(
+            field not in loaded or self.__dict__.get(field) is not loaded[field]
+            for field in self.INDEXED_FIELDS
+            if field in self.__dict__
+        )
+
     def save(self, *args, **kwargs):
         self.name = self.name.strip()
         self.thumbnail = self.thumbnail.strip()
-        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if self.indexed_fields_changed(update_fields):
+            signature = self.update_stations_minhash()
+            grid = self.update_grid_hash()
+        else:
+            signature = grid = False
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            if signature is not False:
+                update_fields.add('stations_minhash')
+            if grid is not False:
+                update_fields.add('grid_hash')
+            kwargs['update_fields'] = update_fields
+        if self._state.adding:
+            if not self.payload_etag:
+                self.build_payload()
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+                self.update_indexes(signature, grid)
+            count_new_map(self)
+        else:
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+                self.update_indexes(signature, grid)
+        self.remember_indexed_fields()
+        forget_urlhash(self.urlhash)
+        # Admin actions, naming, and generate_images all save;
+        #   any of them can change what the map's card shows
+        bump_map_card_version(self.pk)
+
+    def delete(self, *args, **kwargs):
+        forget_urlhash(self.urlhash)
+        bump_map_card_version(self.pk)
+        if self.publicly_visible:
+            forget_random_public_pool()
+        family = MapFamilyMember.objects.filter(savedmap=self.pk).values_list('family', flat=True).first()
+        with track_counters(SavedMap.objects.filter(pk=self.pk)):
+            deleted = super().delete(*args, **kwargs)
+        if family:
+            # It might have been the family's latest version
+            refresh_families(family)
+        return deleted
 
     DEFER_FIELDS = (
         'mapdata',
         'data',
+        'payload_gzip',
         'thumbnail',
         'stations',
+        'stations_minhash',
     )
 
     class Meta:
@@ -417,3 +702,100 @@ class City(models.Model):
         indexes = [
             models.Index(fields=['name']),
         ]
+
+
+class MapSimilarityBand(models.Model):
+
+    """ One band of a map's stations_minhash, hashed into a bucket.
+        Maps that share a bucket in any band probably have similar stations;
+            see map_saver.similarity
+    """
+
+    savedmap = models.ForeignKey(SavedMap, on_delete=models.CASCADE)
+    band = models.SmallIntegerField()
+    bucket = models.BigIntegerField()
+
+    class Meta:
+
+        indexes = [
+            models.Index(fields=['band', 'bucket']),
+        ]
+
+    def __str__(self):
+        return f'Band {self.band} of Map #{self.savedmap_id}: {self.bucket}'
+
+
+class MapGridHash(models.Model):
+
+    """ A map's grid_hash, split into chunks that are each indexed,
+            so maps within a few bits of it can be found without comparing against every map;
+            see map_saver.similarity
+    """
+
+    savedmap = models.OneToOneField(SavedMap, on_delete=models.CASCADE, primary_key=True)
+    grid_hash = models.BigIntegerField()
+    chunk0 = models.PositiveIntegerField()
+    chunk1 = models.PositiveIntegerField()
+    chunk2 = models.PositiveIntegerField()
+    chunk3 = models.PositiveIntegerField()
+
+    class Meta:
+
+        indexes = [
+            models.Index(fields=['chunk0']),
+            models.Index(fields=['chunk1']),
+            models.Index(fields=['chunk2']),
+            models.Index(fields=['chunk3']),
+        ]
+
+    def __str__(self):
+        return f'Grid hash of Map #{self.savedmap_id}: {self.grid_hash:x}'
+
+
+class MapStation(models.Model):
+
+    """ One station name on a map, so maps can be found by their stations;
+            see map_saver.station_index
+    """
+
+    savedmap = models.ForeignKey(SavedMap, on_delete=models.CASCADE)
+    name = models.CharField(max_length=255)
+
+    class Meta:
+
+        indexes = [
+            models.Index(fields=['name']),
+        ]
+
+    def __str__(self):
+        return f'{self.name} on Map #{self.savedmap_id}'
+
+
+class MapFamily(models.Model):
+
+    """ Near-identical versions of one map; see map_saver.families
+    """
+
+    latest = models.ForeignKey(SavedMap, null=True, on_delete=models.SET_NULL, related_name='+')
+    size = models.PositiveIntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'map families'
+
+    def __str__(self):
+        return f'Family #{self.pk} ({self.size} versions, latest: #{self.latest_id})'
+
+
+class MapFamilyMember(models.Model):
+
+    """ Which MapFamily a map is in
+    """
+
+    savedmap = models.OneToOneField(SavedMap, on_delete=models.CASCADE, primary_key=True, related_name='family_membership')
+    family = models.ForeignKey(MapFamily, on_delete=models.CASCADE, related_name='members')
+    # How similar this map is to the version it was matched with
+    similarity = models.FloatField(default=1)
+
+    def __str__(self):
+        return f'Map #{self.savedmap_id} in Family #{self.family_id}'
@@ -0,0 +1,216 @@
+""" Paging through long listings without OFFSET.
+
+    Django's Paginator fetches page N with OFFSET (N - 1) * per_page, which reads and throws away
+        every row before it, and runs a COUNT(*) of the whole listing on every page.
+
+    Instead, the Next / Previous / Last links carry a cursor: the ordering columns' values
+        of the last (or first) map on the page, so the next page is an indexed
+        WHERE (created_at, id) < (...) LIMIT per_page, which costs the same on page 1000 as on page 1.
+    The total is counted once and cached (CachedCountPaginator), so it may lag behind by a few minutes.
+
+    Numbered pages (?page=3) still work, for links that already exist.
+"""
+
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
+from django.core.paginator import InvalidPage, Page, Paginator
+from django.db.models import Q
+from django.http import Http404
+from django.utils.functional import cached_property
+
+import base64
+import datetime
+import hashlib
+import json
+
+COUNT_TIMEOUT = 60 * 5
+
+
+class CachedCountPaginator(Paginator):
+
+    """ A Paginator that only counts each distinct listing once every COUNT_TIMEOUT
+    """
+
+    @cached_property
+    def count(self):
+        try:
+            sql, params = self.object_list.query.sql_with_params()
+        except (AttributeError, EmptyResultSet):
+            return super().count
+        key = 'paginator:count:' + hashlib.md5(f'{sql}{params}'.encode('utf-8')).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = super().count
+            cache.set(key, count, COUNT_TIMEOUT)
+        return count
+
+    def _get_page(self, *args, **kwargs):
+        return CursorPage(*args, **kwargs)
+
+
+def encode_cursor(values):
+    values = [value.isoformat() if isinstance(value, (datetime.date, datetime.datetime)) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, ordering):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        raise Http404('Invalid cursor')
+    if not isinstance(values, list) or len(values) != len(ordering):
+        raise Http404('Invalid cursor')
+    return values
+
+
+def keyset_filter(ordering, values, forward=True):
+
+    """ The rows that come after (or, going backward, before) these values in this ordering:
+            for ('-created_at', '-id'), created_at < x OR (created_at = x AND id < y)
+    """
+
+    rows = Q()
+    for index, field in enumerate(ordering):
+        name = field.lstrip('-')
+        descending = field.startswith('-')
+        lookup = 'lt' if descending == forward else 'gt'
+        clause = Q(**{f'{name}__{lookup}': values[index]})
+        for previous_field, previous_value in zip(ordering[:index], values[:index]):
+            clause &= Q(**{previous_field.lstrip('-'): previous_value})
+        rows |= clause
+    return rows
+
+
+def can_keyset(model, ordering):
+
+    """ Cursors only work over the model's own non-null columns
+            (a NULL compares as neither less nor greater, so those rows would be skipped)
+    """
+
+    for field in ordering:
+        try:
+            field = model._meta.get_field(field.lstrip('-'))
+        except FieldDoesNotExist:
+            return False
+        if field.null or field.is_relation:
+            return False
+    return True
+
+
+def reverse_ordering(ordering):
+    return tuple(field[1:] if field.startswith('-') else f'-{field}' for field in ordering)
+
+
+class CursorPage(Page):
+
+    """ A Page that knows the cursors for the pages either side of it
+    """
+
+    ordering = ()
+
+    def cursor_for(self, obj):
+        return encode_cursor([getattr(obj, field.lstrip('-')) for field in self.ordering])
+
+    @property
+    def next_cursor(self):
+        if self.ordering and self.has_next() and len(self.object_list):
+            return self.cursor_for(self.object_list[len(self.object_list) - 1])
+
+    @property
+    def previous_cursor(self):
+        if self.ordering and self.has_previous() and len(self.object_list):
+            return self.cursor_for(self.object_list[0])
+
+
+class KeysetPage(CursorPage):
+
+    """ A page fetched by cursor; it doesn't have a page number
+    """
+
+    def __init__(self, object_list, paginator, ordering, has_next, has_previous):
+        super().__init__(object_list, None, paginator)
+        self.ordering = ordering
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def start_index(self):
+        return None
+
+    def end_index(self):
+        return None
+
+
+def keyset_page(paginator, ordering, cursor=None, forward=True):
+
+    """ Fetches the page after the cursor (or before it, going backward);
+            going backward with no cursor is the last page
+    """
+
+    queryset = paginator.object_list
+    per_page = paginator.per_page
+    if not forward:
+        queryset = queryset.order_by(*reverse_ordering(ordering))
+    if cursor is not None:
+        queryset = queryset.filter(keyset_filter(ordering, decode_cursor(cursor, ordering), forward))
+
+    # One extra, to know whether there's another page after this one
+    rows = list(queryset[:per_page + 1])
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    if forward:
+        return KeysetPage(rows, paginator, ordering, has_next=more, has_previous=cursor is not None)
+    rows.reverse()
+    return KeysetPage(rows, paginator, ordering, has_next=cursor is not None, has_previous=more)
+
+
+def paginate(request, queryset, ordering, per_page, page_kwarg='page', lenient=False):
+
+    """ Returns the page of this queryset (ordered by ordering, which must be unique, e.g. end in id)
+            that the request asks for: ?after= or ?before= a cursor, ?page=last, or ?page=N.
+        Orderings that can't use cursors (see can_keyset) get numbered pages only.
+
+        Raises InvalidPage for page numbers that don't exist, like Paginator.page(),
+            unless lenient, which falls back to the nearest page like Paginator.get_page()
+    """
+
+    paginator = CachedCountPaginator(queryset.order_by(*ordering), per_page)
+    keyset = can_keyset(queryset.model, ordering)
+
+    if keyset:
+        if request.GET.get('after'):
+            return keyset_page(paginator, ordering, request.GET['after'])
+        if request.GET.get('before'):
+            return keyset_page(paginator, ordering, request.GET['before'], forward=False)
+        if request.GET.get(page_kwarg) == 'last':
+            return keyset_page(paginator, ordering, forward=False)
+
+    number = request.GET.get(page_kwarg) or 1
+    if number == 'last':
+        number = paginator.num_pages
+    page = paginator.get_page(number) if lenient else paginator.page(number)
+    if keyset:
+        page.ordering = ordering
+    return page
+
+
+class KeysetPaginationMixin:
+
+    """ For ListViews (and date archive views): pages by cursor rather than OFFSET;
+            set keyset_ordering to the listing's order, ending in a unique column
+    """
+
+    keyset_ordering = ('-id',)
+
+    def paginate_queryset(self, queryset, page_size):
+        try:
+            page = paginate(self.request, queryset, self.keyset_ordering, page_size, self.page_kwarg)
+        except InvalidPage as exc:
+            raise Http404(f'Invalid page: {exc}')
+        return (page.paginator, page, page.object_list, page.has_other_pages())
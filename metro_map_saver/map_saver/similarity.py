@@ -0,0 +1,296 @@
+""" Finding maps with nearly the same stations, without comparing against every map.
+
+    Each map's set of station names is reduced to a MinHash signature:
+        for each of NUM_PERMUTATIONS hash functions, the smallest hash of any station.
+        Two maps agree on any one of those minimums with probability equal to
+        the Jaccard similarity of their station sets.
+
+    The signature is split into BANDS bands of ROWS rows, and each band is hashed into a bucket
+        (MapSimilarityBand). Maps that share a bucket in any band are candidates;
+        with 16 bands of 4 rows, maps with a Jaccard similarity of 0.5 share a bucket about 64% of the time,
+        and at 0.8 about 99.9% of the time, while unrelated maps almost never do.
+
+    Candidates are then scored exactly (see station_similarity), same as before.
+
+    Maps with the same lines but renamed (or no) stations are found by their grid hash instead:
+        the bounding box of every occupied point, shrunk to GRID_SIZE x GRID_SIZE cells,
+        with one bit per cell set if it has more points than average (an "average hash").
+        Maps that look alike have hashes a few bits apart.
+
+    Each grid hash is split into GRID_HASH_CHUNKS indexed chunks (MapGridHash);
+        two hashes within GRID_HASH_MAX_DISTANCE bits of each other must match exactly
+        on at least one chunk, so only maps sharing a chunk need to be compared.
+"""
+
+from django.db.models import Count, Q
+
+import hashlib
+import json
+import random
+import struct
+
+NUM_PERMUTATIONS = 64
+BANDS = 16
+ROWS = NUM_PERMUTATIONS // BANDS
+# More than enough to find a map's versions; the rest are ranked out
+MAX_CANDIDATES = 200
+
+# A Mersenne prime comfortably bigger than any 32-bit station hash
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+# Fixed, so signatures stay comparable across processes and deploys;
+#   changing any of these means running ./manage.py index_maps --index minhash --reindex
+_permutations = random.Random(20180802)
+PERMUTATIONS = [
+    (_permutations.randint(1, MERSENNE_PRIME - 1), _permutations.randint(0, MERSENNE_PRIME - 1))
+    for _ in range(NUM_PERMUTATIONS)
+]
+
+SIGNATURE_FORMAT = f'>{NUM_PERMUTATIONS}I'
+
+# Same as MapSimilarView has always used
+SIMILARITY_THRESHOLD = 0.8
+
+GRID_SIZE = 8
+GRID_HASH_BITS = GRID_SIZE * GRID_SIZE
+GRID_HASH_MASK = (1 << GRID_HASH_BITS) - 1
+GRID_HASH_CHUNKS = 4
+GRID_HASH_CHUNK_BITS = GRID_HASH_BITS // GRID_HASH_CHUNKS
+# Any more than this and two hashes might not share a chunk
+GRID_HASH_MAX_DISTANCE = GRID_HASH_CHUNKS - 1
+
+
+def station_set(stations):
+
+    """ SavedMap.stations is a comma-separated string of lowercased station names
+    """
+
+    return {station.strip() for station in stations.split(',') if station.strip()}
+
+
+def station_hash(station):
+    return int.from_bytes(hashlib.blake2b(station.encode('utf-8'), digest_size=4).digest(), 'big')
+
+
+def minhash(stations):
+
+    """ Returns the MinHash signature (as bytes) of this set of station names,
+            or None if there aren't any stations
+    """
+
+    if not stations:
+        return None
+
+    hashes = [station_hash(station) for station in stations]
+    signature = [
+        min(((a * h + b) % MERSENNE_PRIME) & MAX_HASH for h in hashes)
+        for a, b in PERMUTATIONS
+    ]
+    return struct.pack(SIGNATURE_FORMAT, *signature)
+
+
+def band_buckets(signature):
+
+    """ Returns [(band, bucket)] for a MinHash signature;
+            buckets fit in a signed 64-bit column
+    """
+
+    row_bytes = ROWS * 4
+    return [
+        (band, int.from_bytes(hashlib.blake2b(signature[band * row_bytes:(band + 1) * row_bytes], digest_size=8).digest(), 'big') >> 1)
+        for band in range(BANDS)
+    ]
+
+
+def station_similarity(these_stations, those_stations):
+
+    """ How similar two maps' station sets are, from 0 to 1:
+            the share of this map's stations the other map also has,
+            less the share of stations the other map has that this one doesn't
+    """
+
+    if not these_stations or not those_stations:
+        return 0
+
+    overlap = len(these_stations & those_stations) / float(len(these_stations))
+    difference = 1.0 - (len(those_stations - these_stations) / float(len(these_stations)))
+    return overlap * difference
+
+
+def index_map(saved_map, signature=None):
+
+    """ Replaces this map's MapSimilarityBand rows with the bands of its current signature
+    """
+
+    from .models import MapSimilarityBand
+
+    if signature is None:
+        signature = minhash(station_set(saved_map.stations))
+
+    MapSimilarityBand.objects.filter(savedmap=saved_map).delete()
+    if signature:
+        MapSimilarityBand.objects.bulk_create([
+            MapSimilarityBand(savedmap=saved_map, band=band, bucket=bucket)
+            for band, bucket in band_buckets(signature)
+        ])
+
+
+def candidate_pks(saved_map, among=None, limit=MAX_CANDIDATES):
+
+    """ Returns the pks of up to limit maps (out of the among queryset, if given)
+            that share at least one band bucket with this one,
+            the ones that share the most buckets (so are likely the most similar) first.
+
+        Near-copies of a popular map (like the default one) can share a bucket with tens of thousands of maps;
+            they're counted and ranked in the database, so only the top few ever leave it.
+    """
+
+    from .models import MapSimilarityBand
+
+    signature = saved_map.stations_minhash
+    if not signature:
+        return []
+
+    # Both columns of the (band, bucket) index are fixed in each term,
+    #   so this is one index range per band
+    buckets = Q()
+    for band, bucket in band_buckets(bytes(signature)):
+        buckets |= Q(band=band, bucket=bucket)
+
+    matches = MapSimilarityBand.objects.filter(buckets).exclude(savedmap=saved_map.pk)
+    if among is not None:
+        matches = matches.filter(savedmap__in=among.values('pk'))
+    # A list rather than a subquery: MySQL doesn't support LIMIT in an IN (...) subquery
+    return list(
+        matches.values('savedmap_id')
+        .annotate(shared=Count('pk'))
+        .order_by('-shared', '-savedmap_id')
+        .values_list('savedmap_id', flat=True)[:limit]
+    )
+
+
+def occupied_points(mapdata):
+
+    """ Returns the set of (x, y) points that have a line on them,
+            for mapdata in any data_version
+    """
+
+    data_version = mapdata.get('global', {}).get('data_version', 1)
+    points = set()
+
+    if data_version == 1:
+        for x in mapdata:
+            if x == 'global' or not isinstance(mapdata[x], dict):
+                continue
+            for y in mapdata[x]:
+                if isinstance(mapdata[x][y], dict) and mapdata[x][y].get('line'):
+                    points.add((int(x), int(y)))
+        return points
+
+    for color in mapdata.get('points_by_color', {}):
+        if data_version == 2:
+            by_width_style = {'xys': mapdata['points_by_color'][color].get('xys', {})}
+        else:
+            by_width_style = mapdata['points_by_color'][color]
+        for xys in by_width_style.values():
+            for x in xys:
+                for y in xys[x]:
+                    points.add((int(x), int(y)))
+
+    return points
+
+
+def grid_hash(points):
+
+    """ Returns the average hash of these points (as a signed 64-bit int, to fit the column),
+            or None if there aren't any
+    """
+
+    if not points:
+        return None
+
+    min_x = min(x for x, _ in points)
+    min_y = min(y for _, y in points)
+    width = max(x for x, _ in points) - min_x + 1
+    height = max(y for _, y in points) - min_y + 1
+
+    cells = [0] * GRID_HASH_BITS
+    for x, y in points:
+        cell_x = (x - min_x) * GRID_SIZE // width
+        cell_y = (y - min_y) * GRID_SIZE // height
+        cells[cell_y * GRID_SIZE + cell_x] += 1
+
+    average = len(points) / GRID_HASH_BITS
+    value = 0
+    for count in cells:
+        value = (value << 1) | (count > average)
+
+    return int.from_bytes(value.to_bytes(8, 'big'), 'big', signed=True)
+
+
+def mapdata_grid_hash(data, mapdata):
+
+    """ SavedMap.data, falling back to the v1 JSON in SavedMap.mapdata for maps that were never converted
+    """
+
+    if not data:
+        try:
+            data = json.loads(mapdata or '{}')
+        except json.JSONDecodeError:
+            return None
+    return grid_hash(occupied_points(data))
+
+
+def grid_hash_chunks(value):
+    value &= GRID_HASH_MASK
+    chunk_mask = (1 << GRID_HASH_CHUNK_BITS) - 1
+    return [
+        (value >> (GRID_HASH_CHUNK_BITS * chunk)) & chunk_mask
+        for chunk in range(GRID_HASH_CHUNKS)
+    ]
+
+
+def hamming_distance(a, b):
+    return bin((a ^ b) & GRID_HASH_MASK).count('1')
+
+
+def index_grid_hash(saved_map, value):
+
+    """ Replaces this map's MapGridHash row
+    """
+
+    from .models import MapGridHash
+
+    MapGridHash.objects.filter(savedmap=saved_map).delete()
+    if value is not None:
+        MapGridHash.objects.create(
+            savedmap=saved_map,
+            grid_hash=value,
+            **{f'chunk{chunk}': part for chunk, part in enumerate(grid_hash_chunks(value))},
+        )
+
+
+def visually_similar(saved_map, max_distance=GRID_HASH_MAX_DISTANCE):
+
+    """ Returns {pk: distance} for the maps whose grid hash is within max_distance bits of this one's
+    """
+
+    from .models import MapGridHash
+
+    if saved_map.grid_hash is None:
+        return {}
+
+    # A UNION of indexed lookups, one per chunk
+    lookups = [
+        MapGridHash.objects.filter(**{f'chunk{chunk}': part}).values_list('savedmap_id', 'grid_hash')
+        for chunk, part in enumerate(grid_hash_chunks(saved_map.grid_hash))
+    ]
+    matches = lookups[0].union(*lookups[1:])
+
+    distances = {}
+    for pk, value in matches:
+        distance = hamming_distance(saved_map.grid_hash, value)
+        if pk != saved_map.pk and distance <= max_distance:
+            distances[pk] = distance
+    return distances
@@ -0,0 +1,78 @@
+""" Which maps have a station called ...?
+
+    SavedMap.stations is one comma-separated string per map, which can't be searched without a full table scan;
+        MapStation has one (indexed) row per station name per map instead,
+        kept up to date by SavedMap.save() whenever a map's stations change.
+
+    The editor saves station names with underscores for spaces (Fort_Totten);
+        they're indexed and searched the way they're shown (fort totten), see station_name.
+
+    ./manage.py index_maps --index stations backfills it.
+"""
+
+from django.db.models import Count
+
+from .similarity import station_set
+
+# Prefixes shorter than this match too many stations to be useful
+MIN_PREFIX_LENGTH = 3
+MAX_STATIONS = 20
+MAX_MAPS = 50
+
+
+def station_name(name):
+
+    """ A station name as it's indexed: lowercase, with spaces instead of underscores,
+            so "Fort Totten", "fort_totten" and "Fort_Totten" are the same station
+    """
+
+    return ' '.join(name.replace('_', ' ').lower().split())
+
+
+def index_stations(saved_map):
+
+    """ Replaces this map's MapStation rows with its current stations
+    """
+
+    from .models import MapStation
+
+    MapStation.objects.filter(savedmap=saved_map).delete()
+    names = {station_name(name) for name in station_set(saved_map.stations or '')}
+    MapStation.objects.bulk_create([
+        MapStation(savedmap=saved_map, name=name[:MapStation._meta.get_field('name').max_length])
+        for name in sorted(names)
+        if name
+    ])
+
+
+def search_stations(prefix, publicly_visible=True, limit=MAX_STATIONS):
+
+    """ Returns [{'name': ..., 'maps': ...}] for the station names starting with this prefix,
+            most common first
+    """
+
+    from .models import MapStation
+
+    stations = MapStation.objects.filter(name__startswith=station_name(prefix))
+    if publicly_visible:
+        stations = stations.filter(savedmap__publicly_visible=True)
+    return list(
+        stations.values('name')
+        .annotate(maps=Count('savedmap_id', distinct=True))
+        .order_by('-maps', 'name')[:limit]
+    )
+
+
+def maps_with_station(name, publicly_visible=True):
+
+    """ Returns a queryset of the maps that have a station with exactly this name
+    """
+
+    from .models import MapStation, SavedMap
+
+    maps = SavedMap.objects.filter(
+        pk__in=MapStation.objects.filter(name=station_name(name)).values('savedmap_id'),
+    )
+    if publicly_visible:
+        maps = maps.filter(publicly_visible=True)
+    return maps.defer(*SavedMap.DEFER_FIELDS).order_by('-created_at')
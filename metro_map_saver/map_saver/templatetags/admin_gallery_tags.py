@@ -1,34 +1,40 @@
 from django import template
+from map_saver.gallery_lookups import clean_name
 from map_saver.models import SavedMap
 from citysuggester.models import TravelSystem
 
 register = template.Library()
 
+# Each of these is answered from the page's GalleryLookups (see map_saver.gallery_lookups) when the view provides one,
+#   and with a query of its own otherwise
+
 @register.filter(name='existing_maps')
 def existing_maps(value, arg):
 
     """ Use to find existing maps with the same name as this
         that are publicly visible and have some tag
     """
-    # user-named maps have suggested tags in parentheses,
-    #   and TravelSystems contain the country name (after a comma)
-    # we don't want these considered part of the name
-    name = value.name.split("(")[0].strip()
-    name = name.split(",")[0].strip()
+    lookups = getattr(value, 'gallery_lookups', None)
+    if lookups:
+        return lookups.existing_maps(value.name, arg)
+
     return SavedMap.objects.filter(**{
         'publicly_visible': True,
-        'name': name,
+        'name': clean_name(value.name),
         'tags__slug': arg,
     }).count()
 
-@register.simple_tag(name='find_existing_maps')
-def existing_maps_search_by_name_tag(name, tag):
+@register.simple_tag(name='find_existing_maps', takes_context=True)
+def existing_maps_search_by_name_tag(context, name, tag):
 
     """ Use to find existing publicly visible maps,
         searching by name and tag
     """
-    name = name.split("(")[0].strip()
-    name = name.split(",")[0].strip()
+    lookups = context.get('gallery_lookups')
+    if lookups:
+        return lookups.find_existing_maps(name, tag)
+
+    name = clean_name(name)
     if name:
         return SavedMap.objects.filter(**{
             'publicly_visible': True,
@@ -36,10 +42,14 @@ def existing_maps_search_by_name_tag(name, tag):
             'tags__slug': tag,
         }).count()
 
-@register.simple_tag(name='stations_in_travelsystem')
-def stations_in_travelsystem(name):
+@register.simple_tag(name='stations_in_travelsystem', takes_context=True)
+def stations_in_travelsystem(context, name):
 
     """ Use to get a count of how many stations
         there are in a given TravelSystem
     """
+    lookups = context.get('gallery_lookups')
+    if lookups:
+        return lookups.stations_in_travelsystem(name)
+
     return TravelSystem.objects.get(name__startswith=name)._station_count()
@@ -0,0 +1,429 @@
+import datetime
+import os
+import pickle
+from io import StringIO
+from unittest import mock
+
+from map_saver.cache_backends import ChunkManifest, ChunkedValuesMixin, CompressedValue, LocalTierMixin, PickledValue
+from map_saver.caching import (
+    bump_map_card_version,
+    forget_favorites_pools,
+    forget_random_public_pool,
+    get_favorites_pool,
+    get_map_card_versions,
+    get_random_public_pool,
+    random_map_pk,
+    sample_favorites,
+)
+from map_saver.management.commands.warm_cache import forget_cached_page, pages_to_warm
+from map_saver.models import SavedMap
+from summary.models import MapsByDay
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.template.loader import render_to_string
+from django.http import HttpResponse
+from django.test import TestCase
+
+
+class TieredLocMemCache(LocalTierMixin, LocMemCache):
+    pass
+
+
+class MultiKeyLocMemCache(LocMemCache):
+
+    """ Like memcached, get_many and set_many don't go back through get and set
+    """
+
+    def get_many(self, keys, version=None):
+        missing = object()
+        found = {key: LocMemCache.get(self, key, missing, version) for key in keys}
+        return {key: value for key, value in found.items() if value is not missing}
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        for key, value in data.items():
+            LocMemCache.set(self, key, value, timeout, version)
+        return []
+
+
+class ChunkedLocMemCache(ChunkedValuesMixin, MultiKeyLocMemCache):
+    pass
+
+
+class TieredChunkedLocMemCache(LocalTierMixin, ChunkedValuesMixin, MultiKeyLocMemCache):
+    pass
+
+
+class FailingChunksLocMemCache(MultiKeyLocMemCache):
+
+    """ Every chunk write fails, as if memcached were out of memory
+    """
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = [key for key in data if ':chunk:' in key]
+        super().set_many({key: value for key, value in data.items() if key not in failed}, timeout, version)
+        return failed
+
+
+class ChunkedFailingLocMemCache(ChunkedValuesMixin, FailingChunksLocMemCache):
+    pass
+
+
+class LocalTierTest(TestCase):
+
+    """ Test the in-process tier in front of the shared cache,
+            using LocMemCache to stand in for memcached
+    """
+
+    def get_cache(self, **local_tier):
+        # Each test gets its own local store (and stats)
+        name = self._testMethodName
+        local_tier.setdefault('NAME', name)
+        local_tier.setdefault('KEY_PREFIXES', ('hot:',))
+        cache = TieredLocMemCache(name, {'LOCAL_TIER': local_tier})
+        cache.clear()
+        return cache
+
+    def shared(self):
+
+        """ The shared cache without a local tier in front of it, like another process would see it
+        """
+
+        return LocMemCache(self._testMethodName, {})
+
+    def test_hot_keys_served_locally(self):
+        cache = self.get_cache()
+        cache.set('hot:page', 'cached page')
+        cache.set('cold:page', 'cached page')
+
+        # Changes to the shared cache behind its back aren't seen until the local entry expires
+        self.shared().set('hot:page', 'changed', version=1)
+        self.shared().set('cold:page', 'changed', version=1)
+        self.assertEqual('cached page', cache.get('hot:page'))
+        self.assertEqual('changed', cache.get('cold:page'))
+
+        stats = cache.local_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['entries'])
+
+        with mock.patch('map_saver.cache_backends.time.monotonic', return_value=10 ** 9):
+            self.assertEqual('changed', cache.get('hot:page'))
+
+    def test_values_are_not_shared_between_requests(self):
+        cache = self.get_cache()
+        cache.set('hot:response', HttpResponse('page'))
+        response = cache.get('hot:response')
+        response['Age'] = 0
+        self.assertNotIn('Age', cache.get('hot:response'))
+
+    def test_responses_rebuilt_without_pickle(self):
+        cache = self.get_cache()
+        page = HttpResponse('<html>page</html>', headers={'Cache-Control': 'max-age=600'})
+        page['Expires'] = 'Thu, 01 Jan 2026 00:00:00 GMT'
+        cache.set('hot:page', page)
+
+        with mock.patch('map_saver.cache_backends.pickle.loads') as loads:
+            response = cache.get('hot:page')
+        loads.assert_not_called()
+        self.assertIsNot(page, response)
+        self.assertEqual(page.content, response.content)
+        self.assertEqual(page.status_code, response.status_code)
+        self.assertEqual(dict(page.items()), dict(response.items()))
+
+    def test_lru_eviction(self):
+        cache = self.get_cache(MAX_ENTRIES=2)
+        cache.set('hot:1', 1)
+        cache.set('hot:2', 2)
+        cache.get('hot:1')
+        cache.set('hot:3', 3)
+
+        stats = cache.local_stats()
+        self.assertEqual(1, stats['evictions'])
+        self.assertEqual(2, stats['entries'])
+
+        # hot:2 was least recently used, so it was evicted locally, but is still in the shared cache
+        self.assertEqual(2, cache.get('hot:2'))
+        self.assertEqual(1, cache.local_stats()['misses'])
+
+    def test_generation_invalidates_other_processes(self):
+        cache = self.get_cache(GENERATION_CHECK_INTERVAL=0)
+        cache.set('hot:page', 'cached page')
+        invalidations = cache.local_stats()['invalidations']
+
+        # Another process deletes the key, which bumps the generation
+        other = TieredLocMemCache(self._testMethodName, {'LOCAL_TIER': {'NAME': 'other-process', 'KEY_PREFIXES': ('hot:',)}})
+        other.delete('hot:page')
+
+        self.assertIsNone(cache.get('hot:page'))
+        self.assertEqual(invalidations + 1, cache.local_stats()['invalidations'])
+
+
+class ChunkedValuesTest(TestCase):
+
+    """ Test compressing and chunking values too big for a single memcached item
+    """
+
+    def get_cache(self):
+        cache = ChunkedLocMemCache(self._testMethodName, {
+            'CHUNKED_VALUES': {'COMPRESS_THRESHOLD': 100, 'CHUNK_SIZE': 1000},
+        })
+        cache.clear()
+        return cache
+
+    def shared(self):
+        return LocMemCache(self._testMethodName, {})
+
+    def test_small_values_untouched(self):
+        cache = self.get_cache()
+        cache.set('small', 'value')
+        cache.set('counter', 1)
+        cache.incr('counter')
+        self.assertEqual('value', self.shared().get('small'))
+        self.assertEqual(2, cache.get('counter'))
+        self.assertEqual(0, cache.chunk_stats['compressed'])
+
+    def test_compressed(self):
+        cache = self.get_cache()
+        value = 'compressible ' * 1000
+        cache.set('compressible', value)
+        self.assertIsInstance(self.shared().get('compressible'), CompressedValue)
+        self.assertEqual(value, cache.get('compressible'))
+        self.assertEqual(0, cache.chunk_stats['chunked'])
+
+    def test_chunked(self):
+        cache = self.get_cache()
+        value = HttpResponse(os.urandom(5000))
+        cache.set('big', value)
+        cache.set_many({'big2': b'x' + os.urandom(3000), 'small': 'value'})
+
+        self.assertEqual(value.content, cache.get('big').content)
+        self.assertEqual({'big', 'big2', 'small'}, set(cache.get_many(['big', 'big2', 'small', 'nope'])))
+        self.assertEqual(2, cache.chunk_stats['chunked'])
+        self.assertEqual(2, cache.chunked_count())
+
+        # If any chunk is evicted, the whole value is a miss
+        manifest = self.shared().get('big')
+        self.shared().delete(manifest.chunk_keys('big')[-1])
+        self.assertIsNone(cache.get('big'))
+        self.assertEqual('default', cache.get('big', 'default'))
+        self.assertEqual(2, cache.chunk_stats['chunk_misses'])
+
+    def test_pickled_once(self):
+        cache = self.get_cache()
+        value = {'small': 'map'}
+        with mock.patch('map_saver.cache_backends.pickle.dumps', wraps=pickle.dumps) as dumps:
+            cache.set('page', value)
+        # LocMemCache pickles whatever it stores too; only count pickles of the value itself
+        self.assertEqual(1, [call.args[0] is value for call in dumps.call_args_list].count(True))
+        self.assertIsInstance(self.shared().get('page'), PickledValue)
+        self.assertEqual(value, cache.get('page'))
+
+    def test_set_many_failed_chunks(self):
+        cache = ChunkedFailingLocMemCache(self._testMethodName, {
+            'CHUNKED_VALUES': {'COMPRESS_THRESHOLD': 100, 'CHUNK_SIZE': 1000},
+        })
+        cache.clear()
+        cache.set_many({'big': 'old value', 'small': 'old value'})
+
+        failed = cache.set_many({'big': os.urandom(5000), 'small': 'value'})
+        self.assertEqual(['big'], failed)
+        # Same as set(): neither a manifest without its chunks nor the older value is left behind
+        self.assertIsNone(cache.get('big'))
+        self.assertEqual('value', cache.get('small'))
+
+    def test_behind_local_tier(self):
+        cache = TieredChunkedLocMemCache(self._testMethodName, {
+            'CHUNKED_VALUES': {'COMPRESS_THRESHOLD': 100, 'CHUNK_SIZE': 1000},
+            'LOCAL_TIER': {'NAME': self._testMethodName, 'KEY_PREFIXES': ['big']},
+        })
+        cache.clear()
+        value = os.urandom(5000)
+        cache.set('big', value)
+        self.assertEqual(value, cache.get('big'))
+        self.assertIsInstance(self.shared().get('big'), ChunkManifest)
+
+
+class WarmCacheTest(TestCase):
+
+    """ Test the warm_cache command's choice of pages, and forgetting stale ones
+    """
+
+    def test_pages_to_warm(self):
+        MapsByDay.objects.create(day=datetime.date(2019, 3, 5), maps=10)
+
+        paths = pages_to_warm(months=2, cities=0)
+        self.assertIn('/gallery/', paths)
+        self.assertIn('/admin/thumbnail/favorite/', paths)
+        self.assertIn('/admin/thumbnail/unknown/', paths)
+        self.assertIn('/city/', paths)
+        today = datetime.date.today()
+        self.assertIn(f'/calendar/{today.year}/{today.month}/', paths)
+        self.assertNotIn('/calendar/2019/3/', paths)
+
+        self.assertIn('/calendar/2019/3/', pages_to_warm(alltime=True, cities=0))
+
+    def test_forget_cached_page(self):
+        cache.clear()
+        headers = {'HTTP_HOST': 'metromapmaker.com', 'HTTP_ACCEPT_ENCODING': 'gzip'}
+        self.client.get('/admin/thumbnail/real/', **headers)
+
+        self.assertEqual(1, forget_cached_page('https://metromapmaker.com', '/admin/thumbnail/real/', 'gzip'))
+        self.assertEqual(0, forget_cached_page('https://metromapmaker.com', '/admin/thumbnail/real/', 'gzip'))
+
+    def test_warm_cache(self):
+        response = mock.Mock(status_code=200)
+        with mock.patch('requests.Session.get', return_value=response) as get:
+            output = StringIO()
+            call_command('warm_cache', '--cities', '0', '--accept-encoding', 'gzip', '--skip-checks', stdout=output)
+
+        requested = {call.args[0] for call in get.call_args_list}
+        self.assertIn('https://metromapmaker.com/gallery/', requested)
+        self.assertEqual({'Accept-Encoding': 'gzip'}, get.call_args.kwargs['headers'])
+        self.assertIn(f'Warmed {len(requested)} of {len(requested)} pages', output.getvalue())
+
+    def test_summarize_warms_cache(self):
+        # Recounting every day doesn't mean every month's calendar needs warming
+        with mock.patch('summary.management.commands.summarize.call_command') as warm:
+            call_command('summarize', '--alltime', '--warm-cache', '--skip-checks', stdout=StringIO())
+        self.assertFalse(warm.call_args.kwargs['alltime'])
+
+        with mock.patch('summary.management.commands.summarize.call_command') as warm:
+            call_command('summarize', '--warm-cache', '--warm-alltime', '--skip-checks', stdout=StringIO())
+        self.assertTrue(warm.call_args.kwargs['alltime'])
+
+
+class MapCardCacheTest(TestCase):
+
+    """ Test that map cards are served from the cache until something bumps their version
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.saved_map = SavedMap.objects.create(urlhash='cardmap', name='Before')
+
+    def render_card(self):
+        saved_map = SavedMap.objects.get(pk=self.saved_map.pk)
+        saved_map.card_version = get_map_card_versions([saved_map.pk])[saved_map.pk]
+        return render_to_string('map_saver/map_card.html', {'map': saved_map, 'cycle_color': 'red'})
+
+    def test_versions(self):
+        other_map = SavedMap.objects.create(urlhash='othermap')
+        versions = get_map_card_versions([self.saved_map.pk, other_map.pk])
+        self.assertEqual(versions, get_map_card_versions([self.saved_map.pk, other_map.pk]))
+
+        bump_map_card_version(self.saved_map.pk)
+        bumped = get_map_card_versions([self.saved_map.pk, other_map.pk])
+        self.assertNotEqual(versions[self.saved_map.pk], bumped[self.saved_map.pk])
+        self.assertEqual(versions[other_map.pk], bumped[other_map.pk])
+
+        # An evicted version doesn't start over
+        cache.clear()
+        self.assertNotIn(get_map_card_versions([other_map.pk])[other_map.pk], (0, 1))
+
+    def test_card_cached_until_bumped(self):
+        self.assertIn('Before', self.render_card())
+
+        # Bypasses save(), so nothing bumps the version
+        SavedMap.objects.filter(pk=self.saved_map.pk).update(name='After')
+        self.assertIn('Before', self.render_card())
+
+        bump_map_card_version(self.saved_map.pk)
+        self.assertIn('After', self.render_card())
+
+        saved_map = SavedMap.objects.get(pk=self.saved_map.pk)
+        saved_map.name = 'Saved'
+        saved_map.save()
+        self.assertIn('Saved', self.render_card())
+
+
+class FavoritesPoolTest(TestCase):
+
+    """ Test sampling favorites from a cached pool of eligible maps
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.favorites = []
+        for index in range(5):
+            saved_map = SavedMap.objects.create(urlhash=f'fave{index}', name=f'Favorite {index}', publicly_visible=True)
+            saved_map.tags.add('favorite')
+            self.favorites.append(saved_map.pk)
+        reviewed = SavedMap.objects.create(urlhash='reviewed', name='Reviewed', publicly_visible=True)
+        reviewed.tags.add('favorite', 'reviewed')
+        SavedMap.objects.create(urlhash='notfave', name='Not a favorite', publicly_visible=True)
+
+    def test_sample_favorites(self):
+        self.assertEqual(sorted(self.favorites), get_favorites_pool('thumbnails'))
+
+        # Only the chosen maps are fetched once the pool is cached
+        with self.assertNumQueries(1):
+            sampled = sample_favorites('thumbnails', 3)
+        self.assertEqual(3, len(sampled))
+        self.assertEqual(3, len({saved_map.pk for saved_map in sampled}))
+        self.assertTrue({saved_map.pk for saved_map in sampled} <= set(self.favorites))
+
+        self.assertEqual(5, len(sample_favorites('thumbnails', 8)))
+
+        response = self.client.get('/admin/thumbnail/favorite/')
+        self.assertContains(response, 'Favorite 0')
+        self.assertNotContains(response, 'Reviewed')
+
+    def test_forget_favorites_pools(self):
+        # The gallery doesn't leave out reviewed maps
+        self.assertEqual(6, len(get_favorites_pool('gallery')))
+        SavedMap.objects.get(urlhash='notfave').tags.add('favorite')
+        self.assertEqual(6, len(get_favorites_pool('gallery')))
+
+        forget_favorites_pools()
+        self.assertEqual(7, len(get_favorites_pool('gallery')))
+
+
+class RandomMapTest(TestCase):
+
+    """ Test picking a random map without loading every pk
+    """
+
+    def setUp(self):
+        cache.clear()
+
+    def test_random_map_pk(self):
+        self.assertIsNone(random_map_pk())
+
+        pks = [SavedMap.objects.create(urlhash=f'random{index}').pk for index in range(10)]
+        public = SavedMap.objects.create(urlhash='public', name='Public', publicly_visible=True)
+
+        # Bounds are cached, so it's a single lookup from then on
+        random_map_pk()
+        with self.assertNumQueries(1):
+            self.assertIn(random_map_pk(), pks + [public.pk])
+
+        # Deleted maps are skipped, wrapping around if need be
+        SavedMap.objects.filter(pk__gt=pks[0]).delete()
+        for _ in range(10):
+            self.assertEqual(pks[0], random_map_pk())
+
+    def test_random_public_map(self):
+        SavedMap.objects.create(urlhash='private')
+        public = SavedMap.objects.create(urlhash='public', name='Public', publicly_visible=True)
+        SavedMap.objects.create(urlhash='private2')
+
+        for _ in range(10):
+            self.assertEqual(public.pk, random_map_pk(publicly_visible=True))
+
+        response = self.client.get('/random/public/')
+        self.assertContains(response, 'public')
+
+        # Chosen evenly from the public maps' pks, however many private maps sit between them
+        SavedMap.objects.bulk_create([SavedMap(urlhash=f'private{index}') for index in range(3, 50)])
+        after_gap = SavedMap.objects.create(urlhash='aftergap', name='After gap', publicly_visible=True)
+        forget_random_public_pool()
+        self.assertEqual([public.pk, after_gap.pk], get_random_public_pool())
+        with self.assertNumQueries(0):
+            self.assertIn(random_map_pk(publicly_visible=True), (public.pk, after_gap.pk))
+
+        # Deleting a public map forgets the pool
+        public.delete()
+        for _ in range(10):
+            self.assertEqual(after_gap.pk, random_map_pk(publicly_visible=True))
@@ -0,0 +1,140 @@
+from citysuggester.models import TravelSystem
+from map_saver.caching import get_map_card_versions
+from map_saver.models import SavedMap
+from summary.counters import get_counters, reconcile, track_counters
+from summary.dashboard import compute_dashboard, latest_snapshot, take_snapshot
+from summary.models import DashboardSnapshot, MapsByDay
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from io import StringIO
+from unittest import mock
+
+
+class CountersTest(TestCase):
+
+    """ Test that the counters stay in step with the maps as they're created, tagged, and hidden
+    """
+
+    def setUp(self):
+        self.maps = [SavedMap.objects.create(urlhash=f'count{index}') for index in range(3)]
+
+    def assertNoDrift(self):
+        self.assertEqual({}, reconcile())
+
+    def test_create(self):
+        counters = get_counters('maps', 'maps:needing_review', 'maps:public')
+        self.assertEqual({'maps': 3, 'maps:needing_review': 3, 'maps:public': 0}, counters)
+        self.assertEqual(3, MapsByDay.objects.get(day=timezone.localdate()).maps)
+        self.assertNoDrift()
+
+    def test_tag_and_publish(self):
+        saved_map = self.maps[0]
+        with track_counters(SavedMap.objects.filter(pk=saved_map.pk)):
+            saved_map.tags.add('real')
+            saved_map.publicly_visible = True
+            saved_map.save()
+
+        counters = get_counters('maps', 'maps:needing_review', 'maps:public', 'maps:public:real')
+        self.assertEqual({'maps': 3, 'maps:needing_review': 2, 'maps:public': 1, 'maps:public:real': 1}, counters)
+        self.assertNoDrift()
+
+        saved_map.delete()
+        self.assertEqual({'maps': 2, 'maps:public': 0}, get_counters('maps', 'maps:public'))
+        self.assertNoDrift()
+
+    def test_count_stations(self):
+        SavedMap.objects.filter(pk=self.maps[0].pk).update(
+            data={'global': {'data_version': 3}, 'points_by_color': {}, 'stations': {'1': {'1': {'name': 'One'}, '2': {'name': 'Two'}}}},
+        )
+        SavedMap.objects.update(station_count=-1)
+        # One map per batch
+        with mock.patch('map_saver.management.commands.count_stations.BATCH_SIZE', 1):
+            output = StringIO()
+            call_command('count_stations', stdout=output, skip_checks=True)
+        self.assertIn('Counted stations for 3 maps.', output.getvalue())
+        self.assertEqual(
+            {'maps:stations:1-10 stations': 1, 'maps:stations:0 stations': 2},
+            get_counters('maps:stations:1-10 stations', 'maps:stations:0 stations'),
+        )
+        self.assertNoDrift()
+
+    def test_admin_actions(self):
+        user = User.objects.create_superuser(username='admin', password='1X<ISRUkw+tuK')
+        self.client.force_login(user)
+        self.client.post('/admin/action/', {'action': 'hide', 'map': self.maps[0].pk})
+        self.assertEqual(2, get_counters('maps:needing_review')['maps:needing_review'])
+
+        pks = [saved_map.pk for saved_map in self.maps]
+        versions = get_map_card_versions(pks)
+        self.client.post('/admin/home/', {'action': 'mass_hide', 'group': "{'station_count': -1}"})
+        self.assertEqual(0, get_counters('maps:needing_review')['maps:needing_review'])
+        # The hidden maps' cards are stale now
+        bumped = get_map_card_versions(pks)
+        self.assertEqual(2, sum(versions[pk] != bumped[pk] for pk in pks))
+        self.assertNoDrift()
+
+        response = self.client.get('/admin/home/')
+        self.assertEqual(3, response.context['totals']['total'])
+        self.assertEqual(3, response.context['last_30'])
+
+    def test_reconcile(self):
+        # Bypasses the counters, like an edit in the Django admin
+        SavedMap.objects.filter(pk=self.maps[0].pk).update(publicly_visible=True)
+
+        output = StringIO()
+        call_command('reconcile_counters', stdout=output, skip_checks=True)
+        self.assertIn('[DRIFT] maps:public: 0 -> 1 (+1)', output.getvalue())
+        self.assertEqual(1, get_counters('maps:public')['maps:public'])
+        self.assertNoDrift()
+
+
+class DashboardSnapshotTest(TestCase):
+
+    """ Test the admin dashboard's background-computed figures
+    """
+
+    def setUp(self):
+        TravelSystem.objects.create(name='Metro', stations='Fort Totten')
+        TravelSystem.objects.create(name='BART, San Francisco', stations='Embarcadero')
+        TravelSystem.objects.create(name='MUNI', stations='Castro')
+
+        real = SavedMap.objects.create(urlhash='real', name='Metro', publicly_visible=True)
+        real.tags.add('real')
+        speculative = SavedMap.objects.create(urlhash='spec', name='BART', publicly_visible=True)
+        speculative.tags.add('speculative')
+        by_suggested_city = SavedMap.objects.create(urlhash='suggest', name='Metro', suggested_city='MUNI', publicly_visible=True)
+        by_suggested_city.tags.add('speculative')
+        # Not publicly visible, so not counted
+        hidden = SavedMap.objects.create(urlhash='hidden', name='MUNI')
+        hidden.tags.add('real')
+
+    def test_compute_dashboard(self):
+        dashboard = compute_dashboard()
+        self.assertEqual(['Metro'], dashboard['travel_system_has_real_map'])
+        self.assertEqual(['BART', 'MUNI'], dashboard['travel_system_missing_real_map'])
+        self.assertEqual(['BART', 'Metro'], dashboard['travel_system_has_speculative_map'])
+        self.assertEqual(['MUNI'], dashboard['travel_system_missing_speculative_map'])
+        self.assertEqual(3, dashboard['total_travel_systems'])
+        self.assertEqual(['Metro', 2], dashboard['most_popular_cities_by_name'][0])
+        self.assertEqual([['MUNI', 1]], dashboard['most_popular_cities'])
+
+    def test_snapshots(self):
+        first = latest_snapshot()
+        self.assertEqual(first, latest_snapshot())
+
+        # The travel systems, coverage, and the two top-10 lists
+        with self.assertNumQueries(4):
+            compute_dashboard()
+
+        second = take_snapshot()
+        self.assertEqual(second, latest_snapshot())
+        self.assertEqual(2, DashboardSnapshot.objects.count())
+
+        user = User.objects.create_superuser(username='admin', password='1X<ISRUkw+tuK')
+        self.client.force_login(user)
+        response = self.client.get('/admin/home/')
+        self.assertEqual(['Metro'], response.context['travel_system_has_real_map'])
+        self.assertEqual(second.created_at, response.context['snapshot_created_at'])
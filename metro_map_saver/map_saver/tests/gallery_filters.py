@@ -0,0 +1,69 @@
+from map_saver.gallery_filters import RejectedQuery, check_filters, check_ordering
+from map_saver.models import SavedMap
+
+from django.contrib.auth.models import User
+from django.db import OperationalError
+from django.test import TestCase
+
+from unittest import mock
+
+
+class GalleryFiltersTest(TestCase):
+
+    """ Test that the admin gallery only runs filters it can run cheaply
+    """
+
+    def setUp(self):
+        user = User.objects.create_superuser(username='admin', password='1X<ISRUkw+tuK')
+        self.client.force_login(user)
+        self.small = SavedMap.objects.create(urlhash='small', station_count=5)
+        self.large = SavedMap.objects.create(urlhash='large', station_count=50)
+
+    def test_check_filters(self):
+        check_filters({
+            'gallery_visible': '0',
+            'station_count__lte': '10',
+            'activitylog__user': '1',
+            'city__name': 'Washington',
+            'family_membership__family': '1',
+        })
+        for key in ('stations__icontains', 'mapdata', 'created_at__date', 'activitylog__action', 'name__regex'):
+            with self.assertRaises(RejectedQuery):
+                check_filters({key: 'x'})
+
+    def test_check_ordering(self):
+        check_ordering('-likes')
+        with self.assertRaises(RejectedQuery):
+            check_ordering('mapdata')
+
+    def test_allowed_filter(self):
+        response = self.client.get('/admin/gallery/', {'station_count__lte': 10})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(['small'], [saved_map.urlhash for saved_map in response.context['saved_maps']])
+
+    def test_rejected(self):
+        for params in (
+            {'stations__icontains': 'Metro'},
+            {'station_count__lte': 'many'},
+            {'order_by': 'stations'},
+        ):
+            response = self.client.get('/admin/gallery/', params)
+            self.assertEqual(400, response.status_code, params)
+            self.assertEqual([], response.context['saved_maps'])
+            self.assertTrue(response.context['error'])
+
+    def test_too_expensive(self):
+        with mock.patch('map_saver.gallery_filters.estimated_cost', return_value=10 ** 9):
+            response = self.client.get('/admin/gallery/', {'station_count__lte': 10})
+        self.assertEqual(400, response.status_code)
+        self.assertContains(response, 'too expensive', status_code=400)
+
+        # The unfiltered gallery doesn't need an estimate
+        with mock.patch('map_saver.gallery_filters.estimated_cost', return_value=10 ** 9) as estimated_cost:
+            self.assertEqual(200, self.client.get('/admin/gallery/').status_code)
+        estimated_cost.assert_not_called()
+
+    def test_timed_out(self):
+        with mock.patch('map_saver.views.paginate', side_effect=OperationalError(3024, 'Query execution was interrupted')):
+            response = self.client.get('/admin/gallery/', {'station_count__lte': 10})
+        self.assertContains(response, 'took too long', status_code=503)
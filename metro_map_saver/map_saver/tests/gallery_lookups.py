@@ -0,0 +1,92 @@
+from citysuggester.models import TravelSystem
+from map_saver.gallery_lookups import GalleryLookups
+from map_saver.models import SavedMap
+from moderate.models import ActivityLog
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.template import Context, Template
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from taggit.models import Tag
+
+
+class GalleryLookupsTest(TestCase):
+
+    """ Test that the admin gallery's per-card lookups are done once per page
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_superuser(username='admin', password='1X<ISRUkw+tuK')
+        self.client.force_login(self.user)
+        Tag.objects.create(name='real', slug='real')
+        Tag.objects.create(name='speculative', slug='speculative')
+        TravelSystem.objects.create(name='Washington, DC', stations='\n'.join(f'dc{index}' for index in range(10)))
+
+        for urlhash, name, tag in (
+            ('public1', 'Washington', 'real'),
+            ('public2', 'Washington (real)', 'real'),
+            ('public3', 'Greater Washington', 'speculative'),
+            ('public4', 'Baltimore', 'real'),
+        ):
+            public = SavedMap.objects.create(urlhash=urlhash, name=name, publicly_visible=True, gallery_visible=False)
+            public.tags.add(tag)
+
+        self.named = SavedMap.objects.create(urlhash='named', name='Washington (fantasy)')
+        self.suggested = SavedMap.objects.create(urlhash='suggest', suggested_city='Washington')
+        ActivityLog.objects.create(user=self.user, savedmap=self.named, action='named')
+
+    def render(self, template, **context):
+        return Template('{% load admin_gallery_tags %}' + template).render(Context(context))
+
+    def test_same_as_per_card_queries(self):
+        lookups = GalleryLookups([self.named, self.suggested], Tag.objects.all())
+        self.assertEqual(1, self.named.activity_count)
+        self.assertEqual(0, self.suggested.activity_count)
+
+        for template, expected in (
+            ('{{ map|existing_maps:"real" }}', '1'),
+            ('{% find_existing_maps "Washington" "real" %}', '2'),
+            ('{% find_existing_maps "Washington, DC" "speculative" %}', '1'),
+            ('{% stations_in_travelsystem "Washington" %}', '10'),
+        ):
+            per_card = self.render(template, map=SavedMap.objects.get(pk=self.named.pk))
+            self.assertEqual(expected, per_card, template)
+            self.assertEqual(per_card, self.render(template, map=self.named, gallery_lookups=lookups), template)
+
+        # Every card's lookups are answered from the same two queries
+        with self.assertNumQueries(0):
+            for saved_map in (self.named, self.suggested):
+                for tag in ('real', 'speculative'):
+                    lookups.existing_maps(saved_map.name, tag)
+                    lookups.find_existing_maps(saved_map.suggested_city or 'Washington', tag)
+                lookups.stations_in_travelsystem(saved_map.suggested_city or 'Washington')
+
+    def test_only_names_on_the_page(self):
+        public = SavedMap.objects.create(urlhash='public5', name='washington metro', publicly_visible=True)
+        public.tags.add('real')
+        lookups = GalleryLookups([self.named, self.suggested], Tag.objects.all())
+
+        # Baltimore isn't named on this page
+        self.assertNotIn(('Baltimore', 'real'), lookups.public_names)
+        self.assertIn(('Greater Washington', 'speculative'), lookups.public_names)
+        # Case-sensitive, like name__contains on MySQL
+        self.assertEqual(2, lookups.find_existing_maps('Washington', 'real'))
+        # Other names still get counted, with a query of their own
+        with self.assertNumQueries(1):
+            self.assertEqual(1, lookups.find_existing_maps('Baltimore', 'real'))
+
+    def test_gallery_queries_per_page(self):
+        def gallery_queries():
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/admin/gallery/', {'per_page': 100})
+            self.assertEqual(200, response.status_code)
+            return len(queries)
+
+        queries = gallery_queries()
+        for index in range(10):
+            saved_map = SavedMap.objects.create(urlhash=f'more{index}', name='Washington', suggested_city='Washington')
+            ActivityLog.objects.create(user=self.user, savedmap=saved_map, action='named')
+        self.assertEqual(queries, gallery_queries())
@@ -0,0 +1,119 @@
+from map_saver.mapdiff import diff_maps, diff_overlay_svg, has_changes
+from map_saver.models import SavedMap
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+import copy
+import json
+
+
+V3_MAP = {
+    'global': {
+        'data_version': 3,
+        'lines': {
+            'bd1038': {'displayName': 'Red Line'},
+            '0896d7': {'displayName': 'Blue Line'},
+        },
+        'style': {'mapLineWidth': 1, 'mapLineStyle': 'solid'},
+    },
+    'points_by_color': {
+        'bd1038': {'1-solid': {'1': {'1': 1, '2': 1, '3': 1}}},
+        '0896d7': {'1-solid': {'5': {'1': 1}, '6': {'1': 1}}},
+    },
+    'stations': {
+        '1': {'1': {'name': 'Fort_Totten'}, '3': {'name': 'Takoma'}},
+        '5': {'1': {'name': 'Metro_Center'}},
+    },
+}
+
+
+class MapDiffTest(TestCase):
+
+    """ Test the structural diff between two maps
+    """
+
+    def setUp(self):
+        self.before = copy.deepcopy(V3_MAP)
+        self.after = copy.deepcopy(V3_MAP)
+
+    def test_identical(self):
+        diff = diff_maps(self.before, self.after)
+        self.assertFalse(has_changes(diff))
+
+    def test_points(self):
+        del self.after['points_by_color']['bd1038']['1-solid']['1']['3']
+        self.after['points_by_color']['bd1038']['1-solid']['2'] = {'3': 1}
+        self.after['points_by_color']['0896d7']['3-dashed'] = {'6': {'2': 1}}
+
+        diff = diff_maps(self.before, self.after)
+        self.assertEqual([
+            {'color': '0896d7', 'width_style': '3-dashed', 'added': [(6, 2)], 'removed': []},
+            {'color': 'bd1038', 'width_style': '1-solid', 'added': [(2, 3)], 'removed': [(1, 3)]},
+        ], diff['points'])
+        self.assertTrue(has_changes(diff))
+
+    def test_lines_and_style(self):
+        self.after['global']['lines']['bd1038']['displayName'] = 'Orange Line'
+        del self.after['global']['lines']['0896d7']
+        self.after['global']['style']['mapLineWidth'] = 0.5
+
+        diff = diff_maps(self.before, self.after)
+        self.assertEqual([
+            {'color': '0896d7', 'before': {'displayName': 'Blue Line'}, 'after': None},
+            {'color': 'bd1038', 'before': {'displayName': 'Red Line'}, 'after': {'displayName': 'Orange Line'}},
+        ], diff['lines'])
+        self.assertEqual(0.5, diff['style']['after']['mapLineWidth'])
+
+    def test_stations(self):
+        self.after['stations']['1']['1']['name'] = 'Fort_Totten_Station'
+        # Takoma moved
+        del self.after['stations']['1']['3']
+        self.after['stations']['6'] = {'1': {'name': 'Takoma'}}
+        self.after['stations']['1']['2'] = {'name': 'Brookland'}
+        self.after['stations']['5']['1']['orientation'] = 180
+
+        stations = diff_maps(self.before, self.after)['stations']
+        self.assertEqual([{'xy': (1, 2), 'name': 'Brookland'}], stations['added'])
+        self.assertEqual([], stations['removed'])
+        self.assertEqual([{'name': 'Takoma', 'from': (1, 3), 'to': (6, 1)}], stations['moved'])
+        self.assertEqual([{'xy': (1, 1), 'before': 'Fort_Totten', 'after': 'Fort_Totten_Station'}], stations['renamed'])
+        self.assertEqual([(5, 1)], [station['xy'] for station in stations['restyled']])
+
+    def test_overlay(self):
+        del self.after['points_by_color']['bd1038']['1-solid']['1']['3']
+        self.after['points_by_color']['bd1038']['1-solid']['2'] = {'3': 1}
+        self.after['stations']['1']['2'] = {'name': 'Brookland'}
+
+        overlay = diff_overlay_svg(diff_maps(self.before, self.after))
+        self.assertIn('viewBox="0 0 80 80"', overlay)
+        self.assertIn('<rect class="added" x="1.5" y="2.5" width="1" height="1"/>', overlay)
+        self.assertIn('<rect class="removed" x="0.5" y="2.5" width="1" height="1"/>', overlay)
+        self.assertIn('<rect class="station" x="0.25" y="1.25" width="1.5" height="1.5"/>', overlay)
+
+    def test_view(self):
+        user = User.objects.create_superuser(username='admin', password='1X<ISRUkw+tuK')
+        self.client.force_login(user)
+
+        self.after['stations']['1']['1']['name'] = 'Fort_Totten_Station'
+        SavedMap.objects.create(urlhash='before', data=self.before)
+        SavedMap.objects.create(urlhash='after', data=self.after)
+        # A v1 map, upgraded to v3 to compare
+        SavedMap.objects.create(urlhash='classic', mapdata=json.dumps({
+            '1': {'1': {'line': 'bd1038', 'station': {'name': 'Fort_Totten'}}},
+            'global': {'lines': {'bd1038': {'displayName': 'Red Line'}}},
+        }))
+
+        response = self.client.get('/admin/diff/before/after/')
+        self.assertContains(response, 'Fort_Totten &rarr; Fort_Totten_Station')
+        self.assertNotIn('overlay', response.context)
+
+        response = self.client.get('/admin/diff/before/after/', {'overlay': 1})
+        self.assertContains(response, 'class="diff-overlay"')
+
+        response = self.client.get('/admin/diff/classic/before/')
+        self.assertTrue(response.context['has_changes'])
+        self.assertEqual(['Metro_Center', 'Takoma'], sorted(station['name'] for station in response.context['diff']['stations']['added']))
+
+        response = self.client.get('/admin/diff/before/missing0/')
+        self.assertContains(response, 'does not exist')
@@ -0,0 +1,94 @@
+from map_saver.models import SavedMap
+from map_saver.pagination import paginate
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.http import Http404
+from django.test import RequestFactory, TestCase
+
+
+class KeysetPaginationTest(TestCase):
+
+    """ Test paging by cursor instead of by OFFSET
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        # Ties in likes, so the id has to break them
+        for index, likes in enumerate([5, 3, 3, 3, 1, 1, 0]):
+            SavedMap.objects.create(urlhash=f'map{index}', likes=likes, gallery_visible=True)
+        self.expected = list(SavedMap.objects.order_by('-likes', '-id').values_list('urlhash', flat=True))
+
+    def page(self, **params):
+        request = self.factory.get('/', params)
+        return paginate(request, SavedMap.objects.all(), ('-likes', '-id'), 3)
+
+    def urlhashes(self, page):
+        return [saved_map.urlhash for saved_map in page.object_list]
+
+    def test_walk_forward_and_back(self):
+        first = self.page()
+        self.assertEqual(self.expected[:3], self.urlhashes(first))
+        self.assertFalse(first.previous_cursor)
+
+        second = self.page(after=first.next_cursor)
+        self.assertEqual(self.expected[3:6], self.urlhashes(second))
+        self.assertIsNone(second.number)
+
+        third = self.page(after=second.next_cursor)
+        self.assertEqual(self.expected[6:], self.urlhashes(third))
+        self.assertFalse(third.has_next())
+
+        self.assertEqual(self.expected[3:6], self.urlhashes(self.page(before=third.previous_cursor)))
+        self.assertEqual(self.expected[:3], self.urlhashes(self.page(before=second.previous_cursor)))
+
+    def test_last_page(self):
+        last = self.page(page='last')
+        self.assertEqual(self.expected[-3:], self.urlhashes(last))
+        self.assertFalse(last.has_next())
+        self.assertTrue(last.has_previous())
+
+    def test_numbered_pages(self):
+        second = self.page(page=2)
+        self.assertEqual(self.expected[3:6], self.urlhashes(second))
+        self.assertEqual(self.expected[6:], self.urlhashes(self.page(after=second.next_cursor)))
+
+    def test_cursor_page_cost(self):
+        cursor = self.page(page=2).next_cursor
+        with self.assertNumQueries(1):
+            self.assertEqual(self.expected[6:], self.urlhashes(self.page(after=cursor)))
+
+    def test_cached_count(self):
+        self.assertEqual(7, self.page().paginator.count)
+        SavedMap.objects.create(urlhash='another')
+        with self.assertNumQueries(0):
+            self.assertEqual(7, self.page().paginator.count)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(Http404):
+            self.page(after='not a cursor')
+
+    def test_gallery(self):
+        user = User.objects.create_superuser(username='admin', password='1X<ISRUkw+tuK')
+        self.client.force_login(user)
+
+        response = self.client.get('/admin/gallery/', {'order_by': '-likes', 'per_page': 3})
+        first = response.context['saved_maps']
+        self.assertEqual(self.expected[:3], self.urlhashes(first))
+        self.assertContains(response, f'?after={first.next_cursor}')
+
+        response = self.client.get('/admin/gallery/', {'order_by': '-likes', 'per_page': 3, 'after': first.next_cursor})
+        self.assertEqual(self.expected[3:6], self.urlhashes(response.context['saved_maps']))
+        self.assertEqual({'order_by': '-likes', 'per_page': 3}, response.context['args'])
+        self.assertEqual(7, response.context['maps_total'])
+
+        # Orderings that can't use a cursor still page by number
+        response = self.client.get('/admin/gallery/', {'order_by': 'svg', 'per_page': 3, 'page': 2})
+        self.assertEqual(2, response.context['saved_maps'].number)
+        self.assertIsNone(response.context['saved_maps'].next_cursor)
+
+    def test_listing_views(self):
+        response = self.client.get('/best/', {'page': 'last'})
+        self.assertEqual(self.expected[:-1], [saved_map.urlhash for saved_map in response.context['maps']])
+        self.assertFalse(response.context['page_obj'].has_other_pages())
@@ -0,0 +1,183 @@
+import gzip
+import json
+from unittest import mock
+
+from map_saver.caching import resolve_urlhash
+from map_saver.models import SavedMap
+
+from django.core.cache import cache
+from django.test import TestCase, Client, AsyncClient
+
+
+class SaveMapTest(TestCase):
+
+    """ Test the /save/ endpoint beyond validation
+    """
+
+    metro_map = json.dumps({
+        "global": {"data_version": 3, "lines": {"bd1038": {"displayName": "Red Line"}}},
+        "points_by_color": {"bd1038": {"1-solid": {"1": {"1": 1, "2": 1}, "2": {"1": 1}}}},
+        "stations": {"1": {"1": {"name": "Fort_Totten"}}},
+    })
+
+    def setUp(self):
+        cache.clear()
+
+    def _post_metromap(self, metro_map):
+        response = Client().post('/save/', {'metroMap': metro_map})
+        return response.content.decode('utf-8').strip()
+
+    def test_repeated_save_skips_validation(self):
+
+        """ Confirm that posting the exact same payload twice
+                returns the same urlhash without validating it again,
+                and without handing out the naming token a second time
+        """
+
+        urlhash, naming_token = self._post_metromap(self.metro_map).split(',')
+        self.assertTrue(naming_token)
+        self.assertEqual(1, SavedMap.objects.filter(urlhash=urlhash).count())
+
+        with mock.patch('map_saver.views.CreateMapForm') as form:
+            response = self._post_metromap(self.metro_map)
+            form.assert_not_called()
+
+        self.assertEqual(f'{urlhash},', response)
+        self.assertEqual(1, SavedMap.objects.filter(urlhash=urlhash).count())
+
+    def test_repeated_save_of_deleted_map(self):
+
+        """ Confirm that a payload whose map has been deleted since is saved again
+        """
+
+        urlhash, _ = self._post_metromap(self.metro_map).split(',')
+        SavedMap.objects.get(urlhash=urlhash).delete()
+
+        urlhash, naming_token = self._post_metromap(self.metro_map).split(',')
+        self.assertTrue(naming_token)
+        self.assertEqual(1, SavedMap.objects.filter(urlhash=urlhash).count())
+
+    async def test_async_repeated_save_of_deleted_map(self):
+        client = AsyncClient()
+        response = await client.post('/async/save/', {'metroMap': self.metro_map})
+        urlhash, _ = response.content.decode('utf-8').strip().split(',')
+        await (await SavedMap.objects.aget(urlhash=urlhash)).adelete()
+
+        response = await client.post('/async/save/', {'metroMap': self.metro_map})
+        urlhash, naming_token = response.content.decode('utf-8').strip().split(',')
+        self.assertTrue(naming_token)
+        self.assertEqual(1, await SavedMap.objects.filter(urlhash=urlhash).acount())
+
+    def test_invalid_payload_not_remembered(self):
+
+        """ Confirm that a payload that fails validation is validated (and rejected) every time
+        """
+
+        invalid = json.dumps({"global": {"data_version": 3}})
+        self.assertIn('[ERROR]', self._post_metromap(invalid))
+        self.assertIn('[ERROR]', self._post_metromap(invalid))
+
+    def test_load_serves_stored_payload(self):
+
+        """ Confirm loading a map serves the payload stored when it was saved,
+                gzipped for clients that accept it,
+                and that a matching If-None-Match gets a 304
+        """
+
+        urlhash, _ = self._post_metromap(self.metro_map).split(',')
+        saved_map = SavedMap.objects.get(urlhash=urlhash)
+        self.assertTrue(saved_map.payload_etag)
+
+        client = Client()
+        response = client.get(f'/load/{urlhash}')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(saved_map.data, json.loads(response.content))
+        self.assertEqual(f'"{saved_map.payload_etag}"', response['ETag'])
+        self.assertIn('immutable', response['Cache-Control'])
+
+        gzipped = client.get(f'/load/{urlhash}', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual('gzip', gzipped['Content-Encoding'])
+        self.assertEqual(response.content, gzip.decompress(gzipped.content))
+        self.assertNotEqual(response['ETag'], gzipped['ETag'])
+
+        not_modified = client.get(f'/load/{urlhash}', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, not_modified.status_code)
+        self.assertFalse(not_modified.content)
+
+        not_modified = client.get(f'/load/{urlhash}', HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=gzipped['ETag'])
+        self.assertEqual(304, not_modified.status_code)
+
+    def test_load_builds_missing_payload(self):
+
+        """ Confirm maps saved before payloads were stored get one the first time they're loaded
+        """
+
+        urlhash, _ = self._post_metromap(self.metro_map).split(',')
+        SavedMap.objects.filter(urlhash=urlhash).update(payload_gzip=None, payload_etag='')
+
+        response = Client().get(f'/load/{urlhash}')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('Fort_Totten', json.loads(response.content)['stations']['1']['1']['name'])
+        self.assertTrue(SavedMap.objects.get(urlhash=urlhash).payload_etag)
+
+        response = Client().get('/load/notfound')
+        self.assertIn('[ERROR] The requested map does not exist', response.content.decode('utf-8'))
+        # Pages without an ETag of their own aren't hashed to make one up
+        self.assertNotIn('ETag', response)
+
+    def test_resolve_urlhash(self):
+
+        """ Confirm unknown urlhashes are remembered as missing
+                until a map with that urlhash is saved,
+                and known ones are answered without a query
+        """
+
+        self.assertIsNone(resolve_urlhash('nosuchmp'))
+        with self.assertNumQueries(0):
+            self.assertIsNone(resolve_urlhash('nosuchmp'))
+            response = Client().get('/load/nosuchmp')
+            self.assertContains(response, 'The requested map does not exist')
+
+        saved_map = SavedMap.objects.create(urlhash='nosuchmp', mapdata='{"global": {"lines": {}}}')
+        self.assertEqual(saved_map.pk, resolve_urlhash('nosuchmp')['pk'])
+
+        # If more than one map has the same urlhash, the earliest wins
+        SavedMap.objects.create(urlhash='nosuchmp', mapdata='{"global": {"lines": {}}}')
+        self.assertEqual(saved_map.pk, resolve_urlhash('nosuchmp')['pk'])
+        with self.assertNumQueries(0):
+            self.assertEqual(saved_map.pk, resolve_urlhash('nosuchmp')['pk'])
+
+        # The ETag check for a known map doesn't need the database either
+        saved_map = SavedMap.objects.create(urlhash='etagmap', mapdata='{"global": {"lines": {}}}')
+        resolve_urlhash('etagmap')
+        with self.assertNumQueries(0):
+            response = Client().get('/load/etagmap', HTTP_IF_NONE_MATCH=f'"{saved_map.payload_etag}"')
+            self.assertEqual(304, response.status_code)
+
+    async def test_async_save_and_load(self):
+
+        """ Confirm the async endpoints save and load maps the same way the WSGI ones do
+        """
+
+        client = AsyncClient()
+        response = await client.post('/async/save/', {'metroMap': self.metro_map})
+        urlhash, naming_token = response.content.decode('utf-8').strip().split(',')
+        self.assertTrue(naming_token)
+
+        saved_map = await SavedMap.objects.aget(urlhash=urlhash)
+        self.assertEqual(3, saved_map.data['global']['data_version'])
+        self.assertEqual('fort_totten', saved_map.stations)
+
+        response = await client.get(f'/async/load/{urlhash}')
+        self.assertEqual(saved_map.data, json.loads(response.content))
+
+        # Both serve the stored payload, so they have the same ETags
+        for headers in ({}, {'Accept-Encoding': 'gzip'}):
+            response = await client.get(f'/async/load/{urlhash}', headers=headers)
+            self.assertEqual((await client.get(f'/load/{urlhash}', headers=headers))['ETag'], response['ETag'])
+            not_modified = await client.get(f'/async/load/{urlhash}', headers={'If-None-Match': response['ETag'], **headers})
+            self.assertEqual(304, not_modified.status_code)
+        self.assertEqual('gzip', response['Content-Encoding'])
+
+        response = await client.get('/async/load/notfound')
+        self.assertIn('[ERROR] The requested map does not exist', response.content.decode('utf-8'))
@@ -0,0 +1,330 @@
+from map_saver.models import MapFamily, MapGridHash, MapSimilarityBand, MapStation, SavedMap
+from map_saver.similarity import (
+    band_buckets,
+    candidate_pks,
+    grid_hash,
+    hamming_distance,
+    minhash,
+    occupied_points,
+    station_set,
+    visually_similar,
+    BANDS,
+)
+from map_saver.station_index import maps_with_station, search_stations
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from io import StringIO
+from unittest import mock
+
+import datetime
+
+
+def stations(names):
+    return ','.join(names)
+
+
+def v3_data(points, offset=0):
+    xys = {}
+    for x, y in points:
+        xys.setdefault(str(x + offset), {})[str(y + offset)] = 1
+    return {'global': {'data_version': 3}, 'points_by_color': {'bd1038': {'1-solid': xys}}, 'stations': {}}
+
+
+class MapSimilarityTest(TestCase):
+
+    """ Test finding maps with nearly the same stations through the MinHash band index
+    """
+
+    def setUp(self):
+        self.base_stations = [f'station {index}' for index in range(50)]
+        self.this_map = SavedMap.objects.create(urlhash='original', stations=stations(self.base_stations), gallery_visible=True)
+        # One station renamed: nearly the same map
+        self.copy = SavedMap.objects.create(urlhash='copy', stations=stations(self.base_stations[:-1] + ['renamed']), gallery_visible=True)
+        self.unrelated = SavedMap.objects.create(urlhash='unrelated', stations=stations(f'other {index}' for index in range(50)), gallery_visible=True)
+        self.no_stations = SavedMap.objects.create(urlhash='empty')
+
+    def test_minhash(self):
+        self.assertIsNone(minhash(set()))
+        signature = minhash(station_set(self.this_map.stations))
+        self.assertEqual(signature, minhash(station_set(self.this_map.stations)))
+        self.assertEqual(BANDS, len(band_buckets(signature)))
+        for _, bucket in band_buckets(signature):
+            self.assertTrue(0 <= bucket < 2 ** 63)
+
+    def test_indexed_on_save(self):
+        self.assertEqual(BANDS, MapSimilarityBand.objects.filter(savedmap=self.this_map).count())
+        self.assertFalse(MapSimilarityBand.objects.filter(savedmap=self.no_stations).exists())
+        self.assertIsNone(self.no_stations.stations_minhash)
+
+        candidates = candidate_pks(self.this_map)
+        self.assertIn(self.copy.pk, candidates)
+        self.assertNotIn(self.unrelated.pk, candidates)
+        self.assertNotIn(self.this_map.pk, candidates)
+
+        # Ranked by how many buckets they share, and capped
+        exact_copy = SavedMap.objects.create(urlhash='exact', stations=self.this_map.stations)
+        self.assertEqual([exact_copy.pk], candidate_pks(self.this_map, limit=1))
+        self.assertEqual([self.copy.pk], candidate_pks(self.this_map, among=SavedMap.objects.exclude(pk=exact_copy.pk), limit=1))
+        exact_copy.delete()
+
+        # Changing the stations re-indexes
+        self.unrelated.stations = self.this_map.stations
+        self.unrelated.save()
+        self.assertIn(self.unrelated.pk, candidate_pks(self.this_map))
+
+    def test_unchanged_stations_not_reindexed(self):
+        band_pks = set(MapSimilarityBand.objects.filter(savedmap=self.this_map).values_list('pk', flat=True))
+        self.this_map.name = 'Renamed'
+        self.this_map.save()
+        self.assertEqual(band_pks, set(MapSimilarityBand.objects.filter(savedmap=self.this_map).values_list('pk', flat=True)))
+
+        # Not even recomputed, unless the stations or data were replaced
+        saved_map = SavedMap.objects.get(pk=self.this_map.pk)
+        with mock.patch.object(SavedMap, 'update_stations_minhash') as update_stations_minhash, \
+                mock.patch.object(SavedMap, 'update_grid_hash') as update_grid_hash:
+            saved_map.name = 'Renamed again'
+            saved_map.save()
+            saved_map.save(update_fields=['name'])
+        update_stations_minhash.assert_not_called()
+        update_grid_hash.assert_not_called()
+
+        saved_map.stations = self.unrelated.stations
+        saved_map.save(update_fields=['stations'])
+        self.assertEqual(self.unrelated.stations_minhash, SavedMap.objects.get(pk=saved_map.pk).stations_minhash)
+        self.assertIn(self.unrelated.pk, candidate_pks(saved_map))
+
+    def test_similar_view(self):
+        user = User.objects.create_superuser(username='admin', password='1X<ISRUkw+tuK')
+        self.client.force_login(user)
+
+        response = self.client.get('/admin/similar/original')
+        self.assertEqual(['original', 'copy'], [saved_map.urlhash for saved_map in response.context['saved_maps']])
+        self.assertIn('copy', response.context['similarity_scores'])
+
+        # Maps saved before the index existed are indexed when they're looked at
+        MapSimilarityBand.objects.all().delete()
+        SavedMap.objects.update(stations_minhash=None)
+        cache.clear()
+        response = self.client.get('/admin/similar/original')
+        self.assertEqual(BANDS, MapSimilarityBand.objects.filter(savedmap=self.this_map).count())
+        # The copy isn't indexed yet, so it can't be a candidate
+        self.assertEqual(['original'], [saved_map.urlhash for saved_map in response.context['saved_maps']])
+
+    def test_index_maps(self):
+        MapSimilarityBand.objects.all().delete()
+        SavedMap.objects.update(stations_minhash=None)
+
+        output = StringIO()
+        call_command('index_maps', '--index', 'minhash', '--chunk-size', '2', stdout=output, skip_checks=True)
+        self.assertIn('Built the minhash index for 3 of 4 maps', output.getvalue())
+        self.assertEqual(BANDS * 3, MapSimilarityBand.objects.count())
+        self.assertIn(self.copy.pk, candidate_pks(SavedMap.objects.get(pk=self.this_map.pk)))
+
+        output = StringIO()
+        call_command('index_maps', stdout=output, skip_checks=True)
+        self.assertIn('Built the minhash index for 0 of 4 maps', output.getvalue())
+
+        output = StringIO()
+        call_command('index_maps', '--reindex', '--start', str(self.copy.pk), stdout=output, skip_checks=True)
+        self.assertIn('Built the minhash index for 2 of 2 maps', output.getvalue())
+        self.assertEqual(BANDS * 3, MapSimilarityBand.objects.count())
+
+
+class MapGridHashTest(TestCase):
+
+    """ Test finding maps that look alike by the grid hash of where their lines are
+    """
+
+    def setUp(self):
+        # An L and a diagonal
+        self.points = [(x, 10) for x in range(10, 60)] + [(10, y) for y in range(10, 60)]
+        self.points += [(n, n) for n in range(20, 60)]
+        self.this_map = SavedMap.objects.create(urlhash='original', data=v3_data(self.points), gallery_visible=True)
+        # Same lines, moved over
+        self.copy = SavedMap.objects.create(urlhash='copy', data=v3_data(self.points, offset=5), gallery_visible=True)
+        # Nearly the same lines
+        self.edited = SavedMap.objects.create(urlhash='edited', data=v3_data(self.points[:-2]), gallery_visible=True)
+        self.unrelated = SavedMap.objects.create(urlhash='unrelated', data=v3_data([(x, 70 - x // 2) for x in range(0, 70)]), gallery_visible=True)
+        self.empty = SavedMap.objects.create(urlhash='empty', gallery_visible=True)
+
+    def test_grid_hash(self):
+        self.assertIsNone(grid_hash(set()))
+        self.assertEqual(set(self.points), occupied_points(self.this_map.data))
+        v1_data = {'10': {'10': {'line': 'bd1038'}, '11': {}}, 'global': {'lines': {}}}
+        self.assertEqual({(10, 10)}, occupied_points(v1_data))
+        self.assertEqual(self.this_map.grid_hash, self.copy.grid_hash)
+        self.assertTrue(-2 ** 63 <= self.this_map.grid_hash < 2 ** 63)
+        self.assertLess(3, hamming_distance(self.this_map.grid_hash, self.unrelated.grid_hash))
+
+    def test_indexed_on_save(self):
+        self.assertEqual(4, MapGridHash.objects.count())
+        self.assertIsNone(self.empty.grid_hash)
+
+        distances = visually_similar(self.this_map)
+        self.assertEqual(0, distances[self.copy.pk])
+        self.assertIn(self.edited.pk, distances)
+        self.assertNotIn(self.unrelated.pk, distances)
+        self.assertNotIn(self.this_map.pk, distances)
+
+        self.unrelated.data = self.this_map.data
+        self.unrelated.save()
+        self.assertEqual(0, visually_similar(self.this_map)[self.unrelated.pk])
+
+    def test_visually_similar_view(self):
+        user = User.objects.create_superuser(username='admin', password='1X<ISRUkw+tuK')
+        self.client.force_login(user)
+
+        response = self.client.get('/admin/similar/original/visual')
+        urlhashes = [saved_map.urlhash for saved_map in response.context['saved_maps']]
+        self.assertEqual('original', urlhashes[0])
+        self.assertEqual({'copy', 'edited'}, set(urlhashes[1:]))
+        self.assertEqual(0, response.context['grid_distances']['copy'])
+        self.assertContains(response, 'View Lookalikes')
+
+    def test_index_maps(self):
+        MapGridHash.objects.all().delete()
+        SavedMap.objects.update(grid_hash=None)
+
+        output = StringIO()
+        call_command('index_maps', '--index', 'grid', stdout=output, skip_checks=True)
+        self.assertIn('Built the grid index for 4 of 5 maps', output.getvalue())
+        self.assertEqual(4, MapGridHash.objects.count())
+        self.assertIn(self.copy.pk, visually_similar(SavedMap.objects.get(pk=self.this_map.pk)))
+
+
+class StationIndexTest(TestCase):
+
+    """ Test finding maps by their station names
+    """
+
+    def setUp(self):
+        self.public = SavedMap.objects.create(urlhash='public', name='Metro', stations='fort_totten,forest_glen,glenmont', publicly_visible=True)
+        self.also_public = SavedMap.objects.create(urlhash='alsopub', stations='fort_totten,takoma', publicly_visible=True)
+        self.hidden = SavedMap.objects.create(urlhash='hidden', stations='fort_totten,fort_worth')
+
+    def test_indexed_on_save(self):
+        self.assertEqual(
+            ['forest glen', 'fort totten', 'glenmont'],
+            list(MapStation.objects.filter(savedmap=self.public).order_by('name').values_list('name', flat=True)),
+        )
+        self.public.stations = 'fort_totten,silver_spring'
+        self.public.save()
+        self.assertEqual(
+            ['fort totten', 'silver spring'],
+            list(MapStation.objects.filter(savedmap=self.public).order_by('name').values_list('name', flat=True)),
+        )
+
+        self.hidden.delete()
+        self.assertFalse(MapStation.objects.filter(name='fort worth').exists())
+
+    def test_search(self):
+        self.assertEqual(
+            [{'name': 'fort totten', 'maps': 2}],
+            search_stations('Fort'),
+        )
+        self.assertEqual(
+            [{'name': 'fort totten', 'maps': 3}, {'name': 'fort worth', 'maps': 1}],
+            search_stations('fort', publicly_visible=False),
+        )
+        self.assertEqual(['alsopub', 'public'], sorted(maps_with_station('Fort Totten').values_list('urlhash', flat=True)))
+        self.assertEqual(['alsopub', 'public'], sorted(maps_with_station('fort_totten').values_list('urlhash', flat=True)))
+        self.assertEqual([{'name': 'fort totten', 'maps': 2}], search_stations('Fort Tot'))
+        self.assertEqual([{'name': 'fort totten', 'maps': 2}], search_stations('fort_tot'))
+
+    def test_search_view(self):
+        response = self.client.get('/stations/', {'q': 'for'})
+        self.assertEqual(
+            [{'name': 'fort totten', 'maps': 2}, {'name': 'forest glen', 'maps': 1}],
+            response.json()['stations'],
+        )
+        self.assertEqual(400, self.client.get('/stations/', {'q': 'fo'}).status_code)
+
+        response = self.client.get('/stations/', {'station': 'glenmont'})
+        self.assertEqual([{'urlhash': 'public', 'name': 'Metro', 'url': '/map/public'}], response.json()['maps'])
+
+        user = User.objects.create_superuser(username='admin', password='1X<ISRUkw+tuK')
+        self.client.force_login(user)
+        response = self.client.get('/stations/', {'station': 'fort worth'})
+        self.assertEqual(['hidden'], [saved_map['urlhash'] for saved_map in response.json()['maps']])
+
+    def test_index_maps(self):
+        MapStation.objects.all().delete()
+        output = StringIO()
+        call_command('index_maps', '--index', 'stations', stdout=output, skip_checks=True)
+        self.assertIn('Built the stations index for 3 of 3 maps', output.getvalue())
+        self.assertEqual(7, MapStation.objects.count())
+
+
+class MapFamilyTest(TestCase):
+
+    """ Test grouping the versions of a map into families
+    """
+
+    def setUp(self):
+        self.base_stations = [f'station {index}' for index in range(50)]
+        self.first = SavedMap.objects.create(urlhash='first', stations=stations(self.base_stations), gallery_visible=True)
+        self.second = SavedMap.objects.create(urlhash='second', stations=stations(self.base_stations + ['new']), gallery_visible=True)
+        self.third = SavedMap.objects.create(urlhash='third', stations=stations(self.base_stations[:-1]), gallery_visible=True)
+        self.unrelated = SavedMap.objects.create(urlhash='unrelated', stations=stations(f'other {index}' for index in range(50)), gallery_visible=True)
+        # Same stations, but saved long after
+        self.much_later = SavedMap.objects.create(urlhash='later', stations=stations(self.base_stations), gallery_visible=True)
+        SavedMap.objects.filter(pk=self.much_later.pk).update(created_at=timezone.now() + datetime.timedelta(days=30))
+        self.no_stations = SavedMap.objects.create(urlhash='empty', gallery_visible=True)
+
+    def cluster(self, *args):
+        output = StringIO()
+        call_command('cluster_families', *args, stdout=output, skip_checks=True)
+        return output.getvalue()
+
+    def test_cluster_families(self):
+        self.assertIn('Clustered 6 maps (2 joined an existing family)', self.cluster())
+
+        family = self.first.family_membership.family
+        self.assertEqual(3, family.size)
+        self.assertEqual(self.third, family.latest)
+        self.assertEqual(
+            [self.first.pk, self.second.pk, self.third.pk],
+            list(family.members.order_by('savedmap').values_list('savedmap', flat=True)),
+        )
+        self.assertEqual(4, MapFamily.objects.count())
+
+        # Incremental: only new maps are clustered
+        fourth = SavedMap.objects.create(urlhash='fourth', stations=stations(self.base_stations), gallery_visible=True)
+        self.assertIn('Clustered 1 maps (1 joined an existing family)', self.cluster())
+        family.refresh_from_db()
+        self.assertEqual((4, fourth), (family.size, family.latest))
+
+        # Deleting the latest version hands it back to the one before
+        fourth.delete()
+        family.refresh_from_db()
+        self.assertEqual((3, self.third), (family.size, family.latest))
+
+        self.assertIn('Clustered 6 maps (2 joined an existing family)', self.cluster('--rebuild'))
+
+    def test_collapsed_gallery(self):
+        self.cluster()
+        user = User.objects.create_superuser(username='admin', password='1X<ISRUkw+tuK')
+        self.client.force_login(user)
+
+        response = self.client.get('/admin/gallery/', {'collapse': 1})
+        urlhashes = {saved_map.urlhash for saved_map in response.context['saved_maps']}
+        self.assertEqual({'third', 'unrelated', 'later', 'empty'}, urlhashes)
+        self.assertEqual({'collapse': 1}, response.context['args'])
+        self.assertContains(response, 'All 3 Versions')
+
+        response = self.client.get('/admin/gallery/', {'family_membership__family': self.first.family_membership.family_id})
+        self.assertEqual(3, response.context['maps_total'])
+
+        # A family whose latest version is filtered out is represented by its latest version that isn't
+        self.third.tags.add('real')
+        response = self.client.get('/admin/gallery/notags/', {'collapse': 1})
+        urlhashes = {saved_map.urlhash for saved_map in response.context['saved_maps']}
+        self.assertEqual({'second', 'unrelated', 'later', 'empty'}, urlhashes)
+        SavedMap.objects.filter(pk=self.second.pk).update(gallery_visible=False)
+        response = self.client.get('/admin/gallery/notags/', {'collapse': 1})
+        urlhashes = {saved_map.urlhash for saved_map in response.context['saved_maps']}
+        self.assertEqual({'first', 'unrelated', 'later', 'empty'}, urlhashes)
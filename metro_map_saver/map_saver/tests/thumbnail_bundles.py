@@ -0,0 +1,108 @@
+from map_saver.models import SavedMap
+from map_saver.thumbnail_bundles import get_bundle, read_index, thumbnail_symbol
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from taggit.models import Tag
+
+from io import StringIO
+
+import shutil
+import tempfile
+
+THUMBNAIL_SVG = '''
+<svg version="1.1" xmlns="http://www.w3.org/2000/svg" viewBox="0 0 80 80"><style>line { stroke-width: 1; fill: none; } .c0 { stroke: #{color} }</style><defs><g id="wmata"><circle r="0.5"/></g></defs><line class="c0" x1="1" y1="1" x2="5" y2="1"/></svg>
+'''
+
+
+class ThumbnailBundleTest(TestCase):
+
+    """ Test bundling each tag's public thumbnails into one SVG sprite
+    """
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        cache.clear()
+
+        Tag.objects.create(name='real', slug='real')
+        Tag.objects.create(name='speculative', slug='speculative')
+        self.maps = {}
+        for urlhash, name, tag, color in (
+            ('real0001', 'Athens', 'real', 'bd1038'),
+            ('real0002', 'Boston', 'real', '0896d7'),
+            ('spec0001', 'Chicago', 'speculative', 'f0ce15'),
+        ):
+            saved_map = SavedMap.objects.create(urlhash=urlhash, name=name, publicly_visible=True)
+            saved_map.thumbnail_svg.save(f'{urlhash}.svg', ContentFile(THUMBNAIL_SVG.replace('{color}', color)))
+            saved_map.tags.add(tag)
+            self.maps[urlhash] = saved_map
+        # Not public, so not bundled
+        private = SavedMap.objects.create(urlhash='private1', name='Denver')
+        private.tags.add('real')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def build(self, *args):
+        output = StringIO()
+        call_command('build_thumbnail_bundles', *args, stdout=output)
+        return output.getvalue()
+
+    def test_thumbnail_symbol(self):
+        symbol = thumbnail_symbol('abcd1234', THUMBNAIL_SVG.replace('{color}', 'bd1038'))
+        self.assertTrue(symbol.startswith('<symbol id="tabcd1234" viewBox="0 0 80 80">'))
+        self.assertIn('#tabcd1234 line {', symbol)
+        self.assertIn('#tabcd1234 .c0 { stroke: #bd1038 }', symbol)
+        self.assertNotIn('<defs>', symbol)
+        self.assertIsNone(thumbnail_symbol('abcd1234', 'not an svg'))
+
+    def test_build_and_mark_dirty(self):
+        self.assertIsNone(get_bundle('real'))
+
+        output = self.build()
+        self.assertIn('Bundled 2 thumbnails tagged real', output)
+        self.assertIn('Bundled 1 thumbnails tagged speculative', output)
+        self.assertEqual(['real0001', 'real0002'], read_index('real')['maps'])
+        self.assertEqual({'real0001', 'real0002'}, get_bundle('real')['maps'])
+        with open(f'{self.media_root}/thumbnails/bundles/real.svg') as bundle:
+            bundle = bundle.read()
+        self.assertIn('<symbol id="treal0002"', bundle)
+        self.assertIn('#treal0002 .c0 { stroke: #0896d7 }', bundle)
+        self.assertIn('No bundles need rebuilding.', self.build())
+
+        # Untagging a public map marks only that tag's bundle dirty
+        user = User.objects.create_superuser(username='admin', password='1X<ISRUkw+tuK')
+        self.client.force_login(user)
+        self.client.post('/admin/action/', {'action': 'removetag', 'map': self.maps['real0002'].pk, 'tag': 'real'})
+        self.assertIsNone(get_bundle('real'))
+        self.assertTrue(get_bundle('speculative'))
+
+        output = self.build()
+        self.assertIn('Bundled 1 thumbnails tagged real', output)
+        self.assertNotIn('speculative', output)
+        self.assertEqual({'real0001'}, get_bundle('real')['maps'])
+
+    def test_galleries_use_bundle(self):
+        response = self.client.get('/admin/thumbnail/speculative/')
+        self.assertNotContains(response, '<use ')
+
+        self.build()
+        self.maps['spec0001'].tags.add('real')
+        # The galleries themselves are cached
+        cache.clear()
+
+        response = self.client.get('/admin/thumbnail/speculative/')
+        self.assertContains(response, 'thumbnails/bundles/speculative.svg?v=')
+        self.assertContains(response, '#tspec0001"/>')
+
+        response = self.client.get('/gallery/')
+        self.assertContains(response, '#treal0001"/>')
+        self.assertContains(response, '#treal0002"/>')
+        # Not in the bundle yet
+        self.assertNotContains(response, '#tspec0001"/>')
@@ -1,10 +1,14 @@
 import json
+import os
+import tempfile
+from io import StringIO
 from unittest import expectedFailure
 
 from map_saver.forms import CreateMapForm
 from map_saver.models import SavedMap
 from map_saver.validator import validate_metro_map
 
+from django.core.management import call_command
 from django.test import TestCase, Client
 from django.core.exceptions import ObjectDoesNotExist
 
@@ -485,6 +489,62 @@ class ValidateMapV2(TestCase):
         # But the data is the same as before
         self.assertEqual(saved_map.data, form.cleaned_data['mapdata'])
 
+    def test_convert_to_v3(self):
+
+        """ Confirm that v1 and v2 maps convert straight to v3
+                with every point drawn in the map's global line width and style
+        """
+
+        mmap_v1 = {
+            "10": {
+                "10": {"line": "008800", "station": {"name": "A", "orientation": "-135", "lines": []}},
+                "11": {"line": "008800"},
+            },
+            "12": {"10": {"line": "0896d7", "station": {"name": "B", "transfer": 1, "lines": []}}},
+            "global": {
+                "lines": {"008800": {"displayName": "Green Line"}, "0896d7": {"displayName": "Blue Line"}},
+                "style": {"mapLineWidth": 0.75, "mapStationStyle": "circles-md"},
+            },
+        }
+        v1_map = SavedMap.objects.create(urlhash='v1', mapdata=json.dumps(mmap_v1))
+
+        v2_map = SavedMap.objects.create(urlhash='v2', mapdata='', data={
+            "global": {"data_version": 2, "map_size": 80, "lines": {"bd1038": {"displayName": "Red Line"}}, "style": {"mapLineWidth": 1.0, "mapLineStyle": "dashed"}},
+            "points_by_color": {"bd1038": {"xys": {"1": {"1": 1, "2": 1}}}},
+            "stations": {"1": {"2": {"name": "C", "orientation": 0}}},
+        })
+
+        call_command('convert_to_v3', '--dry-run', '--checkpoint', os.devnull, stdout=StringIO())
+        v1_map.refresh_from_db()
+        self.assertFalse(v1_map.data)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            checkpoint = os.path.join(tmpdir, 'checkpoint')
+            call_command('convert_to_v3', '--batch-size', '1', '--checkpoint', checkpoint, stdout=StringIO())
+            with open(checkpoint) as checkpoint_file:
+                self.assertEqual(str(v2_map.pk), checkpoint_file.read())
+
+        v1_map.refresh_from_db()
+        self.assertEqual(3, v1_map.data['global']['data_version'])
+        self.assertEqual({"10": {"10": 1, "11": 1}}, v1_map.data['points_by_color']['008800']['0.75-solid'])
+        self.assertEqual({"12": {"10": 1}}, v1_map.data['points_by_color']['0896d7']['0.75-solid'])
+        self.assertEqual({"name": "A", "orientation": -135}, v1_map.data['stations']['10']['10'])
+        self.assertEqual({"name": "B", "orientation": 0, "transfer": 1}, v1_map.data['stations']['12']['10'])
+        # The original v1 mapdata is kept
+        self.assertEqual(mmap_v1, json.loads(v1_map.mapdata))
+
+        v2_map.refresh_from_db()
+        self.assertEqual(3, v2_map.data['global']['data_version'])
+        self.assertEqual({"1": {"1": 1, "2": 1}}, v2_map.data['points_by_color']['bd1038']['1-dashed'])
+        self.assertEqual("C", v2_map.data['stations']['1']['2']['name'])
+
+        # Converted maps are valid v3 maps, and converting them again changes nothing
+        for saved_map in (v1_map, v2_map):
+            form = CreateMapForm({"mapdata": saved_map.data})
+            self.assertTrue(form.is_valid())
+            self.assertEqual(saved_map.data, form.cleaned_data['mapdata'])
+            self.assertEqual(saved_map.data, SavedMap.upgrade_mapdata_to_v3(saved_map.data))
+
     def test_orientation_string_to_int(self):
 
         """ Confirm that orientations will be converted from string to int
@@ -1136,3 +1196,28 @@ class ValidateMap(PostMapDataMixin, TestCase):
         self.assertEqual(45, form.cleaned_data['mapdata']['1']['8']['station']['orientation'])
         self.assertEqual(-45, form.cleaned_data['mapdata']['3']['3']['station']['orientation'])
         self.assertEqual(0, form.cleaned_data['mapdata']['7']['2']['station']['orientation'])
+
+class BenchmarkPayloads(TestCase):
+
+    """ The benchmark_validators command is only useful
+            if its "valid" payloads really are valid
+    """
+
+    def test_generated_valid_payloads_validate(self):
+        from map_saver.management.commands.benchmark_validators import PAYLOADS, VALIDATORS
+
+        for version, validator in VALIDATORS.items():
+            metro_map = PAYLOADS[version]['valid'](100)
+            validated = validator(metro_map)
+            if version == 'v1':
+                self.assertEqual(100, sum(len(metro_map[x]) for x in metro_map if x != 'global'))
+            else:
+                self.assertEqual(10, sum(len(validated['stations'][x]) for x in validated['stations']))
+
+    def test_deep_nesting_payloads_grow(self):
+        from map_saver.management.commands.benchmark_validators import PAYLOADS
+
+        # Depth is capped, so each size has to build a bigger payload some other way
+        for version in PAYLOADS:
+            lengths = [len(json.dumps(PAYLOADS[version]['deep_nesting'](size))) for size in (500, 2000, 8000)]
+            self.assertEqual(sorted(set(lengths)), lengths, version)
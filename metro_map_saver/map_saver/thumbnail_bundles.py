@@ -0,0 +1,170 @@
+""" Bundling each tag's public thumbnails into one SVG sprite,
+        so the public gallery loads one file per tag instead of one per map.
+
+    Each map's thumbnail SVG becomes a <symbol id="t{urlhash}"> in MEDIA_ROOT/thumbnails/bundles/{tag}.svg
+        (its style scoped to the symbol, and its unused station <defs> dropped),
+        and {tag}.json indexes which maps are in the bundle.
+    The gallery draws those maps with <svg><use href="{tag}.svg?v={version}#t{urlhash}"/></svg>,
+        falling back to the map's own thumbnail for maps that aren't in the bundle.
+
+    Admin actions that change which maps are public, how they're tagged, or what their thumbnails look like
+        mark that tag's bundle dirty, and the gallery stops using it
+        until ./manage.py build_thumbnail_bundles (run on a regular schedule) rebuilds it.
+"""
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+import hashlib
+import json
+import re
+
+# Only tags whose whole listing is shown at once; the favorites are a small daily sample
+BUNDLE_TAGS = (
+    'real',
+    'speculative',
+    'unknown',
+)
+BUNDLE_PATH = 'thumbnails/bundles'
+BUNDLE_INDEX_TIMEOUT = 60 * 60
+
+SVG_PATTERN = re.compile(r'<svg\b[^>]*\bviewBox="([^"]+)"[^>]*>(.*)</svg>', re.DOTALL)
+STYLE_PATTERN = re.compile(r'<style>(.*?)</style>', re.DOTALL)
+DEFS_PATTERN = re.compile(r'<defs>.*?</defs>', re.DOTALL)
+CSS_RULE_PATTERN = re.compile(r'([^{}]+)\{([^{}]*)\}')
+
+
+def bundle_filename(tag, extension):
+    return f'{BUNDLE_PATH}/{tag}.{extension}'
+
+
+def bundle_index_key(tag):
+    return f'thumbnail_bundle:{tag}'
+
+
+def scope_style(css, scope):
+
+    """ Every thumbnail's style has rules like line { ... } and .c0 { ... };
+            in one bundle they'd all apply to every symbol, so prefix each selector with the symbol's id
+    """
+
+    return CSS_RULE_PATTERN.sub(
+        lambda rule: '{0} {{{1}}}'.format(
+            ', '.join(f'{scope} {selector.strip()}' for selector in rule.group(1).split(',')),
+            rule.group(2),
+        ),
+        css,
+    )
+
+
+def thumbnail_symbol(urlhash, svg):
+
+    """ Returns this thumbnail SVG as a <symbol>, or None if it isn't one
+    """
+
+    match = SVG_PATTERN.search(svg)
+    if not match:
+        return None
+    view_box, body = match.groups()
+    symbol_id = f't{urlhash}'
+    # Thumbnails don't draw stations, so their station <defs> (and those ids) aren't needed
+    body = DEFS_PATTERN.sub('', body)
+    body = STYLE_PATTERN.sub(lambda style: f'<style>{scope_style(style.group(1), "#" + symbol_id)}</style>', body)
+    return f'<symbol id="{symbol_id}" viewBox="{view_box}">{body}</symbol>'
+
+
+def bundle_maps(tag):
+    from .models import SavedMap
+
+    return SavedMap.objects.filter(publicly_visible=True, tags__slug=tag) \
+        .exclude(thumbnail_svg='') \
+        .exclude(thumbnail_svg=None) \
+        .only('urlhash', 'thumbnail_svg') \
+        .order_by('name')
+
+
+def write_file(name, content):
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    default_storage.save(name, ContentFile(content))
+
+
+def read_index(tag):
+    try:
+        with default_storage.open(bundle_filename(tag, 'json')) as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_index(tag, index):
+    write_file(bundle_filename(tag, 'json'), json.dumps(index).encode('utf-8'))
+    cache.delete(bundle_index_key(tag))
+
+
+def build_bundle(tag):
+
+    """ Writes this tag's bundle and its index; returns how many thumbnails are in it
+    """
+
+    symbols = []
+    urlhashes = []
+    for saved_map in bundle_maps(tag):
+        try:
+            with saved_map.thumbnail_svg.open('rb') as svg_file:
+                svg = svg_file.read().decode('utf-8')
+        except (OSError, ValueError):
+            # Missing files are left to the gallery's <img> fallback
+            continue
+        symbol = thumbnail_symbol(saved_map.urlhash, svg)
+        if symbol:
+            symbols.append(symbol)
+            urlhashes.append(saved_map.urlhash)
+
+    bundle = '<svg version="1.1" xmlns="http://www.w3.org/2000/svg">{0}</svg>'.format(''.join(symbols)).encode('utf-8')
+    write_file(bundle_filename(tag, 'svg'), bundle)
+    write_index(tag, {
+        'version': hashlib.sha256(bundle).hexdigest()[:12],
+        'maps': urlhashes,
+        'built_at': timezone.now().isoformat(),
+        'dirty': False,
+    })
+    return len(urlhashes)
+
+
+def dirty_bundles():
+
+    """ Returns the tags whose bundle is dirty or hasn't been built yet
+    """
+
+    return [tag for tag in BUNDLE_TAGS if (read_index(tag) or {'dirty': True})['dirty']]
+
+
+def mark_bundles_dirty(*tags):
+    for tag in set(tags) & set(BUNDLE_TAGS):
+        index = read_index(tag)
+        if index and not index['dirty']:
+            index['dirty'] = True
+            write_index(tag, index)
+
+
+def get_bundle(tag):
+
+    """ Returns {'url': ..., 'maps': {urlhash, ...}} for this tag's bundle,
+            or None if there's no bundle to use (not built yet, or dirty)
+    """
+
+    bundle = cache.get(bundle_index_key(tag))
+    if bundle is None:
+        index = read_index(tag) if tag in BUNDLE_TAGS else None
+        if index and not index['dirty']:
+            bundle = {
+                'url': '{0}?v={1}'.format(default_storage.url(bundle_filename(tag, 'svg')), index['version']),
+                'maps': set(index['maps']),
+            }
+        else:
+            bundle = False
+        cache.set(bundle_index_key(tag), bundle, BUNDLE_INDEX_TIMEOUT)
+    return bundle or None
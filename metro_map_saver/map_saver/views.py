@@ -1,48 +1,102 @@
+from asgiref.sync import sync_to_async
 from django.contrib import messages
-from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned, PermissionDenied
-from django.db.models import Count, F, Q
-from django.http import HttpResponseRedirect
+from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned, PermissionDenied, ValidationError
+from django.db import OperationalError
+from django.db.models import Count, F, Max, Q, Sum
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render, get_object_or_404, redirect
 from django.utils import timezone
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
 from django.views.decorators.csrf import ensure_csrf_cookie, csrf_exempt
-from django.views.generic.base import TemplateView
+from django.views.generic.base import TemplateView, View
 from django.views.generic.detail import DetailView
 from django.views.generic.edit import FormView
 from django.views.generic.list import ListView
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.utils.decorators import method_decorator
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.gzip import gzip_page
 from django.views.decorators.cache import cache_page, never_cache, cache_control
+from django.views.decorators.http import condition
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import quote_etag
 from django.conf import settings
 from django.views.generic.dates import (
     DayArchiveView,
 )
 
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio
 import base64
 import datetime
-import difflib
+import gzip
 import json
 import logging
 import os
-import pprint
 import pytz
-import random
+import re
 import requests
 import urllib.parse
 
 from taggit.models import Tag
 
 from moderate.models import ActivityLog
-from citysuggester.models import TravelSystem
+from summary.counters import (
+    get_counters,
+    track_counters,
+    PUBLIC_TAGS,
+    STATION_COUNT_GROUPS,
+)
+from summary.dashboard import latest_snapshot
+from summary.models import MapsByDay
 from .forms import (
     CreateMapForm,
     IdentifyForm,
     RateForm,
 )
+from .caching import (
+    aget_urlhash_for_raw_payload,
+    aremember_raw_payload,
+    aresolve_urlhash,
+    bump_map_card_version,
+    forget_favorites_pools,
+    forget_random_public_pool,
+    get_map_card_versions,
+    get_urlhash_for_raw_payload,
+    random_map_pk,
+    remember_raw_payload,
+    resolve_urlhash,
+    sample_favorites,
+)
 from .models import SavedMap, IdentifyMap, City
+from .gallery_filters import (
+    RejectedQuery,
+    apply_filters,
+    check_cost,
+    check_filters,
+    check_ordering,
+    query_timeout,
+)
+from .gallery_lookups import GalleryLookups
+from .mapdiff import diff_maps, diff_overlay_svg, has_changes, map_data_v3
+from .pagination import KeysetPaginationMixin, paginate
+from .similarity import (
+    candidate_pks,
+    index_grid_hash,
+    index_map,
+    station_set,
+    station_similarity,
+    visually_similar,
+    SIMILARITY_THRESHOLD,
+)
+from .station_index import (
+    maps_with_station,
+    search_stations,
+    MAX_MAPS,
+    MIN_PREFIX_LENGTH,
+)
+from .thumbnail_bundles import get_bundle, mark_bundles_dirty
 from .validator import (
     is_hex,
     sanitize_string,
@@ -69,22 +123,15 @@ class HomeView(TemplateView):
             # Only show favorite thumbnails if we're NOT loading a specific map,
             #   otherwise that wastes a bit of bandwidth and pagespeed
             #   which is especially important since this only shows on mobile
-            thumbnails = SavedMap.objects \
-                .filter(gallery_visible=True) \
-                .exclude(thumbnail__exact='') \
-                .exclude(name__exact='') \
-                .exclude(tags__slug='reviewed') \
-                .filter(tags__slug='favorite') \
-                .order_by('?')
-
             context = {
-                'favorites': thumbnails[:3]
+                'favorites': sample_favorites('home', 3)
             }
         else:
             try:
-                saved_map = SavedMap.objects.get(urlhash=urlhash)
-            except MultipleObjectsReturned:
-                saved_map = SavedMap.objects.filter(urlhash=urlhash).first()
+                resolved = resolve_urlhash(urlhash)
+                if not resolved:
+                    raise ObjectDoesNotExist
+                saved_map = SavedMap.objects.get(pk=resolved['pk'])
             except ObjectDoesNotExist:
                 context = {
                     'today': timezone.now().date(),
@@ -146,12 +193,13 @@ class PublicGalleryView(TemplateView):
         thumbnails = SavedMap.objects.defer('mapdata', 'data', 'stations').filter(publicly_visible=True)
 
         for tag in tags:
-            context[tag] = thumbnails.filter(tags__slug=tag).order_by('name')
-        context['favorite'] = context['favorite'].order_by('?')[:8]
+            if tag == 'favorite':
+                context[tag] = sample_favorites('gallery', 8)
+            else:
+                context[tag] = thumbnails.filter(tags__slug=tag).order_by('name')
+                context[f'{tag}_bundle'] = get_bundle(tag)
 
-        from summary.models import MapsByDay
-        mbd = MapsByDay.objects.all()
-        context['map_count'] = sum(m.maps for m in mbd)
+        context['map_count'] = get_counters('maps')['maps']
 
         return context
 
@@ -160,6 +208,11 @@ class ThumbnailGalleryView(TemplateView):
     @method_decorator(gzip_page)
     def get(self, request, **kwargs):
 
+        if kwargs.get('tag') == 'favorite':
+            return render(request, 'thumbnails.html', {
+                'thumbnails': sample_favorites('thumbnails', 8),
+            })
+
         thumbnails = SavedMap.objects \
             .filter(publicly_visible=True) \
             .exclude(name__exact='') \
@@ -168,13 +221,9 @@ class ThumbnailGalleryView(TemplateView):
         if kwargs.get('tag'):
             thumbnails = thumbnails.filter(tags__slug=kwargs.get('tag'))
 
-        if kwargs.get('tag') == 'favorite':
-            thumbnails = thumbnails.order_by('?')[:8]
-        else:
-            thumbnails = thumbnails.order_by('name')
-
         context = {
-            'thumbnails': thumbnails.defer('mapdata', 'data', 'stations'),
+            'thumbnails': thumbnails.order_by('name').defer('mapdata', 'data', 'stations'),
+            'bundle': get_bundle(kwargs.get('tag')),
         }
         return render(request, 'thumbnails.html', context)
 
@@ -191,8 +240,11 @@ class MapGalleryView(TemplateView):
         MAPS_PER_PAGE = 25
         NON_FILTERABLE = (
             'page',
+            'after',
+            'before',
             'per_page',
             'order_by',
+            'collapse',
         )
 
         tags = Tag.objects.all().order_by('id')
@@ -214,10 +266,15 @@ class MapGalleryView(TemplateView):
             # Allow fine-grained filtering of how many stations
             #   or any other attribute in the URL params
             # Example: ?station_count__lte=10&activitylog__user=1
+            # Only lookups onto indexed columns are allowed (see map_saver.gallery_filters)
             MAPS_PER_PAGE = int(request.GET.get('per_page', 25))
             filters = {k: v for k, v in request.GET.items() if k not in NON_FILTERABLE}
-            if filters:
-                visible_maps = visible_maps.filter(**filters).distinct()
+            try:
+                check_filters(filters)
+                if filters:
+                    visible_maps = apply_filters(visible_maps, filters).distinct()
+            except RejectedQuery as exc:
+                return self.rejected(request, exc, filters, tags)
             # Add per_page and order_by to filters so they persist through pagination
             # Awkward structure but I don't care to put order_by=-id in the URL every time
                 #   when I'm not specifying the order
@@ -225,6 +282,8 @@ class MapGalleryView(TemplateView):
                 filters['per_page'] = MAPS_PER_PAGE
             if request.GET.get('order_by'):
                 filters['order_by'] = request.GET.get('order_by')
+            if request.GET.get('collapse'):
+                filters['collapse'] = 1
 
         if kwargs.get('tag') == 'notags':
             visible_maps = visible_maps.filter(tags__exact=None)
@@ -237,23 +296,60 @@ class MapGalleryView(TemplateView):
         elif kwargs.get('tag') in [t.slug for t in tags]:
             visible_maps = visible_maps.filter(tags__slug=kwargs.get('tag'))
 
+        if request.GET.get('collapse'):
+            # Only the latest version of each family of near-identical maps (see map_saver.families)
+            #   out of the maps that made it through the filters above;
+            #   the family's own latest version might be tagged, or hidden, and filtered out
+            latest_shown = visible_maps.filter(family_membership__isnull=False) \
+                .values('family_membership__family') \
+                .annotate(latest=Max('pk')) \
+                .values('latest')
+            visible_maps = visible_maps.filter(
+                Q(family_membership__isnull=True) | Q(pk__in=latest_shown)
+            )
+
         order_by = request.GET.get('order_by', '-id')
-        visible_maps = visible_maps.prefetch_related('tags').order_by(order_by)
+        try:
+            check_ordering(order_by)
+        except RejectedQuery as exc:
+            return self.rejected(request, exc, filters, tags)
+
+        visible_maps = visible_maps.annotate(
+            map_family=F('family_membership__family'),
+            map_family_size=F('family_membership__family__size'),
+        ).prefetch_related('tags')
 
-        paginator = Paginator(visible_maps, MAPS_PER_PAGE)
+        # Break ties by id, so every map has exactly one place in the order
+        #   and the Next / Previous links can page by cursor (see map_saver.pagination)
+        ordering = (order_by,)
+        if order_by.lstrip('-') not in ('id', 'pk'):
+            ordering += ('-id' if order_by.startswith('-') else 'id',)
 
-        page = request.GET.get('page')
         try:
-            saved_maps = paginator.get_page(page)
-        except PageNotAnInteger:
-            saved_maps = paginator.get_page(1)
-        except EmptyPage:
-            saved_maps = paginator.get_page(paginator.num_pages)
+            if filters or request.GET.get('order_by'):
+                check_cost(visible_maps.order_by(*ordering))
+            with query_timeout():
+                saved_maps = paginate(request, visible_maps, ordering, MAPS_PER_PAGE, lenient=True)
+                # Run the queries now, inside the time limit, rather than while rendering
+                saved_maps.object_list = list(saved_maps.object_list)
+                maps_total = saved_maps.paginator.count
+        except RejectedQuery as exc:
+            return self.rejected(request, exc, filters, tags)
+        except OperationalError:
+            return self.rejected(request, 'This query took too long to run; try narrower filters.', filters, tags, status=503)
+
+        context = self.get_gallery_context(request, filters, tags)
+        context.update({
+            'saved_maps': saved_maps,
+            'maps_total': maps_total,
+            'gallery_lookups': GalleryLookups(saved_maps.object_list, tags),
+        })
 
-        context = {
+        return render(request, 'MapGalleryView.html', context)
+
+    def get_gallery_context(self, request, filters, tags):
+        return {
             'args': filters,
-            'saved_maps': saved_maps,
-            'maps_total': visible_maps.count(),
             'tags': tags,
             'is_staff': request.user.is_staff,
             'permissions': {
@@ -264,7 +360,18 @@ class MapGalleryView(TemplateView):
             }
         }
 
-        return render(request, 'MapGalleryView.html', context)
+    def rejected(self, request, error, filters, tags, status=400):
+
+        """ The gallery, without any maps, explaining why the query wasn't run
+        """
+
+        context = self.get_gallery_context(request, filters, tags)
+        context.update({
+            'error': str(error),
+            'saved_maps': [],
+            'maps_total': 0,
+        })
+        return render(request, 'MapGalleryView.html', context, status=status)
 
 def load_map_data(saved_map):
 
@@ -299,80 +406,75 @@ class MapSimilarView(TemplateView):
 
         2019-07: Reducing the search space even further by using the pre-calculated
                  station_count attribute and filtering by a small threshold +/- that
+
+        Now only compares against maps that share a MinHash band with this one
+            (an indexed lookup; see map_saver.similarity) instead of the whole station count window.
     """
 
-    @method_decorator(gzip_page)
-    @method_decorator(login_required)
-    def get(self, request, **kwargs):
+    headline = '{0} Maps similar to {1}'
+
+    def visible_maps(self, candidates=None):
+
+        """ Of these candidate pks (or of every map), the maps that are in the public gallery or have not been reviewed yet
+        """
+
+        maps = SavedMap.objects.all() if candidates is None else SavedMap.objects.filter(pk__in=candidates)
+        visible_maps = maps.filter(gallery_visible=True).filter(tags__exact=None)
+        gallery_maps = maps.filter(gallery_visible=True) \
+            .exclude(thumbnail__exact='') \
+            .exclude(name__exact='') \
+            .exclude(tags__slug='reviewed')
+        visible_maps = visible_maps | gallery_maps # merge these querysets
+        return visible_maps.prefetch_related('tags').order_by('id').distinct()
+
+    def get_similar_maps(self, this_map):
+
+        """ Returns the similar maps, and the context that explains why each is similar
+        """
 
-        # Filter by +/- 20% of the current map's number of stations instead of all visible maps
-        STATION_THRESHOLD = 0.2
         similar_maps = []
         similarity_scores = {}
-        urlhash_to_map = {} # this is so I can access the map object once it has been sorted by similarity
-        tags = Tag.objects.all().order_by('id')
 
-        try:
-            this_map = SavedMap.objects.prefetch_related('tags').get(urlhash=kwargs.get('urlhash'))
-        except ObjectDoesNotExist:
-            pass
-        except MultipleObjectsReturned:
-            # This should never happen, but it happened once?
-            this_map = SavedMap.objects.prefetch_related('tags').filter(urlhash=kwargs.get('urlhash')).order_by('id')[0]
-        else:
+        if not this_map.stations_minhash:
+            # Not indexed yet (see ./manage.py index_maps)
+            signature = this_map.update_stations_minhash()
+            if signature:
+                SavedMap.objects.filter(pk=this_map.pk).update(stations_minhash=signature)
+                index_map(this_map, signature)
 
-            this_map_stations_lower_bound = this_map.station_count * (1 - STATION_THRESHOLD)
-            this_map_stations_upper_bound = this_map.station_count * (1 + STATION_THRESHOLD)
-
-            visible_maps = SavedMap.objects.filter(gallery_visible=True).filter(tags__exact=None) \
-                .exclude(station_count__lt=this_map_stations_lower_bound) \
-                .exclude(station_count__gt=this_map_stations_upper_bound)
-            gallery_maps = SavedMap.objects.filter(gallery_visible=True) \
-                .exclude(thumbnail__exact='') \
-                .exclude(name__exact='') \
-                .exclude(tags__slug='reviewed') \
-                .exclude(station_count__lt=this_map_stations_lower_bound) \
-                .exclude(station_count__gt=this_map_stations_upper_bound)
-            visible_maps = visible_maps | gallery_maps # merge these querysets
-            visible_maps = visible_maps.prefetch_related('tags').order_by('id').distinct()
-
-            this_map_stations = set(this_map.stations.split(','))
-
-            for one_map in visible_maps:
-                if one_map.id == this_map.id:
-                    # Comparing a map to itself would be a perfect match.
-                    #   So don't do it.
-                    continue
-                else:
-                    try:
-                        one_map_stations = set(one_map.stations.split(','))
-                    except Exception:
-                        # If a map failed to load, it's not going to be similar
-                        continue
+        # Only maps that share a MinHash band with this one are worth comparing
+        this_map_stations = station_set(this_map.stations)
 
-                    if len(this_map_stations) == 0 or len(one_map_stations) == 0:
-                        continue
+        for one_map in self.visible_maps(candidate_pks(this_map, among=self.visible_maps())):
+            similarity = station_similarity(this_map_stations, station_set(one_map.stations))
+            if similarity >= SIMILARITY_THRESHOLD:
+                # If there's an overlap of 80% of stations by name, they are probably pretty similar
+                similar_maps.append(one_map)
+                similarity_scores[one_map.urlhash] = similarity
 
-                    overlap = len(this_map_stations.intersection(one_map_stations)) / float(len(this_map_stations))
-                    difference = 1.0 - (len(one_map_stations - this_map_stations) / float(len(this_map_stations)))
+        similar_maps.sort(key=lambda similarity_scores: similarity_scores.urlhash, reverse=True)
+        return similar_maps, {'similarity_scores': similarity_scores}
 
-                    similarity = (overlap * difference)
+    @method_decorator(gzip_page)
+    @method_decorator(login_required)
+    def get(self, request, **kwargs):
 
-                    if similarity >= 0.8:
-                        # If there's an overlap of 80% of stations by name, they are probably pretty similar
-                        similar_maps.append(one_map)
-                        similarity_scores[one_map.urlhash] = similarity
-                        urlhash_to_map[one_map.urlhash] = one_map
+        similar_maps = []
+        scores = {}
+        tags = Tag.objects.all().order_by('id')
 
-            similar_maps.sort(key=lambda similarity_scores: similarity_scores.urlhash, reverse=True)
+        resolved = resolve_urlhash(kwargs.get('urlhash'))
+        if resolved:
+            this_map = SavedMap.objects.prefetch_related('tags').get(pk=resolved['pk'])
+            similar_maps, scores = self.get_similar_maps(this_map)
 
             # It's easier to compare the maps if I can also see the base map on the similarity page
             similar_maps.insert(0, this_map)
 
         context = {
-            'headline': '{0} Maps similar to {1}'.format(len(similar_maps) - 1, kwargs.get('urlhash')),
+            'headline': self.headline.format(len(similar_maps) - 1, kwargs.get('urlhash')),
             'saved_maps': similar_maps,
-            'similarity_scores': similarity_scores,
+            'gallery_lookups': GalleryLookups(similar_maps, tags),
             'tags': tags,
             'is_staff': request.user.is_staff,
             'permissions': {
@@ -382,9 +484,36 @@ class MapSimilarView(TemplateView):
                 'generate_thumbnail': request.user.has_perm('map_saver.generate_thumbnail'),
             }
         }
+        context.update(scores)
 
         return render(request, 'MapGalleryView.html', context)
 
+class MapVisuallySimilarView(MapSimilarView):
+
+    """ Get: Display a gallery of maps whose lines are laid out nearly the same as the specified map,
+             whatever their stations are called (or if they have none at all),
+             by comparing grid hashes (see map_saver.similarity).
+
+        Good for catching copies and spam that MapSimilarView can't.
+    """
+
+    headline = '{0} Maps that look like {1}'
+
+    def get_similar_maps(self, this_map):
+        if this_map.grid_hash is None:
+            # Not indexed yet (see ./manage.py index_maps --index grid)
+            value = this_map.update_grid_hash()
+            if value is not False and value is not None:
+                SavedMap.objects.filter(pk=this_map.pk).update(grid_hash=value)
+                index_grid_hash(this_map, value)
+
+        distances = visually_similar(this_map)
+        similar_maps = sorted(
+            self.visible_maps(list(distances)),
+            key=lambda one_map: (distances[one_map.pk], -one_map.pk),
+        )
+        return similar_maps, {'grid_distances': {one_map.urlhash: distances[one_map.pk] for one_map in similar_maps}}
+
 class CreatorNameMapView(TemplateView):
 
     # @method_decorator(csrf_exempt) # Break glass in case of CSRF failure
@@ -401,22 +530,19 @@ class CreatorNameMapView(TemplateView):
         naming_token = request.POST.get('naming_token')
         context = {'saved_map': ''}
 
-        if name or tags:
-            try:
-                this_map = SavedMap.objects.get(urlhash=request.POST.get('urlhash'))
-            except (ObjectDoesNotExist, MultipleObjectsReturned):
-                pass
+        resolved = resolve_urlhash(request.POST.get('urlhash')) if (name or tags) else None
+        if resolved:
+            this_map = SavedMap.objects.get(pk=resolved['pk'])
+            if this_map.naming_token and this_map.naming_token == naming_token:
+                # This is the original creator of the map; allow them to name the map.
+                this_map.name = sanitize_string(f'{name} ({tags})' if tags in ALLOWED_TAGS else f'{name}')[:255]
+                this_map.save()
+                context['saved_map'] = 'Success'
             else:
-                if this_map.naming_token and this_map.naming_token == naming_token:
-                    # This is the original creator of the map; allow them to name the map.
-                    this_map.name = sanitize_string(f'{name} ({tags})' if tags in ALLOWED_TAGS else f'{name}')[:255]
-                    this_map.save()
-                    context['saved_map'] = 'Success'
-                else:
-                    # Either I have renamed this map,
-                    #   or someone is trying to be sneaky
-                    # Naming this map is no longer an option for the end user.
-                    pass
+                # Either I have renamed this map,
+                #   or someone is trying to be sneaky
+                # Naming this map is no longer an option for the end user.
+                pass
 
         return render(request, 'MapDataView.html', context)
 
@@ -453,46 +579,53 @@ class MapAdminActionView(TemplateView):
             else:
                 if this_map.publicly_visible and not request.user.has_perm('map_saver.edit_publicly_visible'):
                     raise PermissionDenied
-                if action == 'hide' and request.user.has_perm('map_saver.hide_map'):
-                    if this_map.gallery_visible:
-                        this_map.gallery_visible = False
-                    else:
-                        this_map.gallery_visible = True
-                    this_map.save()
-                elif action in ('addtag', 'removetag') and request.user.has_perm('map_saver.tag_map'):
-                    tag = request.POST.get('tag')
-                    try:
-                        # Only use existing tags; explicitly use slug intead of name
-                        # This fixes the problem where 'favorite' wouldn't duplicate on .add()
-                        #   but 'needs-review' would
-                        tag = Tag.objects.get(slug=tag)
-                    except ObjectDoesNotExist:
-                        pass
+                with track_counters(SavedMap.objects.filter(pk=this_map.pk)):
+                    if action == 'hide' and request.user.has_perm('map_saver.hide_map'):
+                        if this_map.gallery_visible:
+                            this_map.gallery_visible = False
+                        else:
+                            this_map.gallery_visible = True
+                        this_map.save()
+                    elif action in ('addtag', 'removetag') and request.user.has_perm('map_saver.tag_map'):
+                        tag = request.POST.get('tag')
+                        try:
+                            # Only use existing tags; explicitly use slug intead of name
+                            # This fixes the problem where 'favorite' wouldn't duplicate on .add()
+                            #   but 'needs-review' would
+                            tag = Tag.objects.get(slug=tag)
+                        except ObjectDoesNotExist:
+                            pass
+                        else:
+                            if tag:
+                                if action == 'addtag':
+                                    this_map.tags.add(tag)
+                                elif action == 'removetag':
+                                    this_map.tags.remove(tag)
+                                this_map.save()
+                    elif action == 'thumbnail' and request.user.has_perm('map_saver.generate_thumbnail'):
+                        this_map.thumbnail = request.POST.get('data', '')
+                        this_map.save()
+                    elif action == 'image' and request.user.is_superuser:
+                        data = request.POST.get('data')
+                        with open(os.path.join(settings.STATIC_ROOT, 'images/') + f"{this_map.urlhash}.png", "wb") as image_file:
+                            image_file.write(base64.b64decode(data[22:]))
+                    elif action == 'name' and request.user.has_perm('map_saver.name_map'):
+                        name = request.POST.get('name')
+                        this_map.name = name
+                        this_map.naming_token = '' # This map can no longer be named by the end user
+                        this_map.save()
+                    elif action == 'publish' and request.user.has_perm('map_saver.generate_thumbnail'):
+                        this_map.publicly_visible = not this_map.publicly_visible
+                        this_map.save()
+                        forget_random_public_pool()
                     else:
-                        if tag:
-                            if action == 'addtag':
-                                this_map.tags.add(tag)
-                            elif action == 'removetag':
-                                this_map.tags.remove(tag)
-                            this_map.save()
-                elif action == 'thumbnail' and request.user.has_perm('map_saver.generate_thumbnail'):
-                    this_map.thumbnail = request.POST.get('data', '')
-                    this_map.save()
-                elif action == 'image' and request.user.is_superuser:
-                    data = request.POST.get('data')
-                    with open(os.path.join(settings.STATIC_ROOT, 'images/') + f"{this_map.urlhash}.png", "wb") as image_file:
-                        image_file.write(base64.b64decode(data[22:]))
-                elif action == 'name' and request.user.has_perm('map_saver.name_map'):
-                    name = request.POST.get('name')
-                    this_map.name = name
-                    this_map.naming_token = '' # This map can no longer be named by the end user
-                    this_map.save()
-                elif action == 'publish' and request.user.has_perm('map_saver.generate_thumbnail'):
-                    this_map.publicly_visible = not this_map.publicly_visible
-                    this_map.save()
-                else:
-                    raise PermissionDenied
+                        raise PermissionDenied
                 context['status'] = 'Success'
+                # Any of these can make a map (in)eligible to be shown as a favorite
+                forget_favorites_pools()
+                if action in ('addtag', 'removetag', 'publish') and (this_map.publicly_visible or action == 'publish'):
+                    # Which maps are in a tag's thumbnail bundle, or how they look, changed
+                    mark_bundles_dirty(request.POST.get('tag', ''), *this_map.tags.slugs())
                 activity_details = request.POST.get('tag') or request.POST.get('name') or request.POST.get('data', '')[:21]
                 if action == 'hide' and this_map.gallery_visible:
                     action = 'show'
@@ -510,50 +643,164 @@ class MapDiffView(TemplateView):
     def get(self, request, **kwargs):
 
         """ Compare two similar maps and return a diff
+
+            Compares the maps' structure (see map_saver.mapdiff) rather than a text diff of their mapdata,
+                so it works the same for maps of any data_version.
+            Add ?overlay=1 to mark the changed cells over the second map's image.
         """
 
         context = {}
-        maps = []
-
-        pretty_printer = pprint.PrettyPrinter(indent=1)
 
-        try:
-            maps.append(SavedMap.objects.get(urlhash=kwargs.get('urlhash_first')))
-            maps.append(SavedMap.objects.get(urlhash=kwargs.get('urlhash_second')))
-        except ObjectDoesNotExist:
+        resolved = [
+            resolve_urlhash(kwargs.get('urlhash_first')),
+            resolve_urlhash(kwargs.get('urlhash_second')),
+        ]
+        if not all(resolved):
             context['error'] = '[ERROR] One or both of the maps does not exist (either {0} or {1})'.format(kwargs.get('urlhash_first'), kwargs.get('urlhash_second'))
-        except MultipleObjectsReturned:
-            context['error'] = '[ERROR] Multiple objects returned during an objects.get() call. This should never happen.'
         else:
+            maps = [SavedMap.objects.get(pk=one_map['pk']) for one_map in resolved]
+            context['maps'] = maps
 
-            context['maps'] = maps[:]
+            try:
+                diff = diff_maps(*[map_data_v3(one_map) for one_map in maps])
+            except (ValueError, KeyError, TypeError, ValidationError) as exc:
+                context['error'] = f'[ERROR] Could not read one of the maps: {exc!r}'
+            else:
+                context['diff'] = diff
+                context['has_changes'] = has_changes(diff)
+                if request.GET.get('overlay'):
+                    map_size = maps[1].map_size if maps[1].map_size > 0 else None
+                    context['overlay'] = diff_overlay_svg(diff, map_size)
 
-            for index, metro_map in enumerate(maps):
-                # It's excessively silly that I need to json.loads() twice here
-                #       but this is the ONLY thing that I could actually get to work after
-                #       many, many hours of trying.
-                # Maybe this is easier in Python 3?
-                maps[index] = pretty_printer.pformat(
-                    json.loads(
-                        str(
-                            json.loads(
-                                json.dumps(
-                                    metro_map.mapdata.replace("u'", "'").replace("'", '"').replace("\\", "").strip('"').strip("'")
-                                )
-                            )
-                        )
-                    )
-                )
+        return render(request, 'MapDiffView.html', context)
 
-            diff = difflib.ndiff(maps[0].splitlines(1), maps[1].splitlines(1))
 
-            context['diff'] = []
+def accepts_gzip(request):
+    return bool(re.search(r'\bgzip\b', request.headers.get('Accept-Encoding', '')))
 
-            for line in diff:
-                if line[0] in ('+', '-'):
-                    context['diff'].append(line.strip().replace("u'", "'").replace('  ', ' ').replace('  ', ' '))
+def map_payload_etag(request, urlhash):
 
-        return render(request, 'MapDiffView.html', context)
+    """ ETag for MapDataView.get, looked up without loading the map itself
+            (usually without touching the database at all)
+            so that If-None-Match can be answered with a 304 straight away.
+
+        The gzipped and uncompressed bodies are different representations,
+            so they get different (strong) ETags.
+    """
+
+    return resolved_payload_etag(request, resolve_urlhash(urlhash))
+
+def resolved_payload_etag(request, resolved):
+    if not resolved or not resolved['payload_etag']:
+        return None
+    etag = resolved['payload_etag']
+    if accepts_gzip(request):
+        return f'{etag}-gzip'
+    return etag
+
+def payload_response(request, saved_map):
+
+    """ Serve a map's pre-rendered payload, compressed if the client allows it
+    """
+
+    if accepts_gzip(request):
+        response = HttpResponse(bytes(saved_map.payload_gzip))
+        response['Content-Encoding'] = 'gzip'
+        response['ETag'] = f'"{saved_map.payload_etag}-gzip"'
+    else:
+        response = HttpResponse(gzip.decompress(saved_map.payload_gzip))
+        response['ETag'] = f'"{saved_map.payload_etag}"'
+    response['Content-Length'] = str(len(response.content))
+    patch_vary_headers(response, ('Accept-Encoding',))
+    patch_cache_control(response, public=True, immutable=True)
+    return response
+
+def missing_map_response(request, urlhash):
+    context = {
+        'error': '[ERROR] The requested map does not exist ({0})'.format(urlhash),
+    }
+    return render(request, 'MapDataView.html', context)
+
+def load_map_payload(request, urlhash):
+
+    """ Serve the saved map with this urlhash
+    """
+
+    resolved = resolve_urlhash(urlhash)
+    if not resolved:
+        return missing_map_response(request, urlhash)
+
+    saved_map = SavedMap.objects.only(
+        'urlhash',
+        'payload_gzip',
+        'payload_etag',
+    ).get(pk=resolved['pk'])
+
+    if not saved_map.payload_etag:
+        # Saved before payloads were stored
+        saved_map = SavedMap.objects.get(pk=saved_map.pk)
+        saved_map.save_payload()
+
+    return payload_response(request, saved_map)
+
+# If-None-Match is answered before the (cached) page is even looked up
+serve_map_payload = condition(etag_func=map_payload_etag)(cache_page(60 * 60 * 24 * 30)(load_map_payload))
+
+def new_map_details(form):
+
+    """ The fields of the SavedMap to create from a CreateMapForm that passed validation
+    """
+
+    return SavedMap.get_map_details(
+        form.cleaned_data['mapdata'],
+        form.cleaned_data['urlhash'],
+        form.cleaned_data['naming_token'],
+        form.cleaned_data['data_version'],
+    )
+
+def save_valid_map(form, raw_mapdata):
+
+    """ Save the map from a CreateMapForm that passed validation,
+            unless it already exists.
+
+        Returns what MapDataView.html shows: "urlhash,naming_token",
+            with no naming token if the map already existed
+    """
+
+    urlhash = form.cleaned_data['urlhash']
+    if resolve_urlhash(urlhash):
+        # Doesn't override the saved map if it already exists.
+        saved_map = f'{urlhash},'
+    else:
+        SavedMap.objects.create(**new_map_details(form))
+        saved_map = f'{urlhash},{form.cleaned_data["naming_token"]}'
+    remember_raw_payload(raw_mapdata, urlhash)
+    return saved_map
+
+async def asave_valid_map(form, raw_mapdata):
+
+    """ Same as save_valid_map, for AsyncMapDataView
+    """
+
+    urlhash = form.cleaned_data['urlhash']
+    if await aresolve_urlhash(urlhash):
+        # Doesn't override the saved map if it already exists.
+        saved_map = f'{urlhash},'
+    else:
+        await SavedMap.objects.acreate(**new_map_details(form))
+        saved_map = f'{urlhash},{form.cleaned_data["naming_token"]}'
+    await aremember_raw_payload(raw_mapdata, urlhash)
+    return saved_map
+
+def failed_validation_error(form):
+
+    """ Returns the user-facing error for a CreateMapForm that failed validation
+    """
+
+    # Anything that appears before the first colon will be internal-only;
+    #   everything else is user-facing.
+    errors = form.errors.get('mapdata', [])
+    return '[ERROR] {0}'.format(' '.join(str(errors).split(':')[1:]).split('</')[0])
 
 
 class MapDataView(TemplateView):
@@ -562,76 +809,102 @@ class MapDataView(TemplateView):
         Post: Save your map and generate a hash URL to facilitate sharing
     """
 
-    @method_decorator(cache_page(60 * 60 * 24 * 30))
-    @method_decorator(gzip_page)
     def get(self, request, **kwargs):
-        urlhash = kwargs.get('urlhash')
-
-        context = {}
-
-        try:
-            saved_map = SavedMap.objects.get(urlhash=urlhash)
-        except ObjectDoesNotExist:
-            context['error'] = '[ERROR] The requested map does not exist ({0})'.format(urlhash)
-        except MultipleObjectsReturned:
-            saved_map = SavedMap.objects.filter(urlhash=urlhash).earliest('id')
-
-        if not context.get('error'):
-            if saved_map.data:
-                mapdata = json.dumps(saved_map.data)
-            elif saved_map.mapdata:
-                mapdata = saved_map.mapdata
-            else:
-                mapdata = {}
-            context['saved_map'] = mapdata
-
-        return render(request, 'MapDataView.html', context)
+        return serve_map_payload(request, kwargs.get('urlhash'))
 
     # @method_decorator(csrf_exempt) # Break glass in case of CSRF failure
     @method_decorator(never_cache)
     def post(self, request, **kwargs):
         mapdata = request.POST.get('metroMap')
+        raw_mapdata = mapdata
 
         context = {}
 
+        # Fast path: we've already validated and saved this exact payload,
+        #   so skip parsing and validation entirely --
+        #   as long as that map is still there (it may have been deleted since)
+        known_urlhash = get_urlhash_for_raw_payload(raw_mapdata)
+        if known_urlhash and resolve_urlhash(known_urlhash):
+            context['saved_map'] = f'{known_urlhash},'
+            return render(request, 'MapDataView.html', context)
+
         form = CreateMapForm({'mapdata': mapdata})
         if form.is_valid():
-            mapdata = form.cleaned_data['mapdata']
-            urlhash = form.cleaned_data['urlhash']
-            naming_token = form.cleaned_data['naming_token']
-            data_version = form.cleaned_data['data_version']
-            try:
-                # Doesn't override the saved map if it already exists.
-                saved_map = SavedMap.objects.only('urlhash').get(urlhash=urlhash)
-                context['saved_map'] = f'{urlhash},'
-            except ObjectDoesNotExist:
-                stations = SavedMap.get_stations(mapdata, data_version)
-                map_details = {
-                    'urlhash': urlhash,
-                    'naming_token': naming_token,
-                    'station_count': len(stations),
-                    'stations': ','.join(stations),
-                    'map_size': mapdata.get('global', {}).get('map_size', -1) or -1,
-                }
-                if data_version >= 2:
-                    map_details['data'] = mapdata
-                else:
-                    map_details['mapdata'] = json.dumps(mapdata)
+            context['saved_map'] = save_valid_map(form, raw_mapdata)
+        else:
+            errors = failed_validation_error(form)
+            context['error'] = errors
+            logger.error('[ERROR] [FAILEDVALIDATION] ({0}); mapdata: {1}'.format(errors, mapdata))
 
-                from citysuggester.utils import MINIMUM_STATION_OVERLAP
-                if len(stations) < MINIMUM_STATION_OVERLAP:
-                    # Don't need to check these ever
-                    map_details['suggested_city_overlap'] = -2
+        return render(request, 'MapDataView.html', context)
+
+
+# Validation is CPU-bound; run it off the event loop,
+#   but never on more than this many threads at once
+#   so a burst of huge maps can't starve everything else in the process
+VALIDATION_EXECUTOR = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'ASYNC_VALIDATION_WORKERS', 4),
+    thread_name_prefix='validation',
+)
+
+class AsyncMapDataView(View):
+
+    """ Same as MapDataView, for serving under ASGI:
+            a slow validation or database write waits
+            without tying up a worker for everyone else.
+
+        Get: Given a hash URL, load a saved map
+        Post: Save your map and generate a hash URL to facilitate sharing
+
+        Loading serves the same stored payload and ETags as MapDataView.get,
+            through the async cache and ORM; there's no page cache in front of it,
+            so a request that isn't answered with a 304 reads the payload row.
+    """
+
+    async def get(self, request, **kwargs):
+        urlhash = kwargs.get('urlhash')
 
-                saved_map = SavedMap.objects.create(**map_details)
-                context['saved_map'] = f'{urlhash},{naming_token}'
-            except MultipleObjectsReturned:
-                context['saved_map'] = f'{urlhash},'
+        resolved = await aresolve_urlhash(urlhash)
+        if not resolved:
+            return missing_map_response(request, urlhash)
+
+        etag = resolved_payload_etag(request, resolved)
+        if etag:
+            not_modified = get_conditional_response(request, etag=quote_etag(etag))
+            if not_modified:
+                return not_modified
+
+        saved_map = await SavedMap.objects.only(
+            'urlhash',
+            'payload_gzip',
+            'payload_etag',
+        ).aget(pk=resolved['pk'])
+
+        if not saved_map.payload_etag:
+            # Saved before payloads were stored
+            saved_map = await SavedMap.objects.aget(pk=saved_map.pk)
+            await sync_to_async(saved_map.save_payload)()
+
+        return payload_response(request, saved_map)
+
+    async def post(self, request, **kwargs):
+        mapdata = request.POST.get('metroMap')
+        raw_mapdata = mapdata
+
+        context = {}
+
+        known_urlhash = await aget_urlhash_for_raw_payload(raw_mapdata)
+        if known_urlhash and await aresolve_urlhash(known_urlhash):
+            context['saved_map'] = f'{known_urlhash},'
+            return render(request, 'MapDataView.html', context)
+
+        form = CreateMapForm({'mapdata': mapdata})
+        loop = asyncio.get_running_loop()
+        is_valid = await loop.run_in_executor(VALIDATION_EXECUTOR, form.is_valid)
+        if is_valid:
+            context['saved_map'] = await asave_valid_map(form, raw_mapdata)
         else:
-            # Anything that appears before the first colon will be internal-only;
-            #   everything else is user-facing.
-            errors = form.errors.get('mapdata', [])
-            errors = '[ERROR] {0}'.format(' '.join(str(errors).split(':')[1:]).split('</')[0])
+            errors = failed_validation_error(form)
             context['error'] = errors
             logger.error('[ERROR] [FAILEDVALIDATION] ({0}); mapdata: {1}'.format(errors, mapdata))
 
@@ -665,7 +938,9 @@ class AdminHomeView(TemplateView):
                 tags__exact=None,
                 **group,
             )
-            maps.update(gallery_visible=False)
+            with track_counters(maps) as pks:
+                maps.update(gallery_visible=False)
+            bump_map_card_version(*pks)
 
         # Return empty response for success
         return render(request, 'MapDataView.html', {})
@@ -685,119 +960,56 @@ class AdminHomeView(TemplateView):
         context['today'] = today
         context['yesterday'] = yesterday
 
-        context['created_today'] = SavedMap.objects.filter(created_at=today).count()
-        context['created_yesterday'] = SavedMap.objects.filter(created_at=yesterday).count()
-        context['last_30'] = SavedMap.objects.filter(created_at__gt=last_30).count()
-        context['last_90'] = SavedMap.objects.filter(created_at__gt=last_90).count()
-        context['prev_90'] = SavedMap.objects.filter(
-            created_at__gt=prev_90_start,
-            created_at__lte=prev_90_end,
-        ).count()
+        # Maps created by day are kept in MapsByDay as maps are created
+        #   (and recalculated by ./manage.py summarize)
+        created = MapsByDay.objects.filter(day__gt=prev_90_start).aggregate(
+            created_today=Sum('maps', filter=Q(day=today), default=0),
+            created_yesterday=Sum('maps', filter=Q(day=yesterday), default=0),
+            last_30=Sum('maps', filter=Q(day__gt=last_30), default=0),
+            last_90=Sum('maps', filter=Q(day__gt=last_90), default=0),
+            prev_90=Sum('maps', filter=Q(day__lte=prev_90_end), default=0),
+        )
+        context.update(created)
         context['last_90_change'] = context['last_90'] - context['prev_90']
 
-        # Get numbers of maps needing review
-        filter_groups = {
-            '0 stations': {'station_count': 0},
-            '1-10 stations': {'station_count__gte': 1, 'station_count__lte': 10},
-            '11-20 stations': {'station_count__gte': 11, 'station_count__lte': 20},
-            '21-30 stations': {'station_count__gte': 21, 'station_count__lte': 30},
-            '31-40 stations': {'station_count__gte': 31, 'station_count__lte': 40},
-            '41-50 stations': {'station_count__gte': 41, 'station_count__lte': 50},
-            '51-75 stations': {'station_count__gte': 51, 'station_count__lte': 75},
-            '76-100 stations': {'station_count__gte': 76, 'station_count__lte': 100},
-            '101-200 stations': {'station_count__gte': 101, 'station_count__lte': 200},
-            '201-500 stations': {'station_count__gte': 201, 'station_count__lte': 500},
-            '501+ stations': {'station_count__gte': 501},
-        }
-
-        maps_needing_review = SavedMap.objects.filter(tags__exact=None, gallery_visible=True)
+        # Everything else comes from the counters (see summary.counters), in one query
+        counters = get_counters()
 
         PER_PAGE = 100
 
+        # Get numbers of maps needing review
         context['maps'] = {
             group: {
-                'needing_review': maps_needing_review.filter(**filters).count(),
-                'total': SavedMap.objects.filter(**filters).count(),
+                'needing_review': counters.get(f'maps:stations:{group}:needing_review', 0),
+                'total': counters.get(f'maps:stations:{group}', 0),
                 'review_link': '/admin/gallery/notags/?per_page={0}&{1}'.format(
                     PER_PAGE,
                     urllib.parse.urlencode(filters)
                 ),
                 'filters': filters,
-            } for group, filters in filter_groups.items()
+            } for group, filters in STATION_COUNT_GROUPS.items()
         }
 
         context['totals'] = {
-            'needing_review': maps_needing_review.count(),
-            'total': SavedMap.objects.count(),
+            'needing_review': counters.get('maps:needing_review', 0),
+            'total': counters.get('maps', 0),
         }
 
-        maps_tagged_need_review = SavedMap.objects.filter(
-            tags__slug='needs-review',
-            gallery_visible=True,
-        ).count()
-        maps_no_tags = SavedMap.objects.filter(
-            tags__exact=None,
-            gallery_visible=True,
-        ).count()
-
-        context['maps_no_tags'] = maps_no_tags
-        context['maps_tagged_need_review'] = maps_tagged_need_review
-
-        # How many travel systems do we have a publicly visible real/speculative map for?
-        travel_system_names = [ts.name.split(',')[0] for ts in TravelSystem.objects.all()]
-        travel_system_has_real_map = set()
-        maps_tagged_real = SavedMap.objects.filter(
-            tags__slug='real',
-            publicly_visible=True,
-        )
+        context['maps_no_tags'] = counters.get('maps:needing_review', 0)
+        context['maps_tagged_need_review'] = counters.get('maps:tagged:needs-review', 0)
 
-        travel_system_has_speculative_map = set()
-        maps_tagged_speculative = SavedMap.objects.filter(
-            tags__slug='speculative',
-            publicly_visible=True,
-        )
-
-        for real_map in maps_tagged_real:
-            if real_map.name in travel_system_names or \
-            real_map.suggested_city in travel_system_names:
-                travel_system_has_real_map.add(real_map.name)
-
-        for speculative_map in maps_tagged_speculative:
-            if speculative_map.name in travel_system_names or \
-            speculative_map.suggested_city in travel_system_names:
-                travel_system_has_speculative_map.add(speculative_map.name)
-
-        travel_system_names = set(travel_system_names)
-
-        context['travel_system_has_real_map'] = sorted(travel_system_has_real_map)
-        context['travel_system_missing_real_map'] = sorted(
-            travel_system_names - travel_system_has_real_map
-        )
-        context['travel_system_has_speculative_map'] = sorted(travel_system_has_speculative_map)
-        context['travel_system_missing_speculative_map'] = sorted(
-            travel_system_names - travel_system_has_speculative_map
-        )
-        context['total_travel_systems'] = TravelSystem.objects.count()
+        # Travel system coverage and the most popular cities are computed in the background
+        #   by ./manage.py snapshot_dashboard; see summary.dashboard
+        snapshot = latest_snapshot()
+        context.update(snapshot.data)
+        context['snapshot_created_at'] = snapshot.created_at
 
         # Maps currently in the public gallery
-        public_tags = ['real', 'speculative', 'unknown', 'favorite']
-        public_tags = {tag: {} for tag in public_tags}
-        context['public_tags'] = {}
-        public = SavedMap.objects.filter(publicly_visible=True)
-        for tag in public_tags:
-            context['public_tags'][tag] = public.filter(tags__slug=tag).count()
-        context['public_total'] = public.count()
-
-        context['most_popular_cities'] = SavedMap.objects.exclude(suggested_city='') \
-            .values_list('suggested_city') \
-            .annotate(city_count=Count('suggested_city')) \
-            .order_by('-city_count')[:10]
-
-        context['most_popular_cities_by_name'] = SavedMap.objects.exclude(name='') \
-            .filter(publicly_visible=True) \
-            .values_list('name') \
-            .annotate(city_count=Count('name')) \
-            .order_by('-city_count')[:10]
+        context['public_tags'] = {
+            tag: counters.get(f'maps:public:{tag}', 0)
+            for tag in PUBLIC_TAGS
+        }
+        context['public_total'] = counters.get('maps:public', 0)
 
         return context
 
@@ -898,11 +1110,27 @@ class MapsByDateView(TemplateView):
 
         return render(request, 'MapsByDateView.json', context)
 
-class MapsPerDayView(DayArchiveView):
+class MapCardsMixin:
+
+    """ For listings of map cards (map_saver/map_card.html):
+            looks up every card's version at once, so each card on the page
+            can be served from the cache instead of being rendered again
+    """
+
+    def get_context_data(self, *args, **kwargs):
+        context = super().get_context_data(*args, **kwargs)
+        maps = context.get('object_list') or []
+        versions = get_map_card_versions([m.pk for m in maps])
+        for m in maps:
+            m.card_version = versions.get(m.pk)
+        return context
+
+class MapsPerDayView(MapCardsMixin, KeysetPaginationMixin, DayArchiveView):
 
     """ Display the maps created this day
     """
 
+    keyset_ordering = ('-created_at', '-id')
     queryset = SavedMap.objects.defer(*SavedMap.DEFER_FIELDS).all().exclude(tags__slug='calendar-hidden')
     date_field = 'created_at'
     paginate_by = 50
@@ -927,11 +1155,12 @@ class MapsPerDayView(DayArchiveView):
     def get(self, request, *args, **kwargs):
         return super().get(request, *args, **kwargs)
 
-class CityView(ListView):
+class CityView(MapCardsMixin, KeysetPaginationMixin, ListView):
 
     """ Show all maps for a given city
     """
 
+    keyset_ordering = ('-created_at', '-id')
     context_object_name = 'maps'
     paginate_by = 50
 
@@ -961,7 +1190,37 @@ class CityView(ListView):
         return super().get(request, *args, **kwargs)
 
 
-class SameDayView(ListView):
+class StationSearchView(View):
+
+    """ Get: JSON of the station names starting with ?q= (and how many maps have each),
+                and/or the maps that have a station named exactly ?station=
+
+        Only publicly visible maps are searched, except for staff.
+    """
+
+    def get(self, request, *args, **kwargs):
+        prefix = request.GET.get('q', '').strip()
+        station = request.GET.get('station', '').strip()
+        publicly_visible = not request.user.is_staff
+
+        context = {}
+        if prefix:
+            if len(prefix) < MIN_PREFIX_LENGTH:
+                return JsonResponse({'error': f'Please enter at least {MIN_PREFIX_LENGTH} letters for your search.'}, status=400)
+            context['stations'] = search_stations(prefix, publicly_visible=publicly_visible)
+        if station:
+            context['maps'] = [
+                {
+                    'urlhash': saved_map.urlhash,
+                    'name': saved_map.name,
+                    'url': reverse('home_map', kwargs={'urlhash': saved_map.urlhash}),
+                }
+                for saved_map in maps_with_station(station, publicly_visible=publicly_visible)[:MAX_MAPS]
+            ]
+        return JsonResponse(context)
+
+
+class SameDayView(MapCardsMixin, ListView):
 
     """ Show all maps created on the same day as a given URLhash,
             which can be especially useful for finding prior versions of the same map
@@ -972,12 +1231,14 @@ class SameDayView(ListView):
 
     def get_queryset(self):
         urlhash = self.request.path_info.split('/')[-1]
-        this_map = get_object_or_404(SavedMap, urlhash=urlhash)
+        this_map = resolve_urlhash(urlhash)
+        if not this_map:
+            raise Http404
 
         # I'd use __date here, but then SQL won't use the index on created_at
         return super().get_queryset().defer(*SavedMap.DEFER_FIELDS).filter(
-            created_at__gte=this_map.created_at.date(),
-            created_at__lt=this_map.created_at.date() + datetime.timedelta(days=1),
+            created_at__gte=this_map['created_at'].date(),
+            created_at__lt=this_map['created_at'].date() + datetime.timedelta(days=1),
         )
 
 class RecaptchaMixin:
@@ -1019,7 +1280,7 @@ class IdentifyMapView(RecaptchaMixin, FormView):
             urlhash = form.cleaned_data['urlhash']
             name = form.cleaned_data['name']
             map_type = form.cleaned_data['map_type']
-            mmap = SavedMap.objects.filter(urlhash=urlhash).first()
+            mmap = SavedMap.objects.get(pk=resolve_urlhash(urlhash)['pk'])
             is_submission_valid = self.is_submission_valid(form)
         except Exception as exc:
             pass
@@ -1056,13 +1317,16 @@ class RateMapView(RecaptchaMixin, FormView, DetailView):
     def get_success_url(self, urlhash):
         return reverse_lazy('rate', args=(urlhash, ))
 
+    def get_object(self, queryset=None):
+        resolved = resolve_urlhash(self.kwargs.get(self.slug_url_kwarg))
+        if not resolved:
+            raise Http404
+        return SavedMap.objects.get(pk=resolved['pk'])
+
     @method_decorator(cache_control(max_age=60))
     @method_decorator(ensure_csrf_cookie)
     def get(self, request, *args, **kwargs):
-        try:
-            self.object = self.get_object()
-        except MultipleObjectsReturned:
-            self.object = SavedMap.objects.filter(urlhash=kwargs.get('urlhash')).earliest('id')
+        self.object = self.get_object()
         context = self.get_context_data(object=self.object, map=self.object)
         if not self.object.id in request.session.get('rated', []):
             context['form_like'] = self.form_class(dict(urlhash=self.object.urlhash, choice='likes'))
@@ -1077,15 +1341,16 @@ class RateMapView(RecaptchaMixin, FormView, DetailView):
             urlhash = form.cleaned_data['urlhash']
             choice = form.cleaned_data['choice']
             assert choice in ('likes', 'dislikes')
-            mmap = SavedMap.objects.filter(urlhash=urlhash)
+            pk = resolve_urlhash(urlhash)['pk']
             is_submission_valid = self.is_submission_valid(form)
         except Exception as exc:
             pass
         else:
             if is_submission_valid:
-                mmap.update(**{choice: F(choice) + 1})
+                SavedMap.objects.filter(pk=pk).update(**{choice: F(choice) + 1})
+                bump_map_card_version(pk)
                 already_rated = self.request.session.get('rated', [])
-                self.request.session['rated'] = already_rated + [mmap.first().id]
+                self.request.session['rated'] = already_rated + [pk]
 
         return HttpResponseRedirect(self.get_success_url(urlhash))
 
@@ -1097,6 +1362,7 @@ class RandomMapView(RateMapView):
     model = SavedMap
     context_object_name = 'map'
     template_name = 'map_saver/savedmap_rate.html'
+    publicly_visible = False # Set to only choose from publicly visible maps
 
     @method_decorator(never_cache)
     @method_decorator(ensure_csrf_cookie)
@@ -1104,12 +1370,15 @@ class RandomMapView(RateMapView):
         return super().get(request, *args, **kwargs)
 
     def get_object(self, *args, **kwargs):
-        pks = SavedMap.objects.all().values_list('pk', flat=True)
-        return SavedMap.objects.get(pk=random.choice(pks))
+        pk = random_map_pk(publicly_visible=self.publicly_visible)
+        if pk is None:
+            raise Http404
+        return SavedMap.objects.get(pk=pk)
 
 
-class HighestRatedMapsView(ListView):
+class HighestRatedMapsView(MapCardsMixin, KeysetPaginationMixin, ListView):
     model = SavedMap
+    keyset_ordering = ('-likes', '-id')
     paginate_by = 100
     context_object_name = 'maps'
 
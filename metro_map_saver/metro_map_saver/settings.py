@@ -86,6 +86,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Pages replayed from the site cache skip the view's condition(); see CachedETagMiddleware
+    'map_saver.middleware.CachedETagMiddleware',
     'django.middleware.cache.FetchFromCacheMiddleware',
 ]
 
@@ -108,6 +110,10 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'metro_map_saver.wsgi.application'
+ASGI_APPLICATION = 'metro_map_saver.asgi.application'
+
+# How many threads the async save endpoint may use to validate maps at once
+ASYNC_VALIDATION_WORKERS = 4
 
 
 # Database
@@ -130,9 +136,27 @@ DATABASES = {
 
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+        'BACKEND': 'map_saver.cache_backends.TieredPyMemcacheCache',
         'LOCATION': 'unix:/home/sturner/apps/metromapmaker/memcached.sock',
         "TIMEOUT": 60 * 15,
+        # In-process LRU in front of memcached for the hottest keys; see map_saver.cache_backends.LocalTierMixin
+        'LOCAL_TIER': {
+            # A listing page alone can be up to 100 map cards
+            'MAX_ENTRIES': 2000,
+            'TIMEOUT': 10,
+            'GENERATION_CHECK_INTERVAL': 1,
+            'KEY_PREFIXES': (
+                'views.decorators.cache.',
+                # Versioned, so never stale; see map_saver.caching.get_map_card_versions
+                'template.cache.map_card.',
+            ),
+        },
+        # memcached runs with -I 2m; compress big values and split anything still too large.
+        #   See map_saver.cache_backends.ChunkedValuesMixin
+        'CHUNKED_VALUES': {
+            'COMPRESS_THRESHOLD': 64 * 1024,
+            'CHUNK_SIZE': 1024 * 1024,
+        },
     }
 }
 
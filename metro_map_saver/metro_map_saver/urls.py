@@ -40,6 +40,10 @@ urlpatterns = [
     path('rate/<slug:urlhash>', map_saver.views.RateMapView.as_view(), name='rate'),
     path('identify/<slug:urlhash>', map_saver.views.IdentifyMapView.as_view(), name='identify'),
 
+    # Async saving and loading, for serving under ASGI (see asgi.py)
+    path('async/save/', never_cache(map_saver.views.AsyncMapDataView.as_view()), name='save_map_async'),
+    path('async/load/<slug:urlhash>', map_saver.views.AsyncMapDataView.as_view(), name='load_map_async'),
+
     # Stats, using summary for performance
     path('calendar/', summary.views.MapsPerMonthView.as_view(month_format='%m'), name='calendar'),
     path('calendar/<int:year>/', summary.views.MapsPerYearView.as_view(), name='calendar-year'),
@@ -50,8 +54,10 @@ urlpatterns = [
 
     path('city/', summary.views.CityListView.as_view(), name='city-list'),
     path('city/<str:city>/', map_saver.views.CityView.as_view(), name='city'),
+    path('stations/', map_saver.views.StationSearchView.as_view(), name='station_search'),
 
     path('random/', map_saver.views.RandomMapView.as_view(), name='random'),
+    path('random/public/', map_saver.views.RandomMapView.as_view(publicly_visible=True), name='random_public'),
     path('sameday/<slug:urlhash>', cache_page(60)(map_saver.views.SameDayView.as_view()), name='sameday'),
     path('best/', map_saver.views.HighestRatedMapsView.as_view(), name='best'),
 
@@ -72,6 +78,7 @@ urlpatterns = [
 
     # Admin Gallery: Similar
     path('admin/similar/<slug:urlhash>', map_saver.views.MapSimilarView.as_view(), name='similar'),
+    path('admin/similar/<slug:urlhash>/visual', map_saver.views.MapVisuallySimilarView.as_view(), name='visually_similar'),
 
     # Admin Gallery: Direct View
     path('admin/direct/<path:direct>', map_saver.views.MapGalleryView.as_view(), name='direct'),
@@ -7,15 +7,17 @@ from django.utils.decorators import method_decorator
 from django.contrib.auth.decorators import login_required
 
 from map_saver.models import SavedMap
+from map_saver.pagination import KeysetPaginationMixin
 from .models import ActivityLog
 
-class ActivityLogList(ListView):
+class ActivityLogList(KeysetPaginationMixin, ListView):
 
     """ Display ActivityLog entries in a tabular format
     """
 
     model = ActivityLog
     paginate_by = 100
+    keyset_ordering = ('-created_at', '-id')
 
     @method_decorator(login_required)
     def get(self, request, *args, **kwargs):
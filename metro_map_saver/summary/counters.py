@@ -0,0 +1,226 @@
+""" Counts of maps (total, needing review, by station count, publicly visible by tag)
+        kept in the Counter table as maps change,
+        so reading any of them is a single row instead of a COUNT(*) over SavedMap.
+
+    Each map contributes 1 to every counter in map_counters(); wrap anything that changes
+        a map's visibility, tags or station count in track_counters() and the difference
+        is applied (with F() updates, in the same transaction as the change).
+    New maps are counted by SavedMap.save(), and ./manage.py reconcile_counters
+        corrects any drift (e.g. from edits made in the Django admin).
+
+    The Counter table starts out empty: run ./manage.py reconcile_counters once after migrating
+        to count the maps that were saved before it existed.
+"""
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from summary.models import Counter, MapsByDay
+
+from contextlib import contextmanager
+import collections
+
+# Used for the admin dashboard's "maps needing review" table, and its review links
+STATION_COUNT_GROUPS = {
+    '0 stations': {'station_count': 0},
+    '1-10 stations': {'station_count__gte': 1, 'station_count__lte': 10},
+    '11-20 stations': {'station_count__gte': 11, 'station_count__lte': 20},
+    '21-30 stations': {'station_count__gte': 21, 'station_count__lte': 30},
+    '31-40 stations': {'station_count__gte': 31, 'station_count__lte': 40},
+    '41-50 stations': {'station_count__gte': 41, 'station_count__lte': 50},
+    '51-75 stations': {'station_count__gte': 51, 'station_count__lte': 75},
+    '76-100 stations': {'station_count__gte': 76, 'station_count__lte': 100},
+    '101-200 stations': {'station_count__gte': 101, 'station_count__lte': 200},
+    '201-500 stations': {'station_count__gte': 201, 'station_count__lte': 500},
+    '501+ stations': {'station_count__gte': 501},
+}
+
+PUBLIC_TAGS = ['real', 'speculative', 'unknown', 'favorite']
+
+TALLY_CHUNK_SIZE = 2000
+
+
+def in_station_count_group(station_count, filters):
+    for lookup, value in filters.items():
+        if lookup == 'station_count' and station_count != value:
+            return False
+        elif lookup == 'station_count__gte' and station_count < value:
+            return False
+        elif lookup == 'station_count__lte' and station_count > value:
+            return False
+    return True
+
+
+def map_counters(gallery_visible, publicly_visible, station_count, tags):
+
+    """ Returns the names of the counters a map with these attributes counts towards
+    """
+
+    needs_review = gallery_visible and not tags
+
+    counters = ['maps']
+    if needs_review:
+        counters.append('maps:needing_review')
+    if gallery_visible and 'needs-review' in tags:
+        counters.append('maps:tagged:needs-review')
+
+    for group, filters in STATION_COUNT_GROUPS.items():
+        if in_station_count_group(station_count, filters):
+            counters.append(f'maps:stations:{group}')
+            if needs_review:
+                counters.append(f'maps:stations:{group}:needing_review')
+
+    if publicly_visible:
+        counters.append('maps:public')
+        counters.extend(f'maps:public:{tag}' for tag in PUBLIC_TAGS if tag in tags)
+
+    return counters
+
+
+def tally(maps):
+
+    """ Returns a collections.Counter of {counter name: count} for this queryset of maps
+    """
+
+    counts = collections.Counter()
+
+    def count(values):
+        if values:
+            counts.update(map_counters(
+                values['gallery_visible'],
+                values['publicly_visible'],
+                values['station_count'],
+                values['tags'],
+            ))
+
+    # One row per map per tag; ordered by pk, so a map's rows are together
+    rows = maps.order_by('pk').values_list(
+        'pk',
+        'gallery_visible',
+        'publicly_visible',
+        'station_count',
+        'tags__slug',
+    )
+    this_map = {}
+    for pk, gallery_visible, publicly_visible, station_count, tag in rows.iterator(chunk_size=TALLY_CHUNK_SIZE):
+        if this_map.get('pk') != pk:
+            count(this_map)
+            this_map = {
+                'pk': pk,
+                'gallery_visible': gallery_visible,
+                'publicly_visible': publicly_visible,
+                'station_count': station_count,
+                'tags': set(),
+            }
+        if tag:
+            this_map['tags'].add(tag)
+    count(this_map)
+
+    return counts
+
+
+def increment(model, lookup, field, delta):
+
+    """ Atomically adds delta to model.field for the row matching lookup,
+            creating the row if it doesn't exist yet
+    """
+
+    if model.objects.filter(**lookup).update(**{field: F(field) + delta}):
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**lookup, **{field: delta})
+    except IntegrityError:
+        # Someone else created it first
+        model.objects.filter(**lookup).update(**{field: F(field) + delta})
+
+
+def apply(deltas):
+    # In a consistent order, so concurrent updates can't deadlock
+    for name, delta in sorted(deltas.items()):
+        if delta:
+            increment(Counter, {'name': name}, 'value', delta)
+
+
+def count_new_map(saved_map):
+
+    """ Called by SavedMap.save() once a map has been created.
+
+        Every new map increments the same few rows, so this runs after the map's own transaction
+            rather than inside it, and each increment is its own statement:
+            concurrent saves only wait on these rows for as long as one UPDATE takes,
+            instead of for the rest of each other's save.
+        A save that's interrupted in between leaves a counter short, until ./manage.py reconcile_counters.
+    """
+
+    apply(collections.Counter(map_counters(
+        saved_map.gallery_visible,
+        saved_map.publicly_visible,
+        saved_map.station_count,
+        set(),
+    )))
+    increment(MapsByDay, {'day': timezone.localdate(saved_map.created_at)}, 'maps', 1)
+
+
+@contextmanager
+def track_counters(maps):
+
+    """ Keeps the counters up to date with whatever happens to this queryset of maps
+            inside the with block:
+
+            with track_counters(SavedMap.objects.filter(pk=this_map.pk)):
+                this_map.tags.add(tag)
+
+        The maps are the ones in the queryset on the way in (their pks are what's yielded);
+            a map that's deleted inside the block is no longer counted.
+    """
+
+    from map_saver.models import SavedMap
+
+    with transaction.atomic():
+        pks = list(maps.values_list('pk', flat=True))
+        before = tally(SavedMap.objects.filter(pk__in=pks))
+        yield pks
+        after = tally(SavedMap.objects.filter(pk__in=pks))
+        after.subtract(before)
+        apply(after)
+
+
+def get_counters(*names):
+
+    """ Returns {name: value} for these counters (or all of them), in one query;
+            a counter nothing has counted towards yet is 0
+    """
+
+    counters = Counter.objects.all()
+    if names:
+        counters = counters.filter(name__in=names)
+    values = dict.fromkeys(names, 0)
+    values.update(counters.values_list('name', 'value'))
+    return values
+
+
+def reconcile():
+
+    """ Recounts every counter from scratch and corrects any that have drifted.
+        Returns {name: (was, now)} for the counters that were wrong.
+
+        The counter rows are locked (in the same order apply() takes them) before the maps are tallied,
+            so a change made meanwhile waits to apply its increments until the corrected values are written,
+            instead of being overwritten by a tally that didn't include it.
+    """
+
+    from map_saver.models import SavedMap
+
+    with transaction.atomic():
+        stored = dict(Counter.objects.select_for_update().order_by('name').values_list('name', 'value'))
+        actual = tally(SavedMap.objects.all())
+        drifted = {
+            name: (stored.get(name, 0), actual.get(name, 0))
+            for name in set(stored) | set(actual)
+            if stored.get(name, 0) != actual.get(name, 0)
+        }
+        for name, (_, now) in sorted(drifted.items()):
+            Counter.objects.update_or_create(name=name, defaults={'value': now})
+    return drifted
@@ -0,0 +1,78 @@
+""" The admin dashboard's figures that are too slow to work out on every visit:
+        which travel systems have a publicly visible real / speculative map,
+        and the most popular cities.
+
+    ./manage.py snapshot_dashboard (run on a regular schedule) stores them as a DashboardSnapshot;
+        AdminHomeView reads the latest one.
+"""
+
+from django.db.models import Count, Q
+
+from summary.models import DashboardSnapshot
+
+# Keep a little history, in case it's useful to see how coverage changes
+SNAPSHOTS_TO_KEEP = 30
+
+
+def compute_dashboard():
+
+    """ Returns every figure for the snapshot, as JSON-serializable data
+    """
+
+    from citysuggester.models import TravelSystem
+    from map_saver.models import SavedMap
+
+    travel_systems = TravelSystem.objects.values_list('name', flat=True)
+    travel_system_names = {name.split(',')[0] for name in travel_systems}
+
+    # How many travel systems do we have a publicly visible real/speculative map for?
+    #   One row per map name, counting its real and speculative maps together
+    coverage = SavedMap.objects \
+        .filter(publicly_visible=True, tags__slug__in=['real', 'speculative']) \
+        .filter(Q(name__in=travel_system_names) | Q(suggested_city__in=travel_system_names)) \
+        .values('name') \
+        .annotate(
+            real=Count('pk', filter=Q(tags__slug='real')),
+            speculative=Count('pk', filter=Q(tags__slug='speculative')),
+        ) \
+        .order_by()
+
+    has_real_map = {row['name'] for row in coverage if row['real']}
+    has_speculative_map = {row['name'] for row in coverage if row['speculative']}
+
+    most_popular_cities = SavedMap.objects.exclude(suggested_city='') \
+        .values_list('suggested_city') \
+        .annotate(city_count=Count('suggested_city')) \
+        .order_by('-city_count')[:10]
+
+    most_popular_cities_by_name = SavedMap.objects.exclude(name='') \
+        .filter(publicly_visible=True) \
+        .values_list('name') \
+        .annotate(city_count=Count('name')) \
+        .order_by('-city_count')[:10]
+
+    return {
+        'travel_system_has_real_map': sorted(has_real_map),
+        'travel_system_missing_real_map': sorted(travel_system_names - has_real_map),
+        'travel_system_has_speculative_map': sorted(has_speculative_map),
+        'travel_system_missing_speculative_map': sorted(travel_system_names - has_speculative_map),
+        'total_travel_systems': len(travel_systems),
+        'most_popular_cities': [list(city) for city in most_popular_cities],
+        'most_popular_cities_by_name': [list(city) for city in most_popular_cities_by_name],
+    }
+
+
+def take_snapshot():
+    snapshot = DashboardSnapshot.objects.create(data=compute_dashboard())
+    old_snapshots = DashboardSnapshot.objects.order_by('-created_at').values_list('pk', flat=True)[SNAPSHOTS_TO_KEEP:]
+    DashboardSnapshot.objects.filter(pk__in=list(old_snapshots)).delete()
+    return snapshot
+
+
+def latest_snapshot():
+
+    """ Returns the most recent DashboardSnapshot,
+            taking the first one now if there isn't one yet
+    """
+
+    return DashboardSnapshot.objects.order_by('-created_at').first() or take_snapshot()
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from summary.counters import reconcile
+
+
+class Command(BaseCommand):
+    help = """
+        Run on a regular schedule to recount every counter in summary.Counter from scratch
+            and correct any that have drifted
+            (e.g. from maps edited in the Django admin, which doesn't update the counters).
+
+        Also run it once after the migration that creates the Counter table,
+            to count the maps saved before it existed.
+
+        Reports each counter that was wrong; if none were, the counters are being kept up to date.
+    """
+
+    def handle(self, *args, **kwargs):
+        drifted = reconcile()
+
+        for name, (was, now) in sorted(drifted.items()):
+            self.stdout.write(f'[DRIFT] {name}: {was} -> {now} ({now - was:+})')
+
+        self.stdout.write(f'Reconciled counters; {len(drifted)} had drifted.')
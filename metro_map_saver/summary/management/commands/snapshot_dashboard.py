@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from summary.dashboard import take_snapshot
+
+import time
+
+
+class Command(BaseCommand):
+    help = """
+        Run on a regular schedule to compute the admin dashboard's slower figures
+            (travel system coverage, most popular cities)
+            and store them as a DashboardSnapshot for the dashboard to read.
+    """
+
+    def handle(self, *args, **kwargs):
+        t0 = time.time()
+        snapshot = take_snapshot()
+        t1 = time.time()
+        self.stdout.write(f'Took dashboard snapshot #{snapshot.pk} in {(t1 - t0):.2f}s')
@@ -1,3 +1,4 @@
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
 from django.db.models import Count
 from django.db.models.functions import TruncDate
@@ -21,6 +22,16 @@ class Command(BaseCommand):
             action='store_true',
             help='Calculate maps by day for all time instead of only last 7 days',
         )
+        parser.add_argument(
+            '--warm-cache',
+            action='store_true',
+            help='Afterwards, re-render the gallery, calendar and city pages into the cache (see warm_cache)',
+        )
+        parser.add_argument(
+            '--warm-alltime',
+            action='store_true',
+            help='With --warm-cache, warm the calendar for every month with maps instead of only the most recent',
+        )
 
     def handle(self, *args, **kwargs):
 
@@ -49,3 +60,6 @@ class Command(BaseCommand):
                     day=mbd['day'],
                     maps=mbd['day__count'],
                 )
+
+        if kwargs.get('warm_cache'):
+            call_command('warm_cache', refresh=True, alltime=kwargs.get('warm_alltime'), stdout=self.stdout)
@@ -1,3 +1,4 @@
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
 from django.db.models import Count, Q
 from django.db.models.functions import TruncDate
@@ -22,6 +23,16 @@ class Command(BaseCommand):
             action='store_true',
             help='Calculate maps for all time instead of only last 7 days',
         )
+        parser.add_argument(
+            '--warm-cache',
+            action='store_true',
+            help='Afterwards, re-render the gallery, calendar and city pages into the cache (see warm_cache)',
+        )
+        parser.add_argument(
+            '--warm-alltime',
+            action='store_true',
+            help='With --warm-cache, warm the calendar for every month with maps instead of only the most recent',
+        )
 
     def handle(self, *args, **kwargs):
         alltime = kwargs.get('alltime')
@@ -70,3 +81,6 @@ class Command(BaseCommand):
             mbc.maps = city.num_maps
             mbc.featured = SavedMap.objects.filter(city=city).order_by('-likes', '-created_at').first() or None
             mbc.save()
+
+        if kwargs.get('warm_cache'):
+            call_command('warm_cache', refresh=True, alltime=kwargs.get('warm_alltime'), stdout=self.stdout)
@@ -37,3 +37,41 @@ class MapsByCity(models.Model):
 
     def __str__(self):
         return self.city.name
+
+
+class Counter(models.Model):
+
+    """ A count of maps that's kept up to date as maps are created, tagged and hidden
+            (see summary.counters), so the admin dashboard and gallery
+            can read a count instead of running COUNT(*) over SavedMap
+    """
+
+    name = models.CharField(max_length=100)
+    value = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['name'], name='unique_counter_name'),
+        ]
+
+    def __str__(self):
+        return f'{self.name}: {self.value}'
+
+
+class DashboardSnapshot(models.Model):
+
+    """ The slower figures on the admin dashboard (see summary.dashboard),
+            computed in the background by ./manage.py snapshot_dashboard
+            so the dashboard itself only has to read the latest one
+    """
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    data = models.JSONField(default=dict)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["created_at"]),
+        ]
+
+    def __str__(self):
+        return f'Dashboard snapshot at {self.created_at}'